@@ -1,184 +1,524 @@
 import streamlit as st
 import pdfplumber
-import io
 from collections import OrderedDict
+from concurrent.futures import as_completed
 import pandas as pd
-from openai import OpenAI
+import numpy as np
 import os
+import re
 from dotenv import load_dotenv
 import plotly.graph_objects as go
 import plotly.express as px
-from anthropic import Anthropic
 import anthropic
 from export_pdf_utils import *
+from extraction_cache import hash_pdf_bytes, get_cached_extraction, set_cached_extraction
+from llm_clients import chat_completion, claude_message, regenerating, show_latency_histogram
+from prompt_tables import sessions_block
+from session_records import build_session_frame, minutes
+from structured_analysis import STRUCTURED_ANALYSIS, structured_session_analysis
+from parse_pool import submit_parse
+from pdf_backends import get_backend, selected_backend
+from report_sections import AnalysisFanOut, chart_analysis_section, text_analysis_section
+from trace_extraction import extract_session_traces, lttb_downsample
+from treatment_overview import render_overview
+from upload_buffers import spool_upload, as_pdf_stream
 # Load environment variables
 load_dotenv()
-def extract_text_from_pdf(pdf_file):
-    try:
-        # Reset file pointer to the beginning
-        pdf_file.seek(0)
+
+# Bump whenever parse_reoxy_report output changes so cached extractions are ignored
+EXTRACTOR_VERSION = "3"
+TRACE_EXTRACTOR_VERSION = "1"
+
+# Points kept per trace when plotting a session's SpO2 / PR curves
+TRACE_PLOT_POINTS = 300
+
+# A session report parses in about 0.1 s, while starting the spawn pool costs about 4 s
+# and each task pays a pickling round trip, so small uploads are parsed in-process
+PARALLEL_MIN_FILES = int(os.getenv("REOXY_PARALLEL_MIN_FILES", "8"))
+
+# Label -> (patient_data field, word_list index of its value on the reference layout, label that must come first)
+# The absolute indices are only used until a report has taught each value's offset from its label
+REOXY_FIELD_LOCATIONS = {
+    # Patient info
+    "Patient name": ('patient_name', 2, None),
+    "Ref. No.": ('reference_number', 3, None),
+    "Sex": ('sex', 8, None),
+    "Date of birth": ('date_of_birth', 9, None),
+    "Treatment No.": ('treatment_number', 10, None),
+    "Date": ('treatment_date', 11, "Treatment No."),  # Treatment date, not the date of birth label
+    
+    # Results section
+    "Total duration": ('total_duration', 39, None),  # "41:09 min:sec"
+    "Total hypoxic time": ('total_hypoxic_time', 40, None),  # "16:40 min:sec"
+    "Adjustment time": ('adjustment_time', 41, None),  # "08:36 min:sec"
+    "Number of hypoxic phases": ('number_of_hypoxic_phases', 46, None),  # "5"
+    "Hypoxic phase duration average": ('hypoxic_phase_duration_avg', 47, None),  # "03:20 min:sec"
+    "Min SpO": ('min_spo2_average', 48, None),  # "82 %"
+    "Number of hyperoxic phases": ('number_of_hyperoxic_phases', 53, None),  # "5"
+    "Hyperoxic phase duration average": ('hyperoxic_phase_duration_avg', 54, None),  # "03:52 min:sec"
+    "Max SpO": ('max_spo2_average', 55, None),  # "100 %"
+    "Baseline PR": ('baseline_pr', 59, None),  # "71 bpm"
+    "Min PR average": ('min_pr_average', 60, None),  # "58 bpm"
+    "Max PR average": ('max_pr_average', 61, None),  # "84 bpm"
+    "PR after procedure": ('pr_after_procedure', 65, None),  # "69 bpm"
+    "PR elevation (BPM)": ('pr_elevation_bpm', 66, None),  # "13,00"
+    "PR elevation (%)": ('pr_elevation_percent', 67, None),  # "18,31"
+    
+    # Blood pressure
+    "BP before procedure": ('bp_before_procedure', 71, None),
+    "BP after procedure": ('bp_after_procedure', 72, None),
+}
+
+# Shape every value must have before a scan is trusted to teach the label offsets
+_DURATION = r'\d+:\d{2}\b.*'
+_DATE = r'\d{2}\.\d{2}\.\d{4}'
+REOXY_VALUE_PATTERNS = {
+    'date_of_birth': _DATE,
+    'treatment_number': r'\d+',
+    'treatment_date': _DATE,
+    'total_duration': _DURATION,
+    'total_hypoxic_time': _DURATION,
+    'adjustment_time': _DURATION,
+    'number_of_hypoxic_phases': r'\d+',
+    'hypoxic_phase_duration_avg': _DURATION,
+    'min_spo2_average': r'\d+\s*%',
+    'number_of_hyperoxic_phases': r'\d+',
+    'hyperoxic_phase_duration_avg': _DURATION,
+    'max_spo2_average': r'\d+\s*%',
+    'baseline_pr': r'\d+\s*bpm',
+    'min_pr_average': r'\d+\s*bpm',
+    'max_pr_average': r'\d+\s*bpm',
+    'pr_after_procedure': r'\d+\s*bpm',
+    'pr_elevation_bpm': r'-?\d+(?:[,.]\d+)?',
+    'pr_elevation_percent': r'-?\d+(?:[,.]\d+)?',
+    'bp_before_procedure': r'\d+\s*/\s*\d+|---',
+    'bp_after_procedure': r'\d+\s*/\s*\d+|---',
+}
+
+# Labels re-checked with a crop before a cached layout plan is trusted
+PLAN_ANCHOR_LABELS = ("Patient name", "Total duration", "Baseline PR", "BP after procedure")
+# Characters this close outside a value cell mean the value is wider than the cell it was learned from
+CELL_EDGE_MARGIN = 3
+
+def layout_fingerprint(pdf):
+    """Identify a report layout from the producing device/software and the page geometry"""
+    metadata = pdf.metadata or {}
+    parts = [
+        str(metadata.get('Creator', '')),
+        str(metadata.get('Producer', '')),
+        str(len(pdf.pages))
+    ]
+    for page in pdf.pages:
+        parts.append(f"{round(float(page.width))}x{round(float(page.height))}")
+    return hash_pdf_bytes("|".join(parts).encode('utf-8'))
+
+def _value_cell_bbox(page, words, value_word):
+    """Widen a value word to its cell: halfway to its neighbours on the same line"""
+    left, right = 0, float(page.width)
+    for other in words:
+        if other is value_word or other['top'] >= value_word['bottom'] or other['bottom'] <= value_word['top']:
+            continue
+        if other['x1'] <= value_word['x0']:
+            left = max(left, (other['x1'] + value_word['x0']) / 2)
+        elif other['x0'] >= value_word['x1']:
+            right = min(right, (value_word['x1'] + other['x0']) / 2)
+    top = max(0, value_word['top'] - 1)
+    bottom = min(float(page.height), value_word['bottom'] + 1)
+    return (left, top, right, bottom)
+
+def load_field_offsets():
+    """Learned offsets of each value from its label (field -> word count), or None before the first good scan"""
+    return get_cached_extraction('reoxy_field_offsets', 'reoxy_session', EXTRACTOR_VERSION)
+
+def learn_field_offsets(values, offsets):
+    """
+    Keep the label offsets of a full scan whose values all have their expected shape
+    
+    Args:
+        values: Field values read by the scan
+        offsets: Field -> value index minus label index, as the scan found them
+    """
+    fields = [field for field, _, _ in REOXY_FIELD_LOCATIONS.values()]
+    if any(field not in offsets or not values.get(field) or values[field] in REOXY_FIELD_LOCATIONS for field in fields):
+        return
+    if any(not re.fullmatch(pattern, values[field]) for field, pattern in REOXY_VALUE_PATTERNS.items()):
+        return
+    set_cached_extraction('reoxy_field_offsets', 'reoxy_session', EXTRACTOR_VERSION, offsets)
+
+def _value_overflows_cell(page, bbox):
+    """True when a character crosses the cell edge or sits just outside it, so a crop would cut the value"""
+    x0, top, x1, bottom = bbox
+    band = page.crop((max(0, x0 - CELL_EDGE_MARGIN), top, min(float(page.width), x1 + CELL_EDGE_MARGIN), bottom))
+    return len(band.chars) != len(page.within_bbox(bbox).chars)
+
+def _match_reoxy_fields(word_list, remaining, offsets=None):
+    """
+    Single pass over a page, looking each word up in the label table
+    
+    Values are read at their learned offset from the label, or at the reference
+    layout's absolute index while no offsets have been learned.
+    
+    Yields (label, field, label_index, value_index) and removes matched labels from remaining
+    """
+    for i, word in enumerate(word_list):
+        if word not in remaining:
+            continue
+        field, value_index, after_label = REOXY_FIELD_LOCATIONS[word]
+        if after_label in remaining:
+            continue
+        if offsets is not None:
+            value_index = i + offsets[field]
+        if not 0 <= value_index < len(word_list):
+            continue
+        remaining.discard(word)
+        yield word, field, i, value_index
+        if not remaining:
+            return
+
+def scan_reoxy_word_lists(page_word_lists, offsets=None):
+    """
+    Extract field values from per-page word lists produced by any PDF text backend
+    
+    Returns:
+        tuple: (values, found_offsets) where found_offsets maps each field to its value index minus label index
+    """
+    values = {}
+    found_offsets = {}
+    remaining = set(REOXY_FIELD_LOCATIONS)
+    for word_list in page_word_lists:
+        word_list = [word for word in word_list if word != '2']
+        for label, field, i, value_index in _match_reoxy_fields(word_list, remaining, offsets):
+            values[field] = word_list[value_index]
+            found_offsets[field] = value_index - i
+        # Stop reading pages once every field has been filled
+        if not remaining:
+            break
+    return values, found_offsets
+
+def scan_reoxy_fields(pdf, offsets=None):
+    """
+    Full-page scan of a ReOxy session report
+    
+    Returns:
+        tuple: (values, plan, found_offsets) where plan holds the label and value cell
+        bounding boxes of every field, or None when not every field was found, and
+        found_offsets maps each field to its value index minus label index
+    """
+    values = {}
+    plan = {}
+    found_offsets = {}
+    remaining = set(REOXY_FIELD_LOCATIONS)
+    for page_index, page in enumerate(pdf.pages):
+        all_words = page.extract_words(
+            x_tolerance=3,
+            y_tolerance=3,
+            keep_blank_chars=True,
+            use_text_flow=True
+        )
         
-        pdf_bytes = pdf_file.read()
-        pdf = pdfplumber.open(io.BytesIO(pdf_bytes))
+        words = [w for w in all_words if w['text'].strip() != '2']
+        word_list = [w['text'].strip() for w in words]
         
-        # Dictionary to store patient data
-        patient_data = {
-            # Existing fields
-            'patient_name': '',
-            'reference_number': '',
-            'sex': '',
-            'date_of_birth': '',
-            'treatment_number': '',
-            'treatment_date': '',
-            
-            # Results section
-            'total_duration': '',
-            'total_hypoxic_time': '',
-            'adjustment_time': '',
-            'number_of_hypoxic_phases': '',
-            'hypoxic_phase_duration_avg': '',
-            'min_spo2_average': '',
-            'number_of_hyperoxic_phases': '',
-            'hyperoxic_phase_duration_avg': '',
-            'max_spo2_average': '',
-            'baseline_pr': '',
-            'min_pr_average': '',
-            'max_pr_average': '',
-            'pr_after_procedure': '',
-            'pr_elevation_bpm': '',
-            'pr_elevation_percent': '',
-            
-            # Add new fields for blood pressure
-            'bp_before_procedure': '',
-            'bp_after_procedure': '',
-        }
+        for label, field, i, value_index in _match_reoxy_fields(word_list, remaining, offsets):
+            values[field] = word_list[value_index]
+            found_offsets[field] = value_index - i
+            label_word = words[i]
+            plan[field] = {
+                'page': page_index,
+                'label': label,
+                'label_bbox': (label_word['x0'], label_word['top'], label_word['x1'], label_word['bottom']),
+                'value_bbox': _value_cell_bbox(page, all_words, words[value_index])
+            }
         
-        for page in pdf.pages:
-            words = page.extract_words(
-                x_tolerance=3,
-                y_tolerance=3,
-                keep_blank_chars=True,
-                use_text_flow=True
-            )
-            
-            word_list = [w['text'].strip() for w in words]
-            word_list = [word for word in word_list if word != '2']
-            
-            
-            # Process Results section
-            for i, word in enumerate(word_list):
-                # Patient info (using exact indices we can see)
-                if word == "Patient name":
-                    patient_data['patient_name'] = word_list[2]  # Index 2
-                elif word == "Ref. No.":
-                    patient_data['reference_number'] = word_list[3]  # Index 3
-                elif word == "Sex":
-                    patient_data['sex'] = word_list[8]  # Index 8
-                elif word == "Date of birth":
-                    patient_data['date_of_birth'] = word_list[9]  # Index 9
-                elif word == "Treatment No.":
-                    patient_data['treatment_number'] = word_list[10]  # Index 10
-                elif word == "Date" and i > 6:  # Treatment date
-                    patient_data['treatment_date'] = word_list[11]  # Index 11
-                
-                # Results section (using exact indices)
-                elif word == "Total duration":
-                    patient_data['total_duration'] = word_list[39]  # "41:09 min:sec"
-                elif word == "Total hypoxic time":
-                    patient_data['total_hypoxic_time'] = word_list[40]  # "16:40 min:sec"
-                elif word == "Adjustment time":
-                    patient_data['adjustment_time'] = word_list[41]  # "08:36 min:sec"
-                elif word == "Number of hypoxic phases":
-                    patient_data['number_of_hypoxic_phases'] = word_list[46]  # "5"
-                elif word == "Hypoxic phase duration average":
-                    patient_data['hypoxic_phase_duration_avg'] = word_list[47]  # "03:20 min:sec"
-                elif word == "Min SpO":
-                    patient_data['min_spo2_average'] = word_list[48]  # "82 %"
-                elif word == "Number of hyperoxic phases":
-                    patient_data['number_of_hyperoxic_phases'] = word_list[53]  # "5"
-                elif word == "Hyperoxic phase duration average":
-                    patient_data['hyperoxic_phase_duration_avg'] = word_list[54]  # "03:52 min:sec"
-                elif word == "Max SpO":
-                    patient_data['max_spo2_average'] = word_list[55]  # "100 %"
-                elif word == "Baseline PR":
-                    patient_data['baseline_pr'] = word_list[59]  # "71 bpm"
-                elif word == "Min PR average":
-                    patient_data['min_pr_average'] = word_list[60]  # "58 bpm"
-                elif word == "Max PR average":
-                    patient_data['max_pr_average'] = word_list[61]  # "84 bpm"
-                elif word == "PR after procedure":
-                    patient_data['pr_after_procedure'] = word_list[65]  # "69 bpm"
-                elif word == "PR elevation (BPM)":
-                    patient_data['pr_elevation_bpm'] = word_list[66]  # "13,00"
-                elif word == "PR elevation (%)":
-                    patient_data['pr_elevation_percent'] = word_list[67]  # "18,31"
-                
-                # Add extraction for BP before and after procedure
-                elif word == "BP before procedure":
-                    patient_data['bp_before_procedure'] = word_list[71]  # Adjust index as needed
-                elif word == "BP after procedure":
-                    patient_data['bp_after_procedure'] = word_list[72]  # Adjust index as needed
+        # Stop reading pages once every field has been filled
+        if not remaining:
+            break
+    
+    return values, (plan if not remaining else None), found_offsets
+
+def apply_layout_plan(pdf, plan):
+    """
+    Read field values by cropping only the value cells of a learned layout plan
+    
+    Returns:
+        dict: Field values, or None if the report does not match the plan
+    """
+    values = {}
+    try:
+        for field, cell in plan.items():
+            if cell['page'] >= len(pdf.pages):
+                return None
+            page = pdf.pages[cell['page']]
+            if cell['label'] in PLAN_ANCHOR_LABELS:
+                x0, top, x1, bottom = cell['label_bbox']
+                label_text = page.crop((max(0, x0 - 1), max(0, top - 1), x1 + 1, bottom + 1)).extract_text() or ''
+                if cell['label'] not in label_text:
+                    return None
+            if _value_overflows_cell(page, cell['value_bbox']):
+                return None
+            value = (page.crop(cell['value_bbox']).extract_text() or '').strip()
+            if not value or '\n' in value:
+                return None
+            values[field] = value
+    except (KeyError, ValueError):
+        return None
+    return values
+
+def parse_reoxy_report(source, backend=None):
+    """
+    Parse a ReOxy session report
+    
+    Args:
+        source: PDF bytes, path or open stream
+        backend: PDF text backend name, defaults to the benchmarked selection
+        
+    Returns:
+        tuple: (formatted_output, patient_data); parsing errors are raised
+    """
+    # Dictionary to store patient data
+    patient_data = {
+        # Existing fields
+        'patient_name': '',
+        'reference_number': '',
+        'sex': '',
+        'date_of_birth': '',
+        'treatment_number': '',
+        'treatment_date': '',
         
+        # Results section
+        'total_duration': '',
+        'total_hypoxic_time': '',
+        'adjustment_time': '',
+        'number_of_hypoxic_phases': '',
+        'hypoxic_phase_duration_avg': '',
+        'min_spo2_average': '',
+        'number_of_hyperoxic_phases': '',
+        'hyperoxic_phase_duration_avg': '',
+        'max_spo2_average': '',
+        'baseline_pr': '',
+        'min_pr_average': '',
+        'max_pr_average': '',
+        'pr_after_procedure': '',
+        'pr_elevation_bpm': '',
+        'pr_elevation_percent': '',
+        
+        # Add new fields for blood pressure
+        'bp_before_procedure': '',
+        'bp_after_procedure': '',
+    }
+    
+    backend = backend or selected_backend('reoxy_session')
+    offsets = load_field_offsets()
+    if backend != 'pdfplumber':
+        values, found_offsets = scan_reoxy_word_lists(get_backend(backend).page_words(source), offsets)
+        if offsets is None:
+            learn_field_offsets(values, found_offsets)
+        patient_data.update(values)
+        return format_patient_data(patient_data), patient_data
+    
+    pdf = pdfplumber.open(as_pdf_stream(source))
+    try:
+        # Known layouts only crop the value cells; unknown ones get a full scan that learns a plan
+        fingerprint = layout_fingerprint(pdf)
+        plan = get_cached_extraction('reoxy_layout_plan', fingerprint, EXTRACTOR_VERSION)
+        values = apply_layout_plan(pdf, plan) if plan is not None else None
+        if values is None:
+            values, plan, found_offsets = scan_reoxy_fields(pdf, offsets)
+            if offsets is None:
+                learn_field_offsets(values, found_offsets)
+            if plan is not None:
+                set_cached_extraction('reoxy_layout_plan', fingerprint, EXTRACTOR_VERSION, plan)
+        patient_data.update(values)
+    finally:
         pdf.close()
+    
+    return format_patient_data(patient_data), patient_data
+
+def format_patient_data(patient_data):
+    """Format extracted session fields as display lines"""
+    formatted_output = [
+        f"Patient Name: {patient_data['patient_name']}",
+        f"Reference Number: {patient_data['reference_number']}",
+        f"Sex: {patient_data['sex']}",
+        f"Date of Birth: {patient_data['date_of_birth']}",
+        f"Treatment Number: {patient_data['treatment_number']}",
+        f"Treatment Date: {patient_data['treatment_date']}",
         
-        # Format output
-        formatted_output = [
-            f"Patient Name: {patient_data['patient_name']}",
-            f"Reference Number: {patient_data['reference_number']}",
-            f"Sex: {patient_data['sex']}",
-            f"Date of Birth: {patient_data['date_of_birth']}",
-            f"Treatment Number: {patient_data['treatment_number']}",
-            f"Treatment Date: {patient_data['treatment_date']}",
-            
-            "\nResults:",
-            f"Total Duration: {patient_data['total_duration']}",
-            f"Total Hypoxic Time: {patient_data['total_hypoxic_time']}",
-            f"Adjustment Time: {patient_data['adjustment_time']}",
-            f"Number of Hypoxic Phases: {patient_data['number_of_hypoxic_phases']}",
-            f"Hypoxic Phase Duration Average: {patient_data['hypoxic_phase_duration_avg']}",
-            f"Min SpO2 Average: {patient_data['min_spo2_average']}",
-            f"Number of Hyperoxic Phases: {patient_data['number_of_hyperoxic_phases']}",
-            f"Hyperoxic Phase Duration Average: {patient_data['hyperoxic_phase_duration_avg']}",
-            f"Max SpO2 Average: {patient_data['max_spo2_average']}",
-            f"Baseline PR: {patient_data['baseline_pr']}",
-            f"Min PR Average: {patient_data['min_pr_average']}",
-            f"Max PR Average: {patient_data['max_pr_average']}",
-            f"PR After Procedure: {patient_data['pr_after_procedure']}",
-            f"PR Elevation (BPM): {patient_data['pr_elevation_bpm']}",
-            f"PR Elevation (%): {patient_data['pr_elevation_percent']}",
-            f"BP Before Procedure: {patient_data['bp_before_procedure']}",
-            f"BP After Procedure: {patient_data['bp_after_procedure']}"
-        ]
+        "\nResults:",
+        f"Total Duration: {patient_data['total_duration']}",
+        f"Total Hypoxic Time: {patient_data['total_hypoxic_time']}",
+        f"Adjustment Time: {patient_data['adjustment_time']}",
+        f"Number of Hypoxic Phases: {patient_data['number_of_hypoxic_phases']}",
+        f"Hypoxic Phase Duration Average: {patient_data['hypoxic_phase_duration_avg']}",
+        f"Min SpO2 Average: {patient_data['min_spo2_average']}",
+        f"Number of Hyperoxic Phases: {patient_data['number_of_hyperoxic_phases']}",
+        f"Hyperoxic Phase Duration Average: {patient_data['hyperoxic_phase_duration_avg']}",
+        f"Max SpO2 Average: {patient_data['max_spo2_average']}",
+        f"Baseline PR: {patient_data['baseline_pr']}",
+        f"Min PR Average: {patient_data['min_pr_average']}",
+        f"Max PR Average: {patient_data['max_pr_average']}",
+        f"PR After Procedure: {patient_data['pr_after_procedure']}",
+        f"PR Elevation (BPM): {patient_data['pr_elevation_bpm']}",
+        f"PR Elevation (%): {patient_data['pr_elevation_percent']}",
+        f"BP Before Procedure: {patient_data['bp_before_procedure']}",
+        f"BP After Procedure: {patient_data['bp_after_procedure']}"
+    ]
+    
+    return formatted_output
+
+def session_cache_version(backend):
+    """Extraction cache version of session reports; parses by another backend are ignored once the benchmark selects a new one"""
+    return f"{EXTRACTOR_VERSION}-{backend}"
+
+def parse_reoxy_report_cached(source, file_hash):
+    """Parse a ReOxy session report through the persistent extraction cache"""
+    backend = selected_backend('reoxy_session')
+    version = session_cache_version(backend)
+    cached = get_cached_extraction('reoxy_session', file_hash, version)
+    if cached is not None:
+        return cached
+    result = parse_reoxy_report(source, backend=backend)
+    set_cached_extraction('reoxy_session', file_hash, version, result)
+    return result
+
+def extract_uploaded_reports(files, parallel=False, progress_callback=None, known_reports=None):
+    """
+    Extract every uploaded PDF exactly once
+    
+    Args:
+        files: Uploaded file objects from st.file_uploader
+        parallel: Spread parsing across a process pool sized to the core count
+        progress_callback: Optional callable(done, total, name) called as each file finishes
+        known_reports: Records returned by the previous run; files found there are reused, not re-parsed
         
-        return formatted_output, patient_data
+    Returns:
+        OrderedDict: SHA-256 of the file bytes -> extraction record with
+        'name', 'upload' (UploadBuffer), 'file_ids', 'formatted_text', 'patient_data' and 'error'
+    """
+    known_reports = known_reports or {}
+    # Uploads seen on the previous run keep their hash, so they are not even re-hashed
+    known_hashes = {file_id: file_hash
+                    for file_hash, report in known_reports.items()
+                    for file_id in report.get('file_ids', [])}
+    reports = OrderedDict()
+    pending = OrderedDict()
+    for file in files:
+        file_id = getattr(file, 'file_id', None)
+        # Hashed in one streaming pass; the bytes stay in the uploader's buffer or a spool file
+        upload = spool_upload(file, known_hashes.get(file_id))
+        file_hash = upload.file_hash
+        # Identical files are only parsed once
+        if file_hash in reports:
+            if file_id:
+                reports[file_hash]['file_ids'].append(file_id)
+            continue
         
-    except Exception as e:
-        st.error(f"Error in extract_text_from_pdf: {str(e)}")
-        st.write("Full error:", str(e))
-        return [], {}
+        reports[file_hash] = {
+            'name': file.name,
+            'upload': upload,
+            'file_ids': [file_id] if file_id else [],
+            'formatted_text': [],
+            'patient_data': {},
+            'error': None
+        }
+        if file_hash in known_reports:
+            known = known_reports[file_hash]
+            reports[file_hash].update(
+                formatted_text=known['formatted_text'],
+                patient_data=known['patient_data'],
+                error=known['error']
+            )
+            continue
+        # Reports parsed in an earlier session or before a restart skip pdfplumber entirely
+        cached = get_cached_extraction('reoxy_session', file_hash, session_cache_version(selected_backend('reoxy_session')))
+        if cached is not None:
+            reports[file_hash]['formatted_text'], reports[file_hash]['patient_data'] = cached
+            continue
+        pending[file_hash] = upload
+    
+    def store_result(file_hash, parse):
+        report = reports[file_hash]
+        try:
+            report['formatted_text'], report['patient_data'] = parse()
+        except Exception as e:
+            report['error'] = str(e)
+        if progress_callback:
+            progress_callback(done, len(pending), report['name'])
+    
+    done = 0
+    if parallel and len(pending) >= PARALLEL_MIN_FILES:
+        futures = {submit_parse(parse_reoxy_report_cached, upload.worker_source(), file_hash): file_hash
+                   for file_hash, upload in pending.items()}
+        for future in as_completed(futures):
+            done += 1
+            store_result(futures[future], future.result)
+    else:
+        for file_hash, upload in pending.items():
+            done += 1
+            with upload.open() as stream:
+                store_result(file_hash, lambda: parse_reoxy_report_cached(stream, file_hash))
+    return reports
+
+def cached_for_sessions(session_key, name, compute):
+    """Reuse a chart, analysis or export result until the set of uploaded sessions changes; failed analyses are retried next time"""
+    cache = st.session_state.setdefault('reoxy_session_results', {})
+    if cache.get('session_key') != session_key:
+        cache.clear()
+        cache['session_key'] = session_key
+    if name not in cache:
+        value = compute()
+        if isinstance(value, str) and value.startswith("Error"):
+            return value
+        cache[name] = value
+    return cache[name]
+
+# Prompt table columns shared by the session comparisons
+ADAPTIVE_RESPONSE_COLUMNS = [
+    ('PR Elevation %', 'pr_elevation_percent'),
+    ('Baseline PR', 'baseline_pr'),
+    ('PR After Treatment', 'pr_after_procedure'),
+    ('Min SpO2', 'min_spo2_average'),
+    ('Max SpO2', 'max_spo2_average'),
+    ('Total Hypoxic Time', 'total_hypoxic_time'),
+]
+
+def start_session_analysis(fan_out, session_key, name, compute):
+    """Start an analysis on the fan-out unless cached_for_sessions already holds it"""
+    cache = st.session_state.get('reoxy_session_results', {})
+    cached = cache.get(name) if cache.get('session_key') == session_key else None
+    fan_out.start(name, compute, cached=cached,
+                  store=lambda value: cached_for_sessions(session_key, name, lambda: value))
+
+# Sections of structured_session_analysis -> the session results they fill
+STRUCTURED_SECTION_NAMES = {
+    'comparison': 'comparison',
+    'phase': 'phase_analysis',
+    'pr': 'pr_analysis',
+    'hypoxic_time': 'hypoxic_analysis',
+    'bp': 'bp_analysis',
+}
+
+def start_structured_session_analysis(fan_out, session_key, sorted_results, case_history):
+    """Start every analysis of the page as one structured request (REOXY_STRUCTURED_ANALYSIS=1)"""
+    names = dict(STRUCTURED_SECTION_NAMES)
+    if case_history.strip():
+        names['case_history'] = ('case_history', case_history)
+    cache = st.session_state.get('reoxy_session_results', {})
+    cached = {name: cache.get(name) for name in names.values()} if cache.get('session_key') == session_key else {}
+    fan_out.start_group(
+        list(names.values()),
+        lambda: {names[section]: text for section, text in structured_session_analysis(sorted_results, case_history).items()},
+        cached=cached,
+        stores={name: (lambda value, name=name: cached_for_sessions(session_key, name, lambda: value)) for name in names.values()}
+    )
 
 def compare_sessions_openai(sorted_results):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            # Convert BP values to display format
-            bp_before = 'N/A' if data['bp_before_procedure'] == '---' else data['bp_before_procedure']
-            bp_after = 'N/A' if data['bp_after_procedure'] == '---' else data['bp_after_procedure']
-            
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            Adaptive Response Metrics:
-            - PR Elevation: {data['pr_elevation_percent']}%
-            - Baseline PR: {data['baseline_pr']}
-            - PR After Treatment: {data['pr_after_procedure']}
-            - Min SpO2: {data['min_spo2_average']}
-            - Max SpO2: {data['max_spo2_average']}
-            - Total Hypoxic Time: {data['total_hypoxic_time']}
-            Blood Pressure Response:
-            - BP Before: {bp_before}
-            - BP After: {bp_after}
-            """)
+        # Convert BP values to display format
+        sessions_data = sessions_block(sorted_results.items(), ADAPTIVE_RESPONSE_COLUMNS + [
+            ('BP Before', lambda treatment_num, data: 'N/A' if data['bp_before_procedure'] == '---' else data['bp_before_procedure']),
+            ('BP After', lambda treatment_num, data: 'N/A' if data['bp_after_procedure'] == '---' else data['bp_after_procedure']),
+        ])
         
         prompt = f"""Analyze the adaptive response changes between these ReOxy sessions. Focus on:
         1. Heart rate adaptation trends
@@ -186,34 +526,22 @@ def compare_sessions_openai(sorted_results):
         3. Changes in hypoxic exposure tolerance
         4. Blood pressure response patterns
         
-        Sessions:{''.join(sessions_data)}
+        Sessions:
+        {sessions_data}
         
         Highlight key improvements in physiological adaptation between sessions, including cardiovascular responses shown by both heart rate and blood pressure changes.
         Return the results in markdown format and make sure to properly create unordered list items."""
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error comparing sessions: {str(e)}"
 
 def compare_sessions_claude(sorted_results):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            Adaptive Response Metrics:
-            - PR Elevation: {data['pr_elevation_percent']}%
-            - Baseline PR: {data['baseline_pr']}
-            - PR After Treatment: {data['pr_after_procedure']}
-            - Min SpO2: {data['min_spo2_average']}
-            - Max SpO2: {data['max_spo2_average']}
-            - Total Hypoxic Time: {data['total_hypoxic_time']}
-            """)
+        sessions_data = sessions_block(sorted_results.items(), ADAPTIVE_RESPONSE_COLUMNS)
         
         prompt = f"""Analyze the adaptive response across these ReOxy treatment sessions:
 
@@ -229,22 +557,21 @@ def compare_sessions_claude(sorted_results):
         
         3. Highlight any improvements or changes in adaptive capacity between sessions.
 
-        Sessions:{''.join(sessions_data)}
+        Sessions:
+        {sessions_data}
         
         Please focus on physiological adaptations and improvements in tolerance to hypoxic stress."""
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=1024,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error comparing sessions: {str(e)}"
 
 def generate_recommendations(patient_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         prompt = f"""
         Based on this ReOxy treatment data:
         - Min SpO2: {patient_data['min_spo2_average']}
@@ -254,17 +581,15 @@ def generate_recommendations(patient_data):
         Provide recommendations for future treatments.
         """
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error generating recommendations: {str(e)}"
 
 def generate_recommendations_claude(patient_data):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         prompt = f"""
         Based on this ReOxy treatment data, provide specific recommendations for future treatments:
         
@@ -283,35 +608,22 @@ def generate_recommendations_claude(patient_data):
         3. Potential areas for improvement
         """
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=1024,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error generating recommendations: {str(e)}"
 
-def create_charts(sorted_results):
-    treatment_numbers = list(sorted_results.keys())
-    
-    # Calculate PR Average and get PR after procedure and baseline
-    pr_averages = []
-    pr_after = []
-    pr_baseline = []
+def create_charts(sorted_results, session_frame=None):
+    if session_frame is None:
+        session_frame = build_session_frame(sorted_results)
+    treatment_numbers = list(session_frame.index)
     
-    for data in sorted_results.values():
-        # Calculate average of Min and Max PR
-        data["max_pr_average"].replace("Baseline Pr", "0")
-        data["min_pr_average"].replace("Baseline Pr", "0")
-        min_pr = float(data['min_pr_average'].split(' ')[0])
-        max_pr = float(data['max_pr_average'].split(' ')[0])
-        pr_avg = (min_pr + max_pr) / 2
-        pr_averages.append(pr_avg)
-        
-        # Get PR after procedure and baseline
-        pr_after.append(float(data['pr_after_procedure'].split(' ')[0]))
-        pr_baseline.append(float(data['baseline_pr'].split(' ')[0]))
+    pr_averages = session_frame['pr_average']
+    pr_after = session_frame['pr_after_procedure']
+    pr_baseline = session_frame['baseline_pr']
     
     # PR Comparison Chart
     fig_pr_comparison = go.Figure()
@@ -348,19 +660,8 @@ def create_charts(sorted_results):
     )
     
     # Process both hyperoxic and hypoxic duration data
-    hyperoxic_durations = []
-    hypoxic_durations = []
-    
-    for data in sorted_results.values():
-        # Process hyperoxic duration
-        hyper_str = data['hyperoxic_phase_duration_avg'].split(' ')[0]
-        hyper_min, hyper_sec = map(int, hyper_str.split(':'))
-        hyperoxic_durations.append(hyper_min + hyper_sec/60)
-        
-        # Process hypoxic duration
-        hypo_str = data['hypoxic_phase_duration_avg'].split(' ')[0]
-        hypo_min, hypo_sec = map(int, hypo_str.split(':'))
-        hypoxic_durations.append(hypo_min + hypo_sec/60)
+    hyperoxic_durations = minutes(session_frame['hyperoxic_phase_duration_avg'])
+    hypoxic_durations = minutes(session_frame['hypoxic_phase_duration_avg'])
     
     # Combined Phase Duration Chart
     fig_phases = go.Figure()
@@ -391,12 +692,7 @@ def create_charts(sorted_results):
     )
     
     # Total Hypoxic Time Chart
-    hypoxic_times = []
-    for data in sorted_results.values():
-        time_str = data['total_hypoxic_time'].split(' ')[0]  # Get "MM:SS" part
-        minutes, seconds = map(int, time_str.split(':'))
-        total_minutes = minutes + seconds/60
-        hypoxic_times.append(total_minutes)
+    hypoxic_times = minutes(session_frame['total_hypoxic_time'])
     
     fig_hypoxic_time = go.Figure()
     fig_hypoxic_time.add_trace(go.Scatter(
@@ -418,25 +714,9 @@ def create_charts(sorted_results):
         )
     )
     
-    # New lists for BP values
-    bp_before = []
-    bp_after = []
-    
-    for data in sorted_results.values():
-        bp_before.append(data['bp_before_procedure'])
-        bp_after.append(data['bp_after_procedure'])
-    
-    # Convert BP values to numeric, handling various invalid values
-    def convert_bp(bp_str):
-        if bp_str in ["N/A", "---", "", None]:
-            return None
-        try:
-            return float(bp_str.split(' ')[0])
-        except (ValueError, AttributeError, IndexError):
-            return None
-    
-    bp_before_numeric = [convert_bp(bp) for bp in bp_before]
-    bp_after_numeric = [convert_bp(bp) for bp in bp_after]
+    # Systolic values are plotted; missing BP ("---", "N/A") is NaN and bridged by connectgaps
+    bp_before_numeric = session_frame['bp_before_sys']
+    bp_after_numeric = session_frame['bp_after_sys']
     
     # BP Comparison Chart
     fig_bp_comparison = go.Figure()
@@ -477,99 +757,145 @@ def create_charts(sorted_results):
     
     return fig_pr_comparison, fig_phases, fig_hypoxic_time, fig_bp_comparison
 
+def load_session_traces(upload, total_duration_seconds=None):
+    """Recover a session's SpO2 / PR traces through the persistent extraction cache"""
+    cached = get_cached_extraction('reoxy_traces', upload.file_hash, TRACE_EXTRACTOR_VERSION)
+    if cached is not None:
+        return cached
+    with upload.open() as stream:
+        traces = extract_session_traces(stream, total_duration_seconds)
+    set_cached_extraction('reoxy_traces', upload.file_hash, TRACE_EXTRACTOR_VERSION, traces)
+    return traces
+
+def create_trace_chart(traces, treatment_num):
+    """Plot LTTB-downsampled SpO2 and PR traces of one session on shared time axis"""
+    fig = go.Figure()
+    trace_styles = [
+        ('spo2', 'SpO2 (%)', 'y'),
+        ('pr', 'Pulse Rate (bpm)', 'y2')
+    ]
+    for key, name, yaxis in trace_styles:
+        if key not in traces:
+            continue
+        values = traces[key]['values']
+        seconds = np.arange(len(values)) + traces[key]['start']
+        x, y = lttb_downsample(seconds / 60, values, TRACE_PLOT_POINTS)
+        fig.add_trace(go.Scatter(x=x, y=y, name=name, mode='lines', yaxis=yaxis))
+    
+    fig.update_layout(
+        title=f'SpO2 and Pulse Rate During Session {treatment_num}',
+        xaxis_title='Time (minutes)',
+        yaxis=dict(title='SpO2 (%)'),
+        yaxis2=dict(title='Pulse Rate (bpm)', overlaying='y', side='right'),
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=-0.3,
+            xanchor="center",
+            x=0.5,
+            font=dict(size=12)
+        ),
+        margin=dict(t=50, l=50, r=50, b=100),
+        height=500
+    )
+    return fig
+
+@st.fragment
+def show_session_traces(sorted_results, treatment_reports, session_frame):
+    # Runs as a fragment so picking a session does not rerun extraction and analyses
+    st.subheader("Session Traces")
+    trace_session = st.selectbox(
+        "Session",
+        list(sorted_results.keys()),
+        key="reoxy_trace_session"
+    )
+    total_duration = session_frame.at[trace_session, 'total_duration']
+    total_duration_seconds = None if pd.isna(total_duration) else total_duration.total_seconds()
+    with st.spinner('Reading session traces...'):
+        traces = load_session_traces(treatment_reports[trace_session]['upload'], total_duration_seconds)
+    if traces:
+        st.plotly_chart(create_trace_chart(traces, trace_session), use_container_width=True)
+    else:
+        st.write("No SpO2 / pulse rate traces found in this report")
+
 def analyze_hyperoxic_duration(sorted_results):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - Hyperoxic Phase Duration: {data['hyperoxic_phase_duration_avg']}
-            - Hypoxic Phase Duration: {data['hypoxic_phase_duration_avg']}
-            - PR Elevation: {data['pr_elevation_percent']}%
-            - SpO2 Max: {data['max_spo2_average']}
-            - SpO2 Min: {data['min_spo2_average']}
-            """)
+        sessions_data = sessions_block(sorted_results.items(), [
+            ('Hyperoxic Phase Duration', 'hyperoxic_phase_duration_avg'),
+            ('Hypoxic Phase Duration', 'hypoxic_phase_duration_avg'),
+            ('PR Elevation %', 'pr_elevation_percent'),
+            ('SpO2 Max', 'max_spo2_average'),
+            ('SpO2 Min', 'min_spo2_average'),
+        ])
         
         prompt = f"""Analyze the hyperoxic and hypoxic phase duration trends across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The relationship between hyperoxic and hypoxic durations
         2. What these trends indicate about the patient's adaptive response to treatment
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=200,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error analyzing phase durations: {str(e)}"
 
-def analyze_pr_trends(sorted_results):
+def analyze_pr_trends(sorted_results, session_frame=None):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        if session_frame is None:
+            session_frame = build_session_frame(sorted_results)
         
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            min_pr = float(data['min_pr_average'].split(' ')[0])
-            max_pr = float(data['max_pr_average'].split(' ')[0])
-            pr_avg = (min_pr + max_pr) / 2
-            
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - PR Average: {pr_avg:.1f} bpm
-            - PR After Procedure: {data['pr_after_procedure']}
-            - PR Elevation: {data['pr_elevation_percent']}%
-            """)
+        sessions_data = sessions_block(sorted_results.items(), [
+            ('PR Average (bpm)', lambda treatment_num, data: f"{session_frame.at[treatment_num, 'pr_average']:.1f}"),
+            ('PR After Procedure', 'pr_after_procedure'),
+            ('PR Elevation %', 'pr_elevation_percent'),
+        ])
         
         prompt = f"""Analyze the relationship between PR Average (mean of Min and Max PR) and PR After Procedure across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The recovery pattern shown by PR After Procedure compared to PR Average
         2. What this indicates about the patient's cardiovascular adaptation to treatment
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=200,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error analyzing PR trends: {str(e)}"
 
 def analyze_hypoxic_time(sorted_results):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - Total Hypoxic Time: {data['total_hypoxic_time']}
-            - PR Elevation: {data['pr_elevation_percent']}%
-            - Min SpO2: {data['min_spo2_average']}
-            """)
+        sessions_data = sessions_block(sorted_results.items(), [
+            ('Total Hypoxic Time', 'total_hypoxic_time'),
+            ('PR Elevation %', 'pr_elevation_percent'),
+            ('Min SpO2', 'min_spo2_average'),
+        ])
         
         prompt = f"""Analyze the total hypoxic time trends across these ReOxy sessions in 2-3 sentences. Focus on:
         1. Changes in hypoxic exposure duration
         2. What this suggests about the patient's adaptation to hypoxic stress
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=200,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error analyzing hypoxic time: {str(e)}"
 
 def analyze_case_history(case_history, sorted_results):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         
         # Get the latest session data
         latest_session = sorted_results[max(sorted_results.keys())]
@@ -585,49 +911,136 @@ def analyze_case_history(case_history, sorted_results):
         - Latest SpO2 Range: {latest_session['min_spo2_average']} - {latest_session['max_spo2_average']}
         """
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=200,  # Reduced token limit for more concise response
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error analyzing case history: {str(e)}"
 
 def analyze_bp_trends(sorted_results):
     try:
-        client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted_results.items():
-            # Only include BP data if it's valid
-            if data['bp_before_procedure'] not in ["N/A", "---", ""]:
-                sessions_data.append(f"""
-                Session {treatment_num}:
-                - BP Before: {data['bp_before_procedure']}
-                - BP After: {data['bp_after_procedure']}
-                - PR Elevation: {data['pr_elevation_percent']}%
-                - Total Hypoxic Time: {data['total_hypoxic_time']}
-                """)
+        # Only include BP data if it's valid
+        bp_sessions = [(treatment_num, data) for treatment_num, data in sorted_results.items()
+                       if data['bp_before_procedure'] not in ["N/A", "---", ""]]
         
-        if not sessions_data:
+        if not bp_sessions:
             return "Insufficient blood pressure data available for analysis."
         
+        sessions_data = sessions_block(bp_sessions, [
+            ('BP Before', 'bp_before_procedure'),
+            ('BP After', 'bp_after_procedure'),
+            ('PR Elevation %', 'pr_elevation_percent'),
+            ('Total Hypoxic Time', 'total_hypoxic_time'),
+        ])
+        
         prompt = f"""Analyze the blood pressure response across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The acute BP response to each session (before vs after)
         2. The overall trend across sessions and what this suggests about cardiovascular adaptation
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.messages.create(
+        return claude_message(
             model="claude-3-sonnet-20240229",
             max_tokens=200,
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.content[0].text
     except Exception as e:
         return f"Error analyzing BP trends: {str(e)}"
 
+@st.fragment
+def show_detailed_overview(sorted_results):
+    # Runs as a fragment so interacting with the overview only redraws the overview
+    st.markdown('<h2 class="detailed-overview-header">Detailed Treatment Overview</h2>', unsafe_allow_html=True)
+
+    if sorted_results:
+        # Define fields to display
+        fields = [
+            ('treatment_date', 'Treatment Date'),
+            ('total_duration', 'Total Duration'),
+            ('total_hypoxic_time', 'Total Hypoxic Time'),
+            ('number_of_hypoxic_phases', 'Number of Hypoxic Phases'),
+            ('hypoxic_phase_duration_avg', 'Hypoxic Phase Duration Average'),
+            ('min_spo2_average', 'Min SpO2 Average'),
+            ('number_of_hyperoxic_phases', 'Number of Hyperoxic Phases'),
+            ('hyperoxic_phase_duration_avg', 'Hyperoxic Phase Duration Average'),
+            ('max_spo2_average', 'Max SpO2 Average'),
+            ('baseline_pr', 'Baseline PR'),
+            ('min_pr_average', 'Min PR Average'),
+            ('max_pr_average', 'Max PR Average'),
+            ('pr_after_procedure', 'PR After Procedure'),
+            ('pr_elevation_bpm', 'PR Elevation (BPM)'),
+            ('pr_elevation_percent', 'PR Elevation (%)'),
+            ('bp_before_procedure', 'BP Before Procedure'),
+            ('bp_after_procedure', 'BP After Procedure')
+        ]
+        
+        # Add custom CSS for styling
+        st.markdown("""
+            <style>
+                /* Style for the section header */
+                .detailed-overview-header {
+                    font-size: 24px;
+                    color: #1E88E5;
+                    padding: 10px 0;
+                    border-bottom: 2px solid #1E88E5;
+                    margin-bottom: 20px;
+                }
+                
+                /* Style for tab labels */
+                .stTabs [data-baseweb="tab-list"] {
+                    gap: 8px;
+                }
+                
+                .stTabs [data-baseweb="tab"] {
+                    background-color: #f0f2f6;
+                    border-radius: 4px;
+                    padding: 8px 16px;
+                    font-weight: 500;
+                }
+                
+                .stTabs [aria-selected="true"] {
+                    background-color: #1E88E5;
+                    color: white;
+                }
+                
+                /* Style for table headers and cells */
+                .treatment-header {
+                    font-weight: bold;
+                    color: #1E88E5;
+                    font-size: 16px;
+                    padding: 8px 0;
+                    border-bottom: 1px solid #e0e0e0;
+                }
+                
+                .field-label {
+                    font-weight: 500;
+                    color: #424242;
+                    background-color: #f5f5f5;
+                    padding: 6px;
+                    border-radius: 4px;
+                    margin: 2px 0;
+                }
+                
+                .field-value {
+                    padding: 6px;
+                    border-radius: 4px;
+                    background-color: white;
+                    margin: 2px 0;
+                    border: 1px solid #e0e0e0;
+                }
+            </style>
+        """, unsafe_allow_html=True)
+        
+        render_overview(
+            sorted(sorted_results), fields,
+            lambda field_key, treatment_num: sorted_results[treatment_num].get(field_key, 'N/A'),
+            key="session_overview"
+        )
+
 def main():
     # Custom CSS for print styling
     st.markdown("""
@@ -823,24 +1236,37 @@ def main():
                         return False
                 return True
             
-            for file in new_files:
-                file_copy = io.BytesIO(file.read())
-                file_copy.name = file.name
-                file.seek(0)
+            # Extract each distinct file once and feed both validation and results from it
+            progress_bar = st.progress(0.0, text="Extracting session reports...")
+            
+            def update_progress(done, total, name):
+                progress_bar.progress(done / total, text=f"Extracted {name} ({done}/{total})")
+            
+            # Only files that were not in the uploader on the previous run are parsed
+            extracted_reports = extract_uploaded_reports(
+                new_files,
+                parallel=len(new_files) > 1,
+                progress_callback=update_progress,
+                known_reports=st.session_state.get('reoxy_reports')
+            )
+            progress_bar.empty()
+            st.session_state.reoxy_reports = OrderedDict(
+                (file_hash, {key: value for key, value in report.items() if key != 'upload'})
+                for file_hash, report in extracted_reports.items()
+            )
+            
+            for file_hash, report in extracted_reports.items():
+                if report['error']:
+                    st.error(f"Error processing {report['name']}: {report['error']}")
+                    continue
                 
-                try:
-                    # Extract data and validate
-                    formatted_text, patient_data = extract_text_from_pdf(file_copy)
-                    
-                    # Check if it's a valid ReOxy report
-                    if not is_valid_reoxy_report(patient_data):
-                        st.error(f"Error: {file.name} does not appear to be a valid ReOxy report. Please upload only ReOxy PDF reports. ReLoad the page")
-                        continue
-                    
-                    patient_names.add(patient_data['patient_name'])
-                    valid_files.append(file_copy)
-                except Exception as e:
-                    st.error(f"Error processing {file.name}: {str(e)}")
+                # Check if it's a valid ReOxy report
+                if not is_valid_reoxy_report(report['patient_data']):
+                    st.error(f"Error: {report['name']} does not appear to be a valid ReOxy report. Please upload only ReOxy PDF reports. ReLoad the page")
+                    continue
+                
+                patient_names.add(report['patient_data']['patient_name'])
+                valid_files.append(file_hash)
             
             # Check if all files are for the same patient
             if len(patient_names) > 1:
@@ -851,30 +1277,59 @@ def main():
                 return
             
             # If validation passes, proceed with processing
-            st.session_state.uploaded_files = valid_files
+            # Only the content hashes are kept per session; the bytes stay with the uploader
+            st.session_state.uploaded_files = list(valid_files)
             
-            # Process uploaded files and extract data
+            # Build results from the already extracted data
             all_results = {}
+            treatment_reports = {}
             first_patient = None
             content_to_export = []
 
-            for uploaded_file in st.session_state.uploaded_files:
+            for file_hash in valid_files:
+                report = extracted_reports[file_hash]
                 try:
-                    formatted_text, patient_data = extract_text_from_pdf(uploaded_file)
+                    patient_data = report['patient_data']
                     treatment_num = int(patient_data['treatment_number'])
                     all_results[treatment_num] = patient_data
+                    treatment_reports[treatment_num] = report
                     
                     # Store the first patient's data
                     if first_patient is None:
                         first_patient = patient_data
                 except Exception as e:
-                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+                    st.error(f"Error processing {report['name']}: {str(e)}")
             
             # Sort results by treatment number
             sorted_results = OrderedDict(sorted(all_results.items()))
+            # Charts and analyses are only recomputed when the set of sessions changes
+            session_key = tuple(sorted(valid_files))
+            # Typed numeric view of the sessions, parsed once for every chart and analysis
+            session_frame = cached_for_sessions(session_key, 'session_frame', lambda: build_session_frame(sorted_results)) if sorted_results else None
 
             # After processing files and before displaying the table
             if sorted_results:
+                # Regenerate asks the models again instead of reusing stored answers
+                regenerate = st.button("Regenerate analyses")
+                if regenerate:
+                    st.session_state.get('reoxy_session_results', {}).clear()
+                
+                # All analyses of the page run concurrently while the page is laid out
+                fan_out = AnalysisFanOut()
+                with regenerating(regenerate):
+                    if STRUCTURED_ANALYSIS and len(sorted_results) > 1:
+                        start_structured_session_analysis(fan_out, session_key, sorted_results, case_history)
+                    else:
+                        if case_history.strip():
+                            start_session_analysis(fan_out, session_key, ('case_history', case_history),
+                                                   lambda: analyze_case_history(case_history, sorted_results))
+                        if len(sorted_results) > 1:
+                            start_session_analysis(fan_out, session_key, 'comparison', lambda: compare_sessions_openai(sorted_results))
+                            start_session_analysis(fan_out, session_key, 'phase_analysis', lambda: analyze_hyperoxic_duration(sorted_results))
+                            start_session_analysis(fan_out, session_key, 'pr_analysis', lambda: analyze_pr_trends(sorted_results, session_frame))
+                            start_session_analysis(fan_out, session_key, 'hypoxic_analysis', lambda: analyze_hypoxic_time(sorted_results))
+                            start_session_analysis(fan_out, session_key, 'bp_analysis', lambda: analyze_bp_trends(sorted_results))
+                
                 # Display Patient Information first
                 st.subheader("Patient Information")
                 first_patient = next(iter(sorted_results.values()))
@@ -887,27 +1342,22 @@ def main():
                 content_to_export.append(patient_details)
                 # Add case history analysis if text was entered
                 if case_history.strip():
-                    st.subheader("Case History Analysis")
-                    history_analysis = analyze_case_history(case_history, sorted_results)
+                    text_analysis_section("Case History Analysis", fan_out, ('case_history', case_history))
 
                     case_history_analysis = AnalysisContent()
                     case_history_analysis.heading = "Case History Analysis"
-                    case_history_analysis.paragraph = history_analysis
                     content_to_export.append(case_history_analysis)
-                    st.write(history_analysis)
                 
                 # Add a separator
                 st.markdown("---")
                 
                 # Session Comparison
-                st.subheader("Session Comparison")
                 if len(sorted_results) > 1:
-                    comparison = compare_sessions_openai(sorted_results)
+                    text_analysis_section("Session Comparison", fan_out, 'comparison', 'Analyzing treatment sessions...')
                     session_analysis_content = AnalysisContent()
                     session_analysis_content.sub_heading = "Session Comparison"
-                    session_analysis_content.paragraph = comparison
-                    st.write(comparison)
                 else:
+                    st.subheader("Session Comparison")
                     st.write("Upload multiple sessions to see comparison")
                 
                 # Add a separator before the charts section
@@ -918,207 +1368,88 @@ def main():
                 
                 if len(sorted_results) > 1:  # Only show charts for multiple sessions
                     # Create all charts first
-                    fig_pr_comparison, fig_phases, fig_hypoxic_time, fig_bp_comparison = create_charts(sorted_results)
+                    fig_pr_comparison, fig_phases, fig_hypoxic_time, fig_bp_comparison = cached_for_sessions(
+                        session_key, 'charts', lambda: create_charts(sorted_results, session_frame)
+                    )
                     
                     # Phase Duration Chart
-                    st.write("**Phase Duration Analysis:**")
-                    st.plotly_chart(fig_phases, use_container_width=True)
-                    with st.spinner('Analyzing phase durations...'):
-                        phase_analysis = analyze_hyperoxic_duration(sorted_results)
-                        analysis_content = AnalysisContent()
-                        analysis_content.heading = "Treatment Progress Charts"
-                        analysis_content.sub_heading = "Phase Duration Analysis"
-                        analysis_content.paragraph = phase_analysis
-                        analysis_content.figure = fig_phases
-                        content_to_export.append(analysis_content)
-                        st.write(phase_analysis)
+                    chart_analysis_section("Phase Duration Analysis", fig_phases, fan_out, 'phase_analysis', 'Analyzing phase durations...')
+                    analysis_content = AnalysisContent()
+                    analysis_content.heading = "Treatment Progress Charts"
+                    analysis_content.sub_heading = "Phase Duration Analysis"
+                    # PDF export restyles its figures, so it gets copies of the cached ones
+                    analysis_content.figure = go.Figure(fig_phases)
+                    content_to_export.append(analysis_content)
                     
                     st.markdown("---")
                     
                     # PR Comparison Chart
-                    st.write("**Pulse Rate Analysis:**")
-                    st.plotly_chart(fig_pr_comparison, use_container_width=True)
-                    with st.spinner('Analyzing pulse rate trends...'):
-                        pr_analysis = analyze_pr_trends(sorted_results)
-                        st.write(pr_analysis)
-                        pulserate_analysis_content = AnalysisContent()
-                        pulserate_analysis_content.sub_heading = "Pulse Rate Analysis"
-                        pulserate_analysis_content.figure = fig_pr_comparison
-                        pulserate_analysis_content.paragraph = pr_analysis
-                        content_to_export.append(pulserate_analysis_content)
+                    chart_analysis_section("Pulse Rate Analysis", fig_pr_comparison, fan_out, 'pr_analysis', 'Analyzing pulse rate trends...')
+                    pulserate_analysis_content = AnalysisContent()
+                    pulserate_analysis_content.sub_heading = "Pulse Rate Analysis"
+                    pulserate_analysis_content.figure = go.Figure(fig_pr_comparison)
+                    content_to_export.append(pulserate_analysis_content)
                     
                     st.markdown("---")
                     
                     # Total Hypoxic Time Chart
-                    st.write("**Total Hypoxic Time Analysis:**")
-                    st.plotly_chart(fig_hypoxic_time, use_container_width=True)
-                    with st.spinner('Analyzing hypoxic time trends...'):
-                        hypoxic_analysis = analyze_hypoxic_time(sorted_results)
-                        st.write(hypoxic_analysis)
-                        hypoxic_time_analysis_content = AnalysisContent()
-                        hypoxic_time_analysis_content.sub_heading = "Total Hypoxic Time Analysis:"
-                        hypoxic_time_analysis_content.figure = fig_hypoxic_time
-                        hypoxic_time_analysis_content.paragraph = hypoxic_analysis
-                        content_to_export.append(hypoxic_time_analysis_content)
+                    chart_analysis_section("Total Hypoxic Time Analysis", fig_hypoxic_time, fan_out, 'hypoxic_analysis', 'Analyzing hypoxic time trends...')
+                    hypoxic_time_analysis_content = AnalysisContent()
+                    hypoxic_time_analysis_content.sub_heading = "Total Hypoxic Time Analysis:"
+                    hypoxic_time_analysis_content.figure = go.Figure(fig_hypoxic_time)
+                    content_to_export.append(hypoxic_time_analysis_content)
                     
                     st.markdown("---")
                     
                     # BP Comparison Chart
-                    st.write("**Blood Pressure Analysis:**")
-                    st.plotly_chart(fig_bp_comparison, use_container_width=True)
-                    with st.spinner('Analyzing BP trends...'):
-                        bp_analysis = analyze_bp_trends(sorted_results)
-                        st.write(bp_analysis)
-                        bp_analysis_content = AnalysisContent()
-                        bp_analysis_content.sub_heading = "Blood Pressure Analysis:"
-                        bp_analysis_content.figure = fig_bp_comparison
-                        bp_analysis_content.paragraph = bp_analysis
-                        content_to_export.append(bp_analysis_content)
+                    chart_analysis_section("Blood Pressure Analysis", fig_bp_comparison, fan_out, 'bp_analysis', 'Analyzing BP trends...')
+                    bp_analysis_content = AnalysisContent()
+                    bp_analysis_content.sub_heading = "Blood Pressure Analysis:"
+                    bp_analysis_content.figure = go.Figure(fig_bp_comparison)
+                    content_to_export.append(bp_analysis_content)
                 else:
                     st.write("Upload multiple sessions to see progress charts")
                 
+                st.markdown("---")
+                show_session_traces(sorted_results, treatment_reports, session_frame)
+                
+                # Write the analyses into their sections as they complete
+                analyses = fan_out.fill()
+                if case_history.strip():
+                    case_history_analysis.paragraph = analyses[('case_history', case_history)]
+                if len(sorted_results) > 1:
+                    session_analysis_content.paragraph = analyses['comparison']
+                    analysis_content.paragraph = analyses['phase_analysis']
+                    pulserate_analysis_content.paragraph = analyses['pr_analysis']
+                    hypoxic_time_analysis_content.paragraph = analyses['hypoxic_analysis']
+                    bp_analysis_content.paragraph = analyses['bp_analysis']
+                
                 st.markdown("---")
                 pdf_path = "exported_report.pdf"
-                print(content_to_export)
-                create_pdf(session_analysis_content, content_to_export, pdf_path)
-                with open(pdf_path, "rb") as file:
-                    pdf_bytes = file.read()
+                
+                def build_pdf():
+                    create_pdf(session_analysis_content, content_to_export, pdf_path)
+                    with open(pdf_path, "rb") as file:
+                        return file.read()
+                
+                # A PDF with a failed analysis in it is rebuilt next time instead of cached
+                if any(str(text).startswith("Error") for text in analyses.values()):
+                    pdf_bytes = build_pdf()
+                else:
+                    pdf_bytes = cached_for_sessions(session_key, ('pdf', case_history), build_pdf)
 
                 st.download_button(
                     label="Download PDF",
                     data=pdf_bytes,
                     file_name=pdf_path,
                     mime="application/pdf",
+                    on_click="ignore"
                 )
                 content_to_export.clear()
 
                 # Add the Detailed Treatment Overview section
-                st.markdown('<h2 class="detailed-overview-header">Detailed Treatment Overview</h2>', unsafe_allow_html=True)
-
-                if sorted_results:
-                    st.markdown('<div class="detailed-overview-content">', unsafe_allow_html=True)
-                    # Convert treatments to sorted list of tuples
-                    sorted_treatments = sorted(sorted_results.items())
-                    
-                    # Group treatments into sets of 5
-                    sessions_per_page = 5
-                    all_pages = []
-                    current_page = []
-                    
-                    for i, (treatment_num, data) in enumerate(sorted_treatments, 1):
-                        current_page.append((treatment_num, data))
-                        if i % sessions_per_page == 0 or i == len(sorted_treatments):
-                            all_pages.append(current_page)
-                            current_page = []
-                    
-                    # Add any remaining treatments to the last page
-                    if current_page:
-                        all_pages.append(current_page)
-                    
-                    # Create tabs for each group of 5
-                    tab_labels = [f"Sessions {i*5-4}-{min(i*5, len(sorted_treatments))}" 
-                                 for i in range(1, len(all_pages) + 1)]
-                    tabs = st.tabs(tab_labels)
-                    
-                    # Define fields to display
-                    fields = [
-                        ('treatment_date', 'Treatment Date'),
-                        ('total_duration', 'Total Duration'),
-                        ('total_hypoxic_time', 'Total Hypoxic Time'),
-                        ('number_of_hypoxic_phases', 'Number of Hypoxic Phases'),
-                        ('hypoxic_phase_duration_avg', 'Hypoxic Phase Duration Average'),
-                        ('min_spo2_average', 'Min SpO2 Average'),
-                        ('number_of_hyperoxic_phases', 'Number of Hyperoxic Phases'),
-                        ('hyperoxic_phase_duration_avg', 'Hyperoxic Phase Duration Average'),
-                        ('max_spo2_average', 'Max SpO2 Average'),
-                        ('baseline_pr', 'Baseline PR'),
-                        ('min_pr_average', 'Min PR Average'),
-                        ('max_pr_average', 'Max PR Average'),
-                        ('pr_after_procedure', 'PR After Procedure'),
-                        ('pr_elevation_bpm', 'PR Elevation (BPM)'),
-                        ('pr_elevation_percent', 'PR Elevation (%)'),
-                        ('bp_before_procedure', 'BP Before Procedure'),
-                        ('bp_after_procedure', 'BP After Procedure')
-                    ]
-                    
-                    # Add custom CSS for styling
-                    st.markdown("""
-                        <style>
-                            /* Style for the section header */
-                            .detailed-overview-header {
-                                font-size: 24px;
-                                color: #1E88E5;
-                                padding: 10px 0;
-                                border-bottom: 2px solid #1E88E5;
-                                margin-bottom: 20px;
-                            }
-                            
-                            /* Style for tab labels */
-                            .stTabs [data-baseweb="tab-list"] {
-                                gap: 8px;
-                            }
-                            
-                            .stTabs [data-baseweb="tab"] {
-                                background-color: #f0f2f6;
-                                border-radius: 4px;
-                                padding: 8px 16px;
-                                font-weight: 500;
-                            }
-                            
-                            .stTabs [aria-selected="true"] {
-                                background-color: #1E88E5;
-                                color: white;
-                            }
-                            
-                            /* Style for table headers and cells */
-                            .treatment-header {
-                                font-weight: bold;
-                                color: #1E88E5;
-                                font-size: 16px;
-                                padding: 8px 0;
-                                border-bottom: 1px solid #e0e0e0;
-                            }
-                            
-                            .field-label {
-                                font-weight: 500;
-                                color: #424242;
-                                background-color: #f5f5f5;
-                                padding: 6px;
-                                border-radius: 4px;
-                                margin: 2px 0;
-                            }
-                            
-                            .field-value {
-                                padding: 6px;
-                                border-radius: 4px;
-                                background-color: white;
-                                margin: 2px 0;
-                                border: 1px solid #e0e0e0;
-                            }
-                        </style>
-                    """, unsafe_allow_html=True)
-                    
-                    # Display content for each tab
-                    for tab_index, tab in enumerate(tabs):
-                        with tab:
-                            current_treatments = all_pages[tab_index]
-                            
-                            # Create columns for the table
-                            cols = st.columns(len(current_treatments) + 1)
-                            
-                            # Treatment number headers
-                            for i, (treatment_num, _) in enumerate(current_treatments, 1):
-                                cols[i].markdown(f'<div class="treatment-header">Session {treatment_num}</div>', unsafe_allow_html=True)
-                            
-                            # Create rows
-                            for field_key, field_label in fields:
-                                cols = st.columns(len(current_treatments) + 1)
-                                cols[0].markdown(f'<div class="field-label">{field_label}</div>', unsafe_allow_html=True)
-                                for i, (treatment_num, data) in enumerate(current_treatments, 1):
-                                    value = data.get(field_key, 'N/A')
-                                    cols[i].markdown(f'<div class="field-value">{value}</div>', unsafe_allow_html=True)
-                    
-                    st.markdown('</div>', unsafe_allow_html=True)
+                show_detailed_overview(sorted_results)
+                show_latency_histogram()
             else:
                 st.write("Upload multiple sessions to see progress charts")
 
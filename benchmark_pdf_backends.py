@@ -0,0 +1,80 @@
+"""
+Re-run the PDF backend benchmark on sample reports and store the fastest correct backend
+
+Usage:
+    python benchmark_pdf_backends.py reoxy_session samples/session_*.pdf
+    python benchmark_pdf_backends.py course_report "Course Report.pdf"
+"""
+import argparse
+import os
+import tempfile
+
+import extraction_cache
+from pdf_backends import benchmark_backends, load_backend_selection, save_backend_selection, BACKENDS_PATH
+
+
+def extract_reoxy_session(pdf_bytes, backend):
+    import app
+    formatted_text, patient_data = app.parse_reoxy_report(pdf_bytes, backend=backend)
+    return patient_data
+
+
+def extract_course(pdf_bytes, backend):
+    import course_report
+    # Page fragments would be cache hits after the first repeat
+    course_data = course_report.parse_course_report(pdf_bytes, use_cache=False)
+    fields = {
+        'patient_name': course_data['patient_name'],
+        'sex': course_data['sex'],
+        'dob': course_data['dob'],
+        'schedule': course_data['schedule']
+    }
+    for treatment_num, data in course_data['treatments'].items():
+        fields[f'treatment_{treatment_num}'] = data
+    return fields
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PDF text backends on sample reports")
+    parser.add_argument("report_type", choices=["reoxy_session", "course_report"])
+    parser.add_argument("samples", nargs="+", help="Sample PDF reports")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per sample")
+    args = parser.parse_args()
+
+    # Parsers still write layout plans and fragments; keep them out of the app's cache
+    cache_dir = tempfile.TemporaryDirectory()
+    extraction_cache.CACHE_PATH = os.path.join(cache_dir.name, "extraction_cache.sqlite3")
+
+    samples = []
+    for path in args.samples:
+        with open(path, "rb") as f:
+            samples.append(f.read())
+
+    if args.report_type == "reoxy_session":
+        import app
+        extract = extract_reoxy_session
+        golden_fields = [field for field, _, _ in app.REOXY_FIELD_LOCATIONS.values()]
+    else:
+        extract = extract_course
+        golden_fields = list(extract_course(samples[0], "pdfplumber").keys())
+
+    results = benchmark_backends(args.report_type, samples, extract, golden_fields, repeats=args.repeats)
+    for result in results:
+        status = "ok" if result['passed'] else f"FAILED ({len(result['mismatches'])} mismatched fields)"
+        print(f"{result['backend']:<12} {result['seconds']:.3f}s  {status}")
+        for sample_index, field, value, expected in result['mismatches'][:5]:
+            print(f"    {args.samples[sample_index]}: {field} = {value!r}, expected {expected!r}")
+
+    passed = [result for result in results if result['passed']]
+    if not passed:
+        print("No backend passed the golden-field check; selection left unchanged")
+        return
+
+    selection = load_backend_selection()
+    selection[args.report_type] = passed[0]['backend']
+    save_backend_selection(selection)
+    print(f"Selected {passed[0]['backend']} for {args.report_type} (saved to {BACKENDS_PATH})")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,232 +6,702 @@ import re
 
 import pandas as pd
 #from anthropic import Anthropic
+import hashlib
 import os
+from collections import OrderedDict
+from datetime import datetime
+import pickle
+from functools import lru_cache
+from concurrent.futures import as_completed
 from dotenv import load_dotenv
+from pdfminer.pdfinterp import LITERAL_FORM
+from pdfminer.pdftypes import PDFStream, resolve1
 import plotly.graph_objects as go
-from openai import OpenAI
 
 from export_pdf_utils import *
+from course_store import match_course, course_result
+from extraction_cache import get_cached_extraction, set_cached_extraction
+from llm_clients import chat_completion, regenerate_requested, regenerating, show_latency_histogram
+from parse_pool import PARSE_WORKERS, submit_parse
+from prompt_tables import sessions_block
+from report_sections import AnalysisFanOut, chart_analysis_section, text_analysis_section
+from session_records import build_course_frame, format_blood_pressure, format_min_sec, minutes
+from treatment_overview import render_overview
+from treatment_selection import (
+    bits_from_flags, bits_from_treatments, flags_from_bits, last_n_bits, range_bits, treatments_from_bits
+)
+from upload_buffers import spool_upload, as_pdf_stream
 # Load environment variables
 load_dotenv()
 content_to_write = []
 
+# Bump whenever extract_course_report output changes so cached extractions are ignored
+COURSE_EXTRACTOR_VERSION = "3"
 
-def extract_course_report(pdf_file):
+# Reports shorter than this are parsed serially. A page takes about 1 s, and going parallel
+# costs about 1.7 s even on a warm pool (the parent still lays out the first page for the
+# patient details, and each worker reopens the PDF), so two workers only win from about 5 pages
+PARALLEL_MIN_PAGES = int(os.getenv("REOXY_PARALLEL_MIN_PAGES", "6"))
+
+# Processed treatment selections kept per course for instant switching between them
+COURSE_SUBSET_CACHE_SIZE = int(os.getenv("REOXY_COURSE_SUBSET_CACHE_SIZE", "8"))
+
+# Memory one browser session may spend on a course report: the in-memory upload and its
+# structured result while parsing, then the course data, metrics and cached selections it keeps;
+# each parse worker's rough footprint counts too when splitting pages
+COURSE_MEMORY_BUDGET_BYTES = int(os.getenv("REOXY_COURSE_MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+# pdfplumber / pdfminer hold roughly this multiple of a page range's PDF bytes while parsing it
+PARSE_MEMORY_FACTOR = 4
+
+
+# Row labels of the main measurements table, matched by substring in this order
+MEASURE_MAPPINGS = (
+    ("Hypoxic O", "Hypoxic O2 conc. (%)"),
+    ("Min SpO", "Min SpO2 Av. (%)"),
+    ("Max SpO", "Max SpO2 Av. (%)"),
+    ("Therapeutic SpO", "Therapeutic SpO2 (%)"),
+    ("Procedure duration", "Procedure duration (min:sec)"),
+    ("Hypox. Phase dur", "Hypox. Phase dur. Av. (min:sec)"),
+    ("Hyperox. Phase dur", "Hyperox. Phase dur. Av. (min:sec)"),
+    ("Number of cycles", "Number of cycles"),
+    ("Min PR", "Min PR Av. (bpm)"),
+    ("Max PR", "Max PR Av. (bpm)"),
+)
+
+
+@lru_cache(maxsize=256)
+def _match_measure(row_label):
+    """Return the canonical measurement name for a main-table row label, or None"""
+    for pattern, full_name in MEASURE_MAPPINGS:
+        if pattern in row_label:
+            return full_name
+    return None
+
+
+def _classify_table(table):
+    """Classify a table in one pass as the 'main' measurements table, the 'bp' table or None"""
+    has_bp_rows = any("BP" in str(row[0]) for row in table if row and row[0])
+    if has_bp_rows:
+        return 'bp'
+    if "Treatment No." in str(table[0]):
+        return 'main'
+    return None
+
+
+def _collect_schedule(table, schedule):
+    """Add the ("Treatment N", date) cell pairs of a table to schedule"""
+    for row in table:
+        if not row:
+            continue
+        
+        # Process pairs of treatment and date
+        for i in range(0, len(row) - 1, 2):
+            treatment_text = str(row[i]).strip()
+            if not treatment_text.startswith("Treatment"):
+                continue
+            date_text = str(row[i + 1]).strip()
+            try:
+                # Strip any non-numeric characters before converting to int
+                treatment_num = int(''.join(filter(str.isdigit, treatment_text)))
+                if date_text:
+                    schedule[treatment_num] = date_text
+            except ValueError:
+                continue
+
+
+def _parse_course_page(page):
     """
-    Extract text from course report PDF
+    Parse the schedule and treatment tables of one course report page
     
-    Args:
-        pdf_file: File object containing the PDF
-        
     Returns:
-        dict: Extracted course report data
+        dict: Page fragment with 'schedule', 'treatments' and the page's 'word_list'
     """
-    try:
-        pdf_file.seek(0)
-        pdf_bytes = pdf_file.read()
-        pdf = pdfplumber.open(io.BytesIO(pdf_bytes))
+    fragment = {
+        'word_list': [],
+        'schedule': {},
+        'treatments': {}
+    }
+    
+    tables = page.extract_tables()
+    words = page.extract_words(
+        x_tolerance=2,
+        y_tolerance=2,
+        keep_blank_chars=True,
+        use_text_flow=False,
+        split_at_punctuation=False
+    )
+    
+    # Drop pdfplumber's per-page object caches; only the extracted values are kept
+    page.close()
+    
+    fragment['word_list'] = [w['text'].strip() for w in words]
+    
+    for table in tables:
+        if not table:
+            continue
+        _collect_schedule(table, fragment['schedule'])
         
-        course_data = {
-            'patient_name': '',
-            'sex': '',
-            'dob': '',
-            'raw_text': '',
-            'word_list': [],
-            'schedule': {},
-            'treatments': {}
-        }
+        table_kind = _classify_table(table)
+        if table_kind is None:
+            continue
         
-        # Extract all text from the first page first
-        first_page = pdf.pages[0]
-        text = first_page.extract_text()
-        course_data['raw_text'] = text
+        # Treatment numbers from the header row
+        treatment_nums = []
+        for cell in table[0][1:]:
+            try:
+                if cell and cell.strip():
+                    num = int(cell.strip())
+                    treatment_nums.append(num)
+                    if num not in fragment['treatments']:
+                        fragment['treatments'][num] = {}
+            except ValueError:
+                continue
         
-        # Extract patient info from raw text using regex
-        name_match = re.search(r'Ref\. No\.\s+([A-Za-z\s]+?)(?=\s+(?:Female|Male))', text)
-        if name_match:
-            course_data['patient_name'] = name_match.group(1).strip()
+        # Process each measurement row
+        for row in table[1:]:
+            if not row or not row[0]:
+                continue
             
-        sex_match = re.search(r'(?:Female|Male)', text)
-        if sex_match:
-            course_data['sex'] = sex_match.group(0).strip()
+            measure_name = str(row[0]).strip()
+            if table_kind == 'main':
+                measure_name = _match_measure(measure_name)
+                if measure_name is None:
+                    continue
             
-        birth_match = re.search(r'(?:Female|Male)\s+(\d{2}\.\d{2}\.\d{4})', text)
-        if birth_match:
-            course_data['dob'] = birth_match.group(1).strip()
+            for i, value in enumerate(row[1:]):
+                if i < len(treatment_nums) and value and value.strip():
+                    treatment_num = treatment_nums[i]
+                    fragment['treatments'][treatment_num][measure_name] = value.strip()
+    
+    return fragment
+
+def _page_fingerprint(page):
+    """Hash a page's drawing instructions and the fonts / forms it uses, without laying it out"""
+    page_obj = page.page_obj
+    digest = hashlib.sha256(repr(page_obj.mediabox).encode())
+    for stream in page_obj.contents:
+        digest.update(resolve1(stream).get_data())
+    resources = resolve1(page_obj.resources) or {}
+    for resource_type in ('Font', 'XObject'):
+        for name, ref in sorted((resolve1(resources.get(resource_type)) or {}).items()):
+            obj = resolve1(ref)
+            digest.update(str(name).encode())
+            if isinstance(obj, PDFStream):
+                # Forms can carry text; images only need their identity
+                if obj.get('Subtype') is LITERAL_FORM:
+                    digest.update(obj.get_data())
+                else:
+                    digest.update(repr(sorted((k, str(v)) for k, v in obj.attrs.items())).encode())
+            elif isinstance(obj, dict):
+                digest.update(str(obj.get('BaseFont')).encode())
+                to_unicode = resolve1(obj.get('ToUnicode'))
+                if isinstance(to_unicode, PDFStream):
+                    digest.update(to_unicode.get_data())
+    return digest.hexdigest()
+
+def _parse_course_page_cached(page):
+    """Reuse the fragment of an identical page from an earlier upload (e.g. last week's export)"""
+    fingerprint = _page_fingerprint(page)
+    fragment = get_cached_extraction('course_page', fingerprint, COURSE_EXTRACTOR_VERSION)
+    if fragment is not None:
+        page.close()
+        return fragment
+    fragment = _parse_course_page(page)
+    set_cached_extraction('course_page', fingerprint, COURSE_EXTRACTOR_VERSION, fragment)
+    return fragment
+
+def _parse_course_pages(source, page_indices):
+    """Parse a range of pages in a worker process, which opens its own copy of the PDF"""
+    with pdfplumber.open(as_pdf_stream(source)) as pdf:
+        fragments = [_parse_course_page(pdf.pages[page_index]) for page_index in page_indices]
+    return fragments
+
+def _merge_course_fragments(course_data, fragments):
+    """
+    Fold page fragments into course_data in page order, exactly as the serial page loop does
+    
+    Returns:
+        list: Word list of the last fragment merged
+    """
+    word_list = []
+    for fragment in fragments:
+        word_list = fragment['word_list']
+        course_data['schedule'].update(fragment['schedule'])
+        for treatment_num, measurements in fragment['treatments'].items():
+            course_data['treatments'].setdefault(treatment_num, {}).update(measurements)
+    return word_list
+
+def _read_source(stream):
+    stream.seek(0)
+    return stream.read()
+
+def _pickled_size(value):
+    """Approximate memory held by a value: the size of its pickle"""
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+def _check_memory_budget(used):
+    """Raise MemoryError once used bytes outgrow the session budget"""
+    if used > COURSE_MEMORY_BUDGET_BYTES:
+        raise MemoryError(
+            f"Course report needs more than the per-session memory budget "
+            f"({COURSE_MEMORY_BUDGET_BYTES // (1024 * 1024)} MB)"
+        )
+
+def _new_course_data(pdf):
+    """Start course_data from the patient details on the first page"""
+    course_data = {
+        'patient_name': '',
+        'sex': '',
+        'dob': '',
+        'ref_no': '',
+        'schedule': {},
+        'treatments': {}
+    }
+    
+    # Extract all text from the first page first; the page is left open so parsing it
+    # next reuses the characters laid out here instead of reading the page twice
+    text = pdf.pages[0].extract_text()
+    
+    # Extract patient info from raw text using regex
+    name_match = re.search(r'Ref\. No\.\s+([A-Za-z\s]+?)(?=\s+(?:Female|Male))', text)
+    if name_match:
+        course_data['patient_name'] = name_match.group(1).strip()
         
-        for page in pdf.pages:
-            tables = page.extract_tables()
-            words = page.extract_words(
-                x_tolerance=2,
-                y_tolerance=2,
-                keep_blank_chars=True,
-                use_text_flow=False,
-                split_at_punctuation=False
-            )
-            
-            word_list = [w['text'].strip() for w in words]
-            course_data['word_list'] = word_list
-            
-            # Process schedule table first
-            for table in tables:
-                if table and len(table) > 0:
-                    # Look for rows that contain treatment dates
-                    for row in table:
-                        if not row:
-                            continue
-                        
-                        # Process pairs of treatment and date
-                        for i in range(0, len(row), 2):
-                            if i + 1 >= len(row):
-                                break
-                            
-                            treatment_text = str(row[i]).strip()
-                            date_text = str(row[i + 1]).strip()
-                            
-                            if treatment_text.startswith("Treatment"):
-                                try:
-                                    # Strip any non-numeric characters before converting to int
-                                    treatment_num = int(''.join(filter(str.isdigit, treatment_text)))
-                                    if date_text:
-                                        course_data['schedule'][treatment_num] = date_text
-                                except (ValueError, IndexError):
-                                    continue
-            
-            # Process tables for treatment data
-            for table in tables:
-                if table and len(table) > 0:
-                    headers = table[0] if table else []
-                    
-                    # Process main treatment table (with SpO2, PR, etc.)
-                    if "Treatment No." in str(headers) and not any("BP" in str(row[0]) for row in table if row and row[0]):
-                        # Process main treatment measurements table
-                        treatment_nums = []
-                        for cell in headers[1:]:
-                            try:
-                                if cell and cell.strip():
-                                    num = int(cell.strip())
-                                    treatment_nums.append(num)
-                                    if num not in course_data['treatments']:
-                                        course_data['treatments'][num] = {}
-                            except ValueError:
-                                continue
-                        
-                        # Process each measurement row
-                        for row in table[1:]:
-                            if not row or not row[0]:
-                                continue
-                            
-                            measure_name = str(row[0]).strip()
-                            
-                            # Special handling for Hypoxic O2 conc.
-                            if "Hypoxic O" in measure_name:
-                                for i, value in enumerate(row[1:]):
-                                    if i < len(treatment_nums) and value and value.strip():
-                                        treatment_num = treatment_nums[i]
-                                        course_data['treatments'][treatment_num]["Hypoxic O2 conc. (%)"] = value.strip()
-                                continue
-                            
-                            # Regular measurement mappings for other values
-                            measure_mappings = {
-                                "Min SpO": "Min SpO2 Av. (%)",
-                                "Max SpO": "Max SpO2 Av. (%)",
-                                "Therapeutic SpO": "Therapeutic SpO2 (%)",
-                                "Procedure duration": "Procedure duration (min:sec)",
-                                "Hypox. Phase dur": "Hypox. Phase dur. Av. (min:sec)",
-                                "Hyperox. Phase dur": "Hyperox. Phase dur. Av. (min:sec)",
-                                "Number of cycles": "Number of cycles",
-                                "Min PR": "Min PR Av. (bpm)",
-                                "Max PR": "Max PR Av. (bpm)"
-                            }
-                            
-                            # Process measurements
-                            matched_measure = None
-                            for pattern, full_name in measure_mappings.items():
-                                if pattern in measure_name:
-                                    matched_measure = full_name
-                                    break
-                            
-                            if matched_measure:
-                                for i, value in enumerate(row[1:]):
-                                    if i < len(treatment_nums) and value and value.strip():
-                                        treatment_num = treatment_nums[i]
-                                        course_data['treatments'][treatment_num][matched_measure] = value.strip()
-                    
-                    # Process BP table separately
-                    elif any("BP" in str(row[0]) for row in table if row and row[0]):
-                        # Get treatment numbers from first row
-                        treatment_nums = []
-                        for cell in headers[1:]:
-                            try:
-                                if cell and cell.strip():
-                                    num = int(cell.strip())
-                                    treatment_nums.append(num)
-                                    if num not in course_data['treatments']:
-                                        course_data['treatments'][num] = {}
-                            except ValueError:
-                                continue
-                        
-                        # Process each BP measurement row
-                        for row in table[1:]:
-                            if not row or not row[0]:
-                                continue
-                            
-                            measure_name = str(row[0]).strip()
-                            # Process each value in the row
-                            for i, value in enumerate(row[1:]):
-                                if i < len(treatment_nums) and value and value.strip():
-                                    treatment_num = treatment_nums[i]
-                                    course_data['treatments'][treatment_num][measure_name] = value.strip()
+    sex_match = re.search(r'(?:Female|Male)', text)
+    if sex_match:
+        course_data['sex'] = sex_match.group(0).strip()
         
-        # Add pattern matching for patient info near the start
-        for word_idx, word in enumerate(word_list):
-            # Look for patient name pattern
-            if word.lower() == "name:":
-                try:
-                    course_data['patient_name'] = word_list[word_idx + 1]
-                except IndexError:
-                    pass
+    birth_match = re.search(r'(?:Female|Male)\s+(\d{2}\.\d{2}\.\d{4})', text)
+    if birth_match:
+        course_data['dob'] = birth_match.group(1).strip()
+    
+    # Reference number follows the date of birth; "---" when the clinic left it empty
+    ref_match = re.search(r'(?:Female|Male)\s+\d{2}\.\d{2}\.\d{4}\s+(\S+)', text)
+    if ref_match and ref_match.group(1) != '---':
+        course_data['ref_no'] = ref_match.group(1).strip()
+    return course_data
+
+def _apply_labelled_patient_info(course_data, word_list):
+    """Override patient details from "name:" / "sex:" / "birth:" labels on the last page"""
+    for word_idx, word in enumerate(word_list):
+        # Look for patient name pattern
+        if word.lower() == "name:":
+            try:
+                course_data['patient_name'] = word_list[word_idx + 1]
+            except IndexError:
+                pass
+        
+        # Look for sex
+        if word.lower() == "sex:":
+            try:
+                course_data['sex'] = word_list[word_idx + 1]
+            except IndexError:
+                pass
             
-            # Look for sex
-            if word.lower() == "sex:":
-                try:
-                    course_data['sex'] = word_list[word_idx + 1]
-                except IndexError:
-                    pass
-                
-            # Look for date of birth
-            if word.lower() == "birth:":
-                try:
-                    course_data['dob'] = word_list[word_idx + 1]
-                except IndexError:
-                    pass
+        # Look for date of birth
+        if word.lower() == "birth:":
+            try:
+                course_data['dob'] = word_list[word_idx + 1]
+            except IndexError:
+                pass
+
+def iter_course_report(source, resident_bytes=0, use_cache=True):
+    """
+    Parse a course report page by page, keeping at most one page's objects in memory
+    
+    Args:
+        source: PDF bytes, path or open stream
+        resident_bytes: Bytes this session already holds for the report (e.g. the in-memory
+            upload or what the session caches), counted against COURSE_MEMORY_BUDGET_BYTES
+        use_cache: Reuse and store page fragments in the extraction cache
+        
+    Yields:
+        tuple: (course_data, treatment numbers found on that page). course_data is
+        the same dict every time, filled in as pages are parsed; it is complete once
+        the generator is exhausted
+    """
+    with pdfplumber.open(as_pdf_stream(source)) as pdf:
+        course_data = _new_course_data(pdf)
+        word_list = []
+        # Each page adds its own fragment, so the result is sized page by page instead of re-measured
+        used = resident_bytes
+        for page in pdf.pages:
+            fragment = _parse_course_page_cached(page) if use_cache else _parse_course_page(page)
+            used += _pickled_size(fragment)
+            _check_memory_budget(used)
+            word_list = _merge_course_fragments(course_data, [fragment])
+            yield course_data, sorted(fragment['treatments'])
+    _apply_labelled_patient_info(course_data, word_list)
+
+def parse_course_report(source, parallel=False, use_cache=True, progress_callback=None):
+    """
+    Parse a course report PDF with pdfplumber
+    
+    Args:
+        source: PDF bytes, path or open stream
+        parallel: Split pages across worker processes; the merged result matches the serial one
+        use_cache: Reuse and store page fragments in the extraction cache; off when timing the parser
+        progress_callback: Optional callable(course_data, treatment_nums) called on the parallel
+            path with the cached pages first, then as each worker's page range finishes
+        
+    Returns:
+        dict: Extracted course report data; parsing errors are raised
+    """
+    if not parallel:
+        course_data = None
+        for course_data, _ in iter_course_report(source, use_cache=use_cache):
+            pass
+        return course_data
+    
+    with pdfplumber.open(as_pdf_stream(source)) as pdf:
+        course_data = _new_course_data(pdf)
+        # Ranges finish in any order, so progress goes to a separate copy and course_data is
+        # merged in page order once every page is in
+        preview = dict(course_data, schedule={}, treatments={})
+        
+        def report(page_fragments):
+            if progress_callback is not None and page_fragments:
+                _merge_course_fragments(preview, page_fragments)
+                progress_callback(preview, sorted({num for fragment in page_fragments for num in fragment['treatments']}))
+        
+        if use_cache:
+            fingerprints = [_page_fingerprint(page) for page in pdf.pages]
+            fragments = [get_cached_extraction('course_page', fingerprint, COURSE_EXTRACTOR_VERSION)
+                         for fingerprint in fingerprints]
+        else:
+            fragments = [None] * len(pdf.pages)
+        missing = [page_index for page_index, fragment in enumerate(fragments) if fragment is None]
+        report([fragment for fragment in fragments if fragment is not None])
+        if len(missing) >= PARALLEL_MIN_PAGES:
+            # Workers lay out their own pages, so drop the first page's objects kept for the parse
+            pdf.pages[0].close()
+            # Contiguous ranges of the pages still to parse keep the merge in page order
+            workers = min(len(missing), PARSE_WORKERS)
+            chunk_size = -(-len(missing) // workers)
+            page_ranges = [missing[first:first + chunk_size] for first in range(0, len(missing), chunk_size)]
+            worker_source = source if isinstance(source, (bytes, str)) else _read_source(source)
+            futures = {submit_parse(_parse_course_pages, worker_source, page_range): page_range
+                       for page_range in page_ranges}
+            for future in as_completed(futures):
+                chunk = future.result()
+                for page_index, fragment in zip(futures[future], chunk):
+                    fragments[page_index] = fragment
+                report(chunk)
+        else:
+            for page_index in missing:
+                fragments[page_index] = _parse_course_page(pdf.pages[page_index])
+                report([fragments[page_index]])
+        if use_cache:
+            for page_index in missing:
+                set_cached_extraction('course_page', fingerprints[page_index], COURSE_EXTRACTOR_VERSION, fragments[page_index])
+        _check_memory_budget(sum(_pickled_size(fragment) for fragment in fragments))
+        word_list = _merge_course_fragments(course_data, fragments)
+    
+    _apply_labelled_patient_info(course_data, word_list)
+    return course_data
+
+def _page_count(source):
+    """Number of pages, read from the page tree without parsing any page content"""
+    with pdfplumber.open(as_pdf_stream(source)) as pdf:
+        return len(pdf.pages)
+
+def _parallel_fits_budget(upload):
+    """Whether every worker opening its own copy of the PDF stays inside the memory budget"""
+    workers = PARSE_WORKERS
+    resident_bytes = 0 if upload.path else upload.size
+    return resident_bytes + upload.size * PARSE_MEMORY_FACTOR * workers <= COURSE_MEMORY_BUDGET_BYTES
+
+def extract_course_report(pdf_file, progress_callback=None):
+    """
+    Extract text from course report PDF
+    
+    Args:
+        pdf_file: File object containing the PDF
+        progress_callback: Optional callable(course_data, page_treatment_nums) called as pages
+            (or, for long reports, each worker's page range) are parsed, so sessions can be
+            shown before parsing ends
         
+    Returns:
+        dict: Extracted course report data (patient details, schedule and treatments only)
+    """
+    try:
+        # Hash in one streaming pass and parse from the upload's own buffer or its spool file
+        upload = spool_upload(pdf_file)
+        cached = get_cached_extraction('course_report', upload.file_hash, COURSE_EXTRACTOR_VERSION)
+        if cached is not None:
+            return cached
+        
+        with upload.open() as stream:
+            page_count = _page_count(stream)
+        if page_count >= PARALLEL_MIN_PAGES and _parallel_fits_budget(upload):
+            # Long reports are worth splitting across processes; short ones stream page by page
+            course_data = parse_course_report(upload.worker_source(), parallel=True,
+                                              progress_callback=progress_callback)
+        else:
+            # Spooled files are mapped from disk, so only in-memory uploads count as resident
+            resident_bytes = 0 if upload.path else upload.size
+            with upload.open() as stream:
+                for course_data, page_treatment_nums in iter_course_report(stream, resident_bytes):
+                    if progress_callback is not None:
+                        progress_callback(course_data, page_treatment_nums)
+        set_cached_extraction('course_report', upload.file_hash, COURSE_EXTRACTOR_VERSION, course_data)
         return course_data
         
     except Exception as e:
         raise Exception(f"Error extracting course report: {str(e)}")
 
+def course_metrics(course_match, analysis_data):
+    """Typed and derived metrics for the analysed treatments, built once per set of treatment contents"""
+    hashes = course_match['hashes']
+    key = tuple((num, hashes.get(num)) for num in sorted(analysis_data['treatments']))
+    memo = st.session_state.setdefault('course_metrics', {})
+    if key not in memo:
+        # Only the current selection is worth keeping
+        memo.clear()
+        memo[key] = build_course_frame(analysis_data['treatments'], analysis_data['schedule'])
+        st.session_state.course_metrics_bytes = int(memo[key].memory_usage(deep=True).sum())
+    return memo[key]
+
+def create_course_charts(metrics):
+    """
+    Build the course progress charts from the metrics frame
+    
+    Returns:
+        tuple: (phase durations, pulse rate, total hypoxic time, blood pressure) figures
+    """
+    # Create data for the phase duration chart
+    treatment_nums = list(metrics.index)
+    hypoxic_durations = minutes(metrics['hypoxic_phase_duration_avg']).fillna(0)
+    hyperoxic_durations = minutes(metrics['hyperoxic_phase_duration_avg']).fillna(0)
+    
+    # Create phase duration chart
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=hyperoxic_durations,
+        name='Hyperoxic Phase',
+        mode='lines+markers',
+        # line=dict(color='rgb(0, 122, 204)', width=2),  # Blue color
+        # marker=dict(color='rgb(0, 122, 204)', size=8)
+
+    ))
+    
+    fig.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=hypoxic_durations,
+        name='Hypoxic Phase',
+        mode='lines+markers',
+        # line=dict(color='rgb(255, 127, 14)', width=2),  # Orange color
+        # marker=dict(color='rgb(255, 127, 14)', size=8)
+
+    ))
+    
+    fig.update_layout(
+        title='Hyperoxic/Hypoxic Phase Durations Across Sessions',
+        xaxis_title='Session Number',
+        yaxis_title='Duration (minutes)',
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=1.02,
+            font=dict(size=12)
+        ),
+        margin=dict(t=50, l=50, r=100, b=50),
+        height=500,
+        template='plotly'
+    )
+    
+    # Create data for the pulse rate chart
+    min_pr_avg = metrics['min_pr_average'].fillna(0)
+    max_pr_avg = metrics['max_pr_average'].fillna(0)
+
+
+    # Create pulse rate chart
+    fig_pr = go.Figure()
+
+    
+    fig_pr.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=max_pr_avg,
+        name='Max PR Average',
+        mode='lines+markers'
+    ))
+    
+    fig_pr.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=min_pr_avg,
+        name='Min PR Average',
+        mode='lines+markers'
+    ))
+    
+    fig_pr.update_layout(
+        title='Pulse Rate Average Across Sessions',
+        xaxis_title='Session Number',
+        yaxis_title='Pulse Rate (bpm)',
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=1.02,
+            font=dict(size=12)
+        ),
+        margin=dict(t=50, l=50, r=100, b=50),
+        height=500,
+        template='plotly'
+
+    )
+    
+    # Create data for total hypoxic time chart
+    total_hypoxic_times = minutes(metrics['total_hypoxic_time']).fillna(0)
+    
+    # Create total hypoxic time chart
+    fig_hypoxic = go.Figure()
+    
+    fig_hypoxic.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=total_hypoxic_times,
+        name='Total Hypoxic Time',
+        mode='lines+markers'
+    ))
+    
+    fig_hypoxic.update_layout(
+        title='Total Hypoxic Time Across Sessions',
+        xaxis_title='Session Number',
+        yaxis_title='Duration (minutes)',
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=1.02,
+            font=dict(size=12)
+        ),
+        margin=dict(t=50, l=50, r=100, b=50),
+        height=500,
+        template='plotly'
+
+    )
+    
+    # Only the systolic value is plotted, and only when both values are present
+    bp_before = metrics['bp_before_sys'].where(metrics['bp_before_valid'])
+    bp_after = metrics['bp_after_sys'].where(metrics['bp_after_valid'])
+    
+    # BP Comparison Chart
+    fig_bp_comparison = go.Figure()
+    
+    fig_bp_comparison.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=bp_before,
+        name='BP Before Procedure',
+        mode='lines+markers',
+        connectgaps=True
+    ))
+    
+    fig_bp_comparison.add_trace(go.Scatter(
+        x=treatment_nums,
+        y=bp_after,
+        name='BP After Procedure',
+        mode='lines+markers',
+        connectgaps=True
+    ))
+    
+    fig_bp_comparison.update_layout(
+        title='Blood Pressure Trends Across Sessions',
+        xaxis_title='Session Number',
+        yaxis_title='Blood Pressure (mmHg)',
+        legend=dict(
+            orientation="v",
+            yanchor="middle",
+            y=0.5,
+            xanchor="left",
+            x=1.02,
+            font=dict(size=12)
+        ),
+        margin=dict(t=50, l=50, r=100, b=50),
+        height=500,
+        template='plotly'
+
+    )
+    
+    return fig, fig_pr, fig_hypoxic, fig_bp_comparison
+
+def course_session_bytes():
+    """Memory this session holds for the course: its data, metrics and cached selections"""
+    subsets = st.session_state.get('course_subset_results', {})
+    return (st.session_state.get('course_data_bytes', 0)
+            + st.session_state.get('course_metrics_bytes', 0)
+            + sum(subset_results.get('_bytes', 0) for subset_results in subsets.values()))
+
+def _trim_subset_cache(cache):
+    """Drop the oldest selections while over the entry limit or the memory budget; the newest always stays"""
+    while len(cache) > 1 and (len(cache) > COURSE_SUBSET_CACHE_SIZE
+                              or course_session_bytes() > COURSE_MEMORY_BUDGET_BYTES):
+        cache.popitem(last=False)
+
+def course_subset_results(treatment_nums, case_history):
+    """
+    Per-course LRU of processed selections, bounded by COURSE_SUBSET_CACHE_SIZE and the memory budget
+    
+    Returns:
+        dict: Figures, analysis texts and PDF bytes of this selection and case history,
+        filled in by cached_for_subset; '_bytes' holds their approximate size
+    """
+    cache = st.session_state.setdefault('course_subset_results', OrderedDict())
+    key = (frozenset(treatment_nums), hashlib.sha256(case_history.encode('utf-8')).hexdigest())
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = {}
+        _trim_subset_cache(cache)
+    return cache[key]
+
+def cached_for_subset(subset_results, name, compute):
+    """Return subset_results[name], computing it on first use; failed analyses are retried next time"""
+    if name not in subset_results:
+        value = compute()
+        if isinstance(value, str) and value.startswith("Error"):
+            return value
+        subset_results[name] = value
+        subset_results['_bytes'] = subset_results.get('_bytes', 0) + _pickled_size(value)
+        _trim_subset_cache(st.session_state.course_subset_results)
+    return subset_results[name]
+
+def start_course_analysis(fan_out, subset_results, course_match, name, treatment_nums, compute, extra=None):
+    """Start an analysis on the fan-out unless this selection or the course store already has it"""
+    fan_out.start(
+        name,
+        lambda: course_result(course_match, name, treatment_nums, compute, extra=extra, refresh=regenerate_requested()),
+        cached=subset_results.get(name),
+        store=lambda value: cached_for_subset(subset_results, name, lambda: value)
+    )
+
 def load_default_pdf():
     """Load the default Course Report.pdf file"""
     return None
 
+def course_blood_pressure(when):
+    """Prompt table column value giving the "SYS/DIA" blood pressure measured before or after a treatment"""
+    return lambda treatment_num, data: (
+        f"{data.get(f'BP SYS {when} (mmHg)', 'N/A')}/{data.get(f'BP DIA {when} (mmHg)', 'N/A')}"
+    )
+
 def analyze_case_history(case_history, analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
         # Get treatment metrics for analysis
-        treatment_data = []
-        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-            treatment_data.append(f"""
-            Session {treatment_num}:
-            - SpO2 Range: {data.get('Min SpO2 Av. (%)', 'N/A')} - {data.get('Max SpO2 Av. (%)', 'N/A')}
-            - PR Range: {data.get('Min PR Av. (bpm)', 'N/A')} - {data.get('Max PR Av. (bpm)', 'N/A')}
-            - Hypoxic Phase Duration: {data.get('Hypox. Phase dur. Av. (min:sec)', 'N/A')}
-            - Number of Cycles: {data.get('Number of cycles', 'N/A')}
-            - BP Before: {data.get('BP SYS before (mmHg)', 'N/A')}/{data.get('BP DIA before (mmHg)', 'N/A')}
-            - BP After: {data.get('BP SYS after (mmHg)', 'N/A')}/{data.get('BP DIA after (mmHg)', 'N/A')}
-            """)
+        treatment_data = sessions_block(sorted(analysis_data['treatments'].items()), [
+            ('Min SpO2', 'Min SpO2 Av. (%)'),
+            ('Max SpO2', 'Max SpO2 Av. (%)'),
+            ('Min PR', 'Min PR Av. (bpm)'),
+            ('Max PR', 'Max PR Av. (bpm)'),
+            ('Hypoxic Phase Duration', 'Hypox. Phase dur. Av. (min:sec)'),
+            ('Number of Cycles', 'Number of cycles'),
+            ('BP Before', course_blood_pressure('before')),
+            ('BP After', course_blood_pressure('after')),
+        ])
         
         prompt = f"""Based on the patient's case history and ReOxy treatment results, identify key correlations and relevant clinical insights in 2-3 sentences. 
        .
@@ -246,7 +716,7 @@ def analyze_case_history(case_history, analysis_data):
         - Date of Birth: {analysis_data.get('dob', 'N/A')}
 
         Detailed Treatment Results:
-        {''.join(treatment_data)}
+        {treatment_data}
 
         Please analyze:
         1. How the patient's medical history relates to their treatment responses
@@ -254,137 +724,121 @@ def analyze_case_history(case_history, analysis_data):
         3. Potential implications for future treatment based on history and responses
         """
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing case history: {str(e)}"
 
 def analyze_phase_durations(analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - Hyperoxic Phase Duration: {data.get('Hyperox. Phase dur. Av. (min:sec)', 'N/A')}
-            - Hypoxic Phase Duration: {data.get('Hypox. Phase dur. Av. (min:sec)', 'N/A')}
-            """)
+        sessions_data = sessions_block(sorted(analysis_data['treatments'].items()), [
+            ('Hyperoxic Phase Duration', 'Hyperox. Phase dur. Av. (min:sec)'),
+            ('Hypoxic Phase Duration', 'Hypox. Phase dur. Av. (min:sec)'),
+        ])
         
         prompt = f"""Analyze the hyperoxic and hypoxic phase duration trends across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The relationship between hyperoxic and hypoxic durations
         2. What these trends indicate about the patient's adaptive response to treatment
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing phase durations: {str(e)}"
 
 def analyze_pr_trends(analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - Min PR Average: {data.get('Min PR Av. (bpm)', 'N/A')}
-            - Max PR Average: {data.get('Max PR Av. (bpm)', 'N/A')}
-            """)
+        sessions_data = sessions_block(sorted(analysis_data['treatments'].items()), [
+            ('Min PR Average', 'Min PR Av. (bpm)'),
+            ('Max PR Average', 'Max PR Av. (bpm)'),
+        ])
         
         prompt = f"""Analyze the Pulse Rate averages trends across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The relationship between Min and Max Pulse Rate averages
         2. What these trends indicate about the patient's adaptive response to treatment
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing pulse rate trends: {str(e)}"
 
 def analyze_hypoxic_time(analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - Total Hypoxic Time: {data.get('total_hypoxic_calc', 'N/A')}
-            - Number of cycles: {data.get('Number of cycles', 'N/A')}
-            - Min SpO2: {data.get('Min SpO2 Av. (%)', 'N/A')}
-            """)
+        metrics = analysis_data.get('metrics')
+        if metrics is None:
+            metrics = build_course_frame(analysis_data['treatments'], analysis_data.get('schedule'))
+        total_hypoxic = format_min_sec(metrics['total_hypoxic_time'])
+        
+        sessions_data = sessions_block(sorted(analysis_data['treatments'].items()), [
+            ('Total Hypoxic Time', lambda treatment_num, data: total_hypoxic[treatment_num]),
+            ('Number of cycles', 'Number of cycles'),
+            ('Min SpO2', 'Min SpO2 Av. (%)'),
+        ])
         
         prompt = f"""Analyze the total hypoxic time trends across these ReOxy sessions in 2-3 sentences. Focus on:
         1. Changes in hypoxic exposure duration
         2. What this suggests about the patient's adaptation to hypoxic stress
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing hypoxic time: {str(e)}"
 
 def analyze_bp_trends(analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
-        sessions_data = []
-        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            - BP Before: {data.get('BP SYS before (mmHg)', 'N/A')}/{data.get('BP DIA before (mmHg)', 'N/A')}
-            - BP After: {data.get('BP SYS after (mmHg)', 'N/A')}/{data.get('BP DIA after (mmHg)', 'N/A')}
-            """)
+        sessions_data = sessions_block(sorted(analysis_data['treatments'].items()), [
+            ('BP Before', course_blood_pressure('before')),
+            ('BP After', course_blood_pressure('after')),
+        ])
         
         prompt = f"""Analyze the blood pressure response across these ReOxy sessions in 2-3 sentences. Focus on:
         1. The acute BP response to each session (before vs after)
         2. The overall trend across sessions and what this suggests about cardiovascular adaptation
 
-        Sessions data:{''.join(sessions_data)}"""
+        Sessions data:
+        {sessions_data}"""
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing BP trends: {str(e)}"
 
 def compare_sessions_openai(analysis_data):
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        sessions_data = []
-        
-        for treatment_num, data in analysis_data['treatments'].items():
-            sessions_data.append(f"""
-            Session {treatment_num}:
-            Treatment Metrics:
-            - Min SpO2 Av. (%): {data.get('Min SpO2 Av. (%)', 'N/A')}
-            - Max SpO2 Av. (%): {data.get('Max SpO2 Av. (%)', 'N/A')}
-            - Therapeutic SpO2 (%): {data.get('Therapeutic SpO2 (%)', 'N/A')}
-            - Min PR Av. (bpm): {data.get('Min PR Av. (bpm)', 'N/A')}
-            - Max PR Av. (bpm): {data.get('Max PR Av. (bpm)', 'N/A')}
-            - Procedure duration (min:sec): {data.get('Procedure duration (min:sec)', 'N/A')}
-            - Number of cycles: {data.get('Number of cycles', 'N/A')}
-            - Hypoxic O2 conc. (%): {data.get('Hypoxic O2 conc. (%)', 'N/A')}
-            """)
+        sessions_data = sessions_block(analysis_data['treatments'].items(), [
+            (field, field) for field in (
+                'Min SpO2 Av. (%)',
+                'Max SpO2 Av. (%)',
+                'Therapeutic SpO2 (%)',
+                'Min PR Av. (bpm)',
+                'Max PR Av. (bpm)',
+                'Procedure duration (min:sec)',
+                'Number of cycles',
+                'Hypoxic O2 conc. (%)',
+            )
+        ])
 
         prompt = f"""Analyze the following ReOxy treatment sessions and provide insights on:
         1. Changes in SpO2 tolerance and adaptation between sessions
@@ -392,19 +846,224 @@ def compare_sessions_openai(analysis_data):
         3. Changes in treatment duration and number of cycles
         4. Overall progression in hypoxic tolerance
         
-        Treatment Data:{''.join(sessions_data)}
+        Treatment Data:
+        {sessions_data}
         
         Provide a concise analysis highlighting key trends, improvements, or areas of note between sessions. 
        """
         
-        response = client.chat.completions.create(
+        return chat_completion(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}]
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error comparing sessions: {str(e)}"
 
+def set_selection_bits(bits):
+    """Replace the treatment selection; a new editor key drops the table's pending edits"""
+    st.session_state.selection_bits = bits
+    st.session_state.selection_base_bits = bits
+    st.session_state.selection_version = st.session_state.get('selection_version', 0) + 1
+    st.session_state.show_analysis = False  # Prevent auto-processing
+
+def treatment_selector(treatment_numbers, schedule, course_diff=None):
+    """
+    Treatment picker backed by one data_editor checkbox column and a bitset in session state
+    
+    Returns:
+        list: Selected treatment numbers in ascending order
+    """
+    count = len(treatment_numbers)
+    updated = set(course_diff['new'] + course_diff['changed']) if course_diff else set()
+    
+    col1, col2, col3, col4, col5 = st.columns([2, 1, 1, 1, 1])
+    with col1:
+        st.subheader("Select Treatments")
+    with col2:
+        st.markdown(f'<div class="treatment-count">Found: {count} Treatments</div>', unsafe_allow_html=True)
+    with col3:
+        st.button("Select All", on_click=set_selection_bits, args=(last_n_bits(count, count),))
+    with col4:
+        st.button("Deselect All", on_click=set_selection_bits, args=(0,))
+    with col5:
+        st.button("Select New", disabled=not updated,
+                  on_click=set_selection_bits, args=(bits_from_treatments(updated, treatment_numbers),))
+    
+    # Range and "last N" selectors
+    col1, col2, col3, col4, col5 = st.columns([1, 1, 1, 1, 1])
+    first = col1.number_input("From", min_value=treatment_numbers[0], max_value=treatment_numbers[-1],
+                              value=treatment_numbers[0], key="selection_range_first")
+    last = col2.number_input("To", min_value=treatment_numbers[0], max_value=treatment_numbers[-1],
+                             value=treatment_numbers[-1], key="selection_range_last")
+    col3.button("Select Range", on_click=lambda: set_selection_bits(range_bits(
+        treatment_numbers, st.session_state.selection_range_first, st.session_state.selection_range_last)))
+    last_n = col4.number_input("Last N", min_value=1, max_value=count, value=min(5, count), key="selection_last_n")
+    col5.button("Select Last N", on_click=lambda: set_selection_bits(last_n_bits(count, st.session_state.selection_last_n)))
+    
+    # The table is built from the base selection; its edits are read back, never written into it
+    base_flags = flags_from_bits(st.session_state.selection_base_bits, count)
+    table = pd.DataFrame({
+        'Select': base_flags,
+        'Treatment': treatment_numbers,
+        'Date': [schedule.get(num, '') for num in treatment_numbers],
+        'Status': ['updated' if num in updated else '' for num in treatment_numbers],
+    })
+    edited = st.data_editor(
+        table,
+        key=f"treatment_selection_{st.session_state.selection_version}",
+        hide_index=True,
+        use_container_width=True,
+        height=min(35 * (count + 1) + 3, 400),
+        disabled=['Treatment', 'Date', 'Status'],
+        column_config={
+            'Select': st.column_config.CheckboxColumn("Select", width="small"),
+            'Treatment': st.column_config.NumberColumn("Treatment", format="%d"),
+        },
+    )
+    st.session_state.selection_bits = bits_from_flags(edited['Select'])
+    return treatments_from_bits(st.session_state.selection_bits, treatment_numbers)
+
+def analysis_requested():
+    return bool(st.session_state.show_analysis and st.session_state.analyzed_treatments)
+
+@st.fragment
+def treatment_selection_section(treatment_numbers, schedule, course_diff):
+    # Runs as a fragment: ticking treatments only redraws the selection, not the report
+    selected_treatments = treatment_selector(treatment_numbers, schedule, course_diff)
+    
+    # Update selections in session state without triggering analysis
+    if st.session_state.selected_treatments != selected_treatments:
+        st.session_state.selected_treatments = selected_treatments
+        st.session_state.show_analysis = False  # Reset analysis state when selection changes
+    
+    # Add analyze button
+    st.button("Process Selected Treatments", 
+             disabled=len(st.session_state.selected_treatments) == 0,
+             key="analyze_button",
+             on_click=lambda: setattr(st.session_state, 'show_analysis', True) or 
+                            setattr(st.session_state, 'analyzed_treatments', 
+                            st.session_state.selected_treatments.copy()))
+    
+    # The report below is outside the fragment; redraw the page when it has to appear or go
+    if analysis_requested() != st.session_state.analysis_rendered:
+        st.rerun()
+
+@st.fragment
+def show_detailed_overview(analysis_data, df, metrics):
+    # Runs as a fragment so interacting with the overview only redraws the overview
+    # Add custom CSS for styling
+    st.markdown("""
+        <style>
+            /* Style for the section header */
+            .detailed-overview-header {
+                font-size: 24px;
+                color: #1E88E5;
+                padding: 10px 0;
+                border-bottom: 2px solid #1E88E5;
+                margin-bottom: 20px;
+            }
+            
+            /* Style for tab labels */
+            .stTabs [data-baseweb="tab-list"] {
+                gap: 8px;
+            }
+            
+            .stTabs [data-baseweb="tab"] {
+                background-color: #f0f2f6;
+                border-radius: 4px;
+                padding: 8px 16px;
+                font-weight: 500;
+            }
+            
+            .stTabs [aria-selected="true"] {
+                background-color: #1E88E5;
+                color: white;
+            }
+            
+            /* Style for table headers and cells */
+            .treatment-header {
+                font-weight: bold;
+                color: #1E88E5;
+                font-size: 16px;
+                padding: 8px 0;
+                border-bottom: 1px solid #e0e0e0;
+            }
+            
+            .field-label {
+                font-weight: 500;
+                color: #424242;
+                background-color: #f5f5f5;
+                padding: 6px;
+                border-radius: 4px;
+                margin: 2px 0;
+            }
+            
+            .field-value {
+                padding: 6px;
+                border-radius: 4px;
+                background-color: white;
+                margin: 2px 0;
+                border: 1px solid #e0e0e0;
+            }
+            
+            /* Keep Case History Analysis heading with content */
+            h2:contains("Case History Analysis") {
+                break-inside: avoid !important;
+                page-break-inside: avoid !important;
+            }
+            
+            /* Keep the analysis text with its heading */
+            h2:contains("Case History Analysis") + p {
+                break-inside: avoid !important;
+                page-break-inside: avoid !important;
+            }
+            
+            /* Create a wrapper for the heading and content */
+            .case-history-section {
+                break-inside: avoid !important;
+                page-break-inside: avoid !important;
+                margin-bottom: 20px !important;
+            }
+        </style>
+    """, unsafe_allow_html=True)
+    
+    # Add paginated detailed view with styled header
+    st.markdown('<h2 class="detailed-overview-header">Detailed Treatment Overview</h2>', unsafe_allow_html=True)
+    if analysis_data['treatments']:
+        # Define fields to display
+        fields = [
+            ('Date', 'Treatment Date'),
+            ('Procedure duration (min:sec)', 'Total Duration'),
+            ('total_hypoxic_calc', 'Total Hypoxic Time (approx)'),
+            ('Number of cycles', 'Number of Cycles'),
+            ('Hypox. Phase dur. Av. (min:sec)', 'Hypoxic Phase Duration Average'),
+            ('Min SpO2 Av. (%)', 'Min SpO2 Average'),
+            ('Hyperox. Phase dur. Av. (min:sec)', 'Hyperoxic Phase Duration Average'),
+            ('Max SpO2 Av. (%)', 'Max SpO2 Average'),
+            ('Min PR Av. (bpm)', 'Min PR Average'),
+            ('Max PR Av. (bpm)', 'Max PR Average'),
+            ('Therapeutic SpO2 (%)', 'Therapeutic SpO2'),
+            ('Hypoxic O2 conc. (%)', 'Hypoxic O2 Concentration'),
+            ('BP_before', 'BP Before Procedure'),
+            ('BP_after', 'BP After Procedure')
+        ]
+        
+        # Derived cells formatted once for all treatments
+        overview_columns = {
+            'total_hypoxic_calc': format_min_sec(metrics['total_hypoxic_time']),
+            'BP_before': format_blood_pressure(metrics['bp_before_sys'], metrics['bp_before_dia']),
+            'BP_after': format_blood_pressure(metrics['bp_after_sys'], metrics['bp_after_dia']),
+        }
+        
+        def cell(field_key, treatment_num):
+            if field_key in overview_columns:
+                return overview_columns[field_key].at[treatment_num]
+            if field_key in df.columns:
+                return df.loc[treatment_num, field_key]
+            return analysis_data['treatments'][treatment_num].get(field_key, 'N/A')
+        
+        render_overview(sorted(analysis_data['treatments']), fields, cell, key="course_overview")
+
 def main():
     # Replace the AI model selectbox with a hidden default
     ai_model = "OpenAI GPT-3.5"  # Set default model
@@ -547,6 +1206,8 @@ def main():
         st.session_state.course_data = None
     if 'selected_treatments' not in st.session_state:
         st.session_state.selected_treatments = []
+    if 'selection_bits' not in st.session_state:
+        set_selection_bits(0)
     if 'show_analysis' not in st.session_state:
         st.session_state.show_analysis = False
     if 'analyzed_treatments' not in st.session_state:
@@ -574,66 +1235,57 @@ def main():
     )
     
     if uploaded_file:
+        # A different file replaces the course; it is diffed against the stored copy below
+        if st.session_state.get('course_file_id') != uploaded_file.file_id:
+            st.session_state.course_file_id = uploaded_file.file_id
+            st.session_state.course_data = None
+            st.session_state.course_data_bytes = 0
+            st.session_state.show_analysis = False
+            st.session_state.course_subset_results = OrderedDict()
+            set_selection_bits(0)
+        
         # Only extract data if it hasn't been extracted yet
         if st.session_state.course_data is None:
+            progress_placeholder = st.empty()
+            
+            def show_found_treatments(partial_data, page_treatment_nums):
+                # Show sessions as soon as their page is parsed
+                found = sorted(partial_data['treatments'])
+                schedule = partial_data['schedule']
+                progress_placeholder.markdown(
+                    f"Loading report... found {len(found)} treatments: " +
+                    ", ".join(f"{num} ({schedule[num]})" if num in schedule else str(num) for num in found)
+                )
+            
             with st.spinner('Loading report...'):
                 try:
-                    st.session_state.course_data = extract_course_report(uploaded_file)
+                    st.session_state.course_data = extract_course_report(uploaded_file, progress_callback=show_found_treatments)
                 except Exception as e:
+                    progress_placeholder.empty()
                     st.error(f"Error: {str(e)}")
                     return
+            progress_placeholder.empty()
+            st.session_state.course_data_bytes = _pickled_size(st.session_state.course_data)
+            # Match against the stored course once per upload; later reruns keep this diff
+            st.session_state.course_match = match_course(st.session_state.course_data)
         
         if st.session_state.course_data:
             treatment_numbers = sorted(st.session_state.course_data['treatments'].keys())
-            
-            # Create a container for the selection interface
-            selection_container = st.container()
-            with selection_container:
-                col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
-                with col1:
-                    st.subheader("Select Treatments")
-                with col2:
-                    st.markdown(f'<div class="treatment-count">Found: {len(treatment_numbers)} Treatments</div>', unsafe_allow_html=True)
-                with col3:
-                    if st.button("Select All"):
-                        st.session_state.selected_treatments = treatment_numbers.copy()
-                        st.session_state.show_analysis = False  # Prevent auto-processing
-                        st.rerun()
-                with col4:
-                    if st.button("Deselect All"):
-                        st.session_state.selected_treatments = []
-                        st.session_state.show_analysis = False  # Prevent auto-processing
-                        st.rerun()
-            
-            # Create columns for inline checkboxes
-            num_cols = min(len(treatment_numbers), 8)
-            cols = st.columns(num_cols)
-            
-            # Update selected treatments without triggering analysis
-            current_selections = []
-            for i, treatment_num in enumerate(treatment_numbers):
-                col_idx = i % num_cols
-                if cols[col_idx].checkbox(str(treatment_num), 
-                                        value=treatment_num in st.session_state.selected_treatments, 
-                                        key=f"treatment_{treatment_num}",
-                                        label_visibility="visible"):
-                    current_selections.append(treatment_num)
-            
-            # Update selections in session state without triggering analysis
-            if st.session_state.selected_treatments != current_selections:
-                st.session_state.selected_treatments = current_selections
-                st.session_state.show_analysis = False  # Reset analysis state when selection changes
-            
-            # Add analyze button
-            st.button("Process Selected Treatments", 
-                     disabled=len(st.session_state.selected_treatments) == 0,
-                     key="analyze_button",
-                     on_click=lambda: setattr(st.session_state, 'show_analysis', True) or 
-                                    setattr(st.session_state, 'analyzed_treatments', 
-                                    st.session_state.selected_treatments.copy()))
+            course_match = st.session_state.course_match
+            course_diff = course_match['diff']
+            if course_diff:
+                uploaded_at = datetime.fromtimestamp(course_match['previous_upload']).strftime('%d.%m.%Y %H:%M')
+                st.info(
+                    f"Matched the course uploaded on {uploaded_at}: "
+                    f"{len(course_diff['new'])} new, {len(course_diff['changed'])} changed, "
+                    f"{len(course_diff['unchanged'])} unchanged treatments. "
+                    f"Results for unchanged treatments are reused."
+                )
             
             # Show analysis only if button was clicked and using the analyzed treatments
-            if st.session_state.show_analysis and st.session_state.analyzed_treatments:
+            st.session_state.analysis_rendered = analysis_requested()
+            treatment_selection_section(treatment_numbers, st.session_state.course_data['schedule'], course_diff)
+            if st.session_state.analysis_rendered:
                 st.markdown("---")
                 # Variable to save plotly figures
                 all_figures = []
@@ -644,6 +1296,34 @@ def main():
                                         if k in st.session_state.analyzed_treatments}
                     analysis_data = st.session_state.course_data.copy()
                     analysis_data['treatments'] = filtered_treatments
+                    metrics = course_metrics(course_match, analysis_data)
+                    analysis_data['metrics'] = metrics
+                    # Figures, analyses and the PDF of a selection processed before are reused as is
+                    subset_results = course_subset_results(st.session_state.analyzed_treatments, case_history)
+                    
+                    # Regenerate asks the models again instead of reusing stored answers
+                    regenerate = st.button("Regenerate analyses")
+                    if regenerate:
+                        subset_results.clear()
+                    
+                    # All analyses of the selection run concurrently while the page is laid out
+                    fan_out = AnalysisFanOut()
+                    with regenerating(regenerate):
+                        if case_history.strip():
+                            start_course_analysis(fan_out, subset_results, course_match, 'case_history', filtered_treatments,
+                                                  lambda: analyze_case_history(case_history, analysis_data), extra=case_history)
+                        if len(filtered_treatments) > 1:
+                            start_course_analysis(fan_out, subset_results, course_match, 'session_comparison', filtered_treatments,
+                                                  lambda: compare_sessions_openai(analysis_data))
+                        if len(analysis_data['treatments']) > 1:
+                            start_course_analysis(fan_out, subset_results, course_match, 'phase_durations', filtered_treatments,
+                                                  lambda: analyze_phase_durations(analysis_data))
+                            start_course_analysis(fan_out, subset_results, course_match, 'pr_trends', filtered_treatments,
+                                                  lambda: analyze_pr_trends(analysis_data))
+                            start_course_analysis(fan_out, subset_results, course_match, 'hypoxic_time', filtered_treatments,
+                                                  lambda: analyze_hypoxic_time(analysis_data))
+                            start_course_analysis(fan_out, subset_results, course_match, 'bp_trends', filtered_treatments,
+                                                  lambda: analyze_bp_trends(analysis_data))
                     
                     # Display patient information first
                     st.markdown("<div class='myUniqueId'><h2>Patient Information</h2></div>", unsafe_allow_html=True)
@@ -656,14 +1336,10 @@ def main():
                     # Add case history analysis if text was entered
                     if case_history.strip():
                         st.markdown('<div class="case-history-section">', unsafe_allow_html=True)
-                        st.subheader("Case History Analysis")
-                        with st.spinner('Analyzing case history...'):
-                            history_analysis = analyze_case_history(case_history, analysis_data)
-                            st.write(history_analysis)
+                        text_analysis_section("Case History Analysis", fan_out, 'case_history', 'Analyzing case history...')
                         st.markdown('</div>', unsafe_allow_html=True)
                         case_history_analysis = AnalysisContent()
                         case_history_analysis.heading = "Case History Analysis"
-                        case_history_analysis.paragraph = history_analysis
                         content_to_write.append(case_history_analysis)
                     # else:
                     #     content_to_write.append(None)
@@ -673,15 +1349,9 @@ def main():
                     
                     # Session comparison
                     if len(filtered_treatments) > 1:
-                        st.subheader("Session Comparison")
-                        with st.spinner('Analyzing treatment sessions...'):
-                            comparison = compare_sessions_openai(analysis_data)
-                            st.write(comparison)
-                            comparison = comparison
-
-                            session_analysis_content = AnalysisContent()
-                            session_analysis_content.sub_heading = "Session Comparison"
-                            session_analysis_content.paragraph = comparison
+                        text_analysis_section("Session Comparison", fan_out, 'session_comparison', 'Analyzing treatment sessions...')
+                        session_analysis_content = AnalysisContent()
+                        session_analysis_content.sub_heading = "Session Comparison"
 
                     else:
                         st.write("Upload multiple sessions to see comparison")
@@ -705,479 +1375,85 @@ def main():
 
                     st.subheader("Treatment Progress Charts")
                     if len(analysis_data['treatments']) > 1:  # Only show charts for multiple sessions
-                        # Create data for the phase duration chart
-                        treatment_nums = []
-                        hypoxic_durations = []
-                        hyperoxic_durations = []
-                        
-                        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-                            treatment_nums.append(treatment_num)
-                            
-                            # Process hypoxic duration
-                            hypo_str = data.get('Hypox. Phase dur. Av. (min:sec)', '0:00')
-                            hypo_min, hypo_sec = map(int, hypo_str.split(':'))
-                            hypoxic_durations.append(hypo_min + hypo_sec/60)
-                            
-                            # Process hyperoxic duration
-                            hyper_str = data.get('Hyperox. Phase dur. Av. (min:sec)', '0:00')
-                            hyper_min, hyper_sec = map(int, hyper_str.split(':'))
-                            hyperoxic_durations.append(hyper_min + hyper_sec/60)
-                        
-                        # Create phase duration chart
-                        st.write("**Phase Duration Analysis:**")
-                        with st.spinner('Analyzing phase durations...'):
-                            phase_analysis = analyze_phase_durations(analysis_data)
+                        fig, fig_pr, fig_hypoxic, fig_bp_comparison = cached_for_subset(
+                            subset_results, 'charts', lambda: create_course_charts(metrics)
+                        )
                         
-                        # Create phase duration chart
-                        fig = go.Figure()
+                        all_figures.append(fig)
+                        chart_analysis_section("Phase Duration Analysis", fig, fan_out, 'phase_durations', 'Analyzing phase durations...')
                         analysis_content = AnalysisContent()
                         analysis_content.heading = "Treatment Progress Charts"
                         analysis_content.sub_heading = "Phase Duration Analysis"
-                        fig.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=hyperoxic_durations,
-                            name='Hyperoxic Phase',
-                            mode='lines+markers',
-                            # line=dict(color='rgb(0, 122, 204)', width=2),  # Blue color
-                            # marker=dict(color='rgb(0, 122, 204)', size=8)
-
-                        ))
-                        
-                        fig.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=hypoxic_durations,
-                            name='Hypoxic Phase',
-                            mode='lines+markers',
-                            # line=dict(color='rgb(255, 127, 14)', width=2),  # Orange color
-                            # marker=dict(color='rgb(255, 127, 14)', size=8)
-
-                        ))
-                        
-                        fig.update_layout(
-                            title='Hyperoxic/Hypoxic Phase Durations Across Sessions',
-                            xaxis_title='Session Number',
-                            yaxis_title='Duration (minutes)',
-                            legend=dict(
-                                orientation="v",
-                                yanchor="middle",
-                                y=0.5,
-                                xanchor="left",
-                                x=1.02,
-                                font=dict(size=12)
-                            ),
-                            margin=dict(t=50, l=50, r=100, b=50),
-                            height=500,
-                            template='plotly'
-                        )
-
-                        all_figures.append(fig)
-                        st.plotly_chart(fig, use_container_width=True)
-                        st.write(phase_analysis)
-                        analysis_content.paragraph = phase_analysis
-                        analysis_content.figure = fig
+                        # PDF export restyles its figures, so it gets copies of the cached ones
+                        analysis_content.figure = go.Figure(fig)
                         content_to_write.append(analysis_content)
                         st.markdown("---")
                         
-                        # Create data for the pulse rate chart
-                        min_pr_avg = []
-                        max_pr_avg = []
-                        
-                        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-                            # Process min PR average
-                            min_pr_str = data.get('Min PR Av. (bpm)', '0')
-                            min_pr_avg.append(float(min_pr_str.split()[0]))
-                            
-                            # Process max PR average
-                            max_pr_str = data.get('Max PR Av. (bpm)', '0')
-                            max_pr_avg.append(float(max_pr_str.split()[0]))
-
-
-                        # Create pulse rate chart
-                        st.write("**Pulse Rate Analysis:**")
-                        with st.spinner('Analyzing pulse rate trends...'):
-                            pr_analysis = analyze_pr_trends(analysis_data)
-                        
-                        # Create pulse rate chart
-                        fig_pr = go.Figure()
-
-                        
-                        fig_pr.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=max_pr_avg,
-                            name='Max PR Average',
-                            mode='lines+markers'
-                        ))
-                        
-                        fig_pr.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=min_pr_avg,
-                            name='Min PR Average',
-                            mode='lines+markers'
-                        ))
-                        
-                        fig_pr.update_layout(
-                            title='Pulse Rate Average Across Sessions',
-                            xaxis_title='Session Number',
-                            yaxis_title='Pulse Rate (bpm)',
-                            legend=dict(
-                                orientation="v",
-                                yanchor="middle",
-                                y=0.5,
-                                xanchor="left",
-                                x=1.02,
-                                font=dict(size=12)
-                            ),
-                            margin=dict(t=50, l=50, r=100, b=50),
-                            height=500,
-                            template='plotly'
-
-                        )
                         all_figures.append(fig_pr)
+                        chart_analysis_section("Pulse Rate Analysis", fig_pr, fan_out, 'pr_trends', 'Analyzing pulse rate trends...')
                         pulserate_analysis_content = AnalysisContent()
                         pulserate_analysis_content.sub_heading = "Pulse Rate Analysis"
-                        pulserate_analysis_content.figure = fig_pr
-                        pulserate_analysis_content.paragraph = pr_analysis
+                        pulserate_analysis_content.figure = go.Figure(fig_pr)
                         content_to_write.append(pulserate_analysis_content)
-                        st.plotly_chart(fig_pr, use_container_width=True)
-                        st.write(pr_analysis)
                         
                         st.markdown("---")
                         
-                        # Create data for total hypoxic time chart
-                        total_hypoxic_times = []
-                        
-                        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-                            try:
-                                # Calculate total hypoxic time
-                                hypoxic_dur = data.get('Hypox. Phase dur. Av. (min:sec)', '0:00')
-                                hypo_min, hypo_sec = map(int, hypoxic_dur.split(':'))
-                                total_seconds = hypo_min * 60 + hypo_sec
-                                
-                                cycles_str = data.get('Number of cycles', '0')
-                                num_cycles = int(cycles_str.split()[0])
-                                
-                                total_minutes = (total_seconds * num_cycles) / 60
-                                total_hypoxic_times.append(total_minutes)
-                            except (ValueError, IndexError):
-                                total_hypoxic_times.append(0)
-                        
-                        # Create total hypoxic time chart
-                        st.write("**Total Hypoxic Time Analysis:**")
-                        with st.spinner('Analyzing hypoxic time trends...'):
-                            hypoxic_time_analysis = analyze_hypoxic_time(analysis_data)
-                        
-                        # Create total hypoxic time chart
-                        fig_hypoxic = go.Figure()
-                        
-                        fig_hypoxic.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=total_hypoxic_times,
-                            name='Total Hypoxic Time',
-                            mode='lines+markers'
-                        ))
-                        
-                        fig_hypoxic.update_layout(
-                            title='Total Hypoxic Time Across Sessions',
-                            xaxis_title='Session Number',
-                            yaxis_title='Duration (minutes)',
-                            legend=dict(
-                                orientation="v",
-                                yanchor="middle",
-                                y=0.5,
-                                xanchor="left",
-                                x=1.02,
-                                font=dict(size=12)
-                            ),
-                            margin=dict(t=50, l=50, r=100, b=50),
-                            height=500,
-                            template='plotly'
-
-                        )
                         all_figures.append(fig_hypoxic)
-
-                        st.plotly_chart(fig_hypoxic, use_container_width=True)
-                        st.write(hypoxic_time_analysis)
+                        chart_analysis_section("Total Hypoxic Time Analysis", fig_hypoxic, fan_out, 'hypoxic_time', 'Analyzing hypoxic time trends...')
 
                         hypoxic_time_analysis_content = AnalysisContent()
                         hypoxic_time_analysis_content.sub_heading = "Total Hypoxic Time Analysis:"
-                        hypoxic_time_analysis_content.figure = fig_hypoxic
-                        hypoxic_time_analysis_content.paragraph = hypoxic_time_analysis
+                        hypoxic_time_analysis_content.figure = go.Figure(fig_hypoxic)
                         content_to_write.append(hypoxic_time_analysis_content)
                         st.markdown("---")
                         
-                        # Create data for blood pressure chart
-                        bp_before = []
-                        bp_after = []
-                        
-                        # Add the BP analysis section first
-                        st.write("**Blood Pressure Analysis:**")
-                        with st.spinner('Analyzing BP trends...'):
-                            bp_analysis = analyze_bp_trends(analysis_data)
-                        
-                        for treatment_num, data in sorted(analysis_data['treatments'].items()):
-                            # Convert BP values to display format
-                            sys_before = data.get('BP SYS before (mmHg)', 'N/A')
-                            dia_before = data.get('BP DIA before (mmHg)', 'N/A')
-                            sys_after = data.get('BP SYS after (mmHg)', 'N/A')
-                            dia_after = data.get('BP DIA after (mmHg)', 'N/A')
-                            
-                            # Format BP values - only append if both systolic and diastolic are valid numbers
-                            try:
-                                if sys_before != 'N/A' and dia_before != 'N/A':
-                                    sys_before = float(sys_before)
-                                    dia_before = float(dia_before)
-                                    bp_before.append(sys_before)  # Only use systolic value for plotting
-                                else:
-                                    bp_before.append(None)
-                                    
-                                if sys_after != 'N/A' and dia_after != 'N/A':
-                                    sys_after = float(sys_after)
-                                    dia_after = float(dia_after)
-                                    bp_after.append(sys_after)  # Only use systolic value for plotting
-                                else:
-                                    bp_after.append(None)
-                            except (ValueError, TypeError):
-                                bp_before.append(None)
-                                bp_after.append(None)
-                        
-                        # BP Comparison Chart
-                        fig_bp_comparison = go.Figure()
-                        
-                        fig_bp_comparison.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=bp_before,
-                            name='BP Before Procedure',
-                            mode='lines+markers',
-                            connectgaps=True
-                        ))
-                        
-                        fig_bp_comparison.add_trace(go.Scatter(
-                            x=treatment_nums,
-                            y=bp_after,
-                            name='BP After Procedure',
-                            mode='lines+markers',
-                            connectgaps=True
-                        ))
-                        
-                        fig_bp_comparison.update_layout(
-                            title='Blood Pressure Trends Across Sessions',
-                            xaxis_title='Session Number',
-                            yaxis_title='Blood Pressure (mmHg)',
-                            legend=dict(
-                                orientation="v",
-                                yanchor="middle",
-                                y=0.5,
-                                xanchor="left",
-                                x=1.02,
-                                font=dict(size=12)
-                            ),
-                            margin=dict(t=50, l=50, r=100, b=50),
-                            height=500,
-                            template='plotly'
-
-                        )
                         all_figures.append(fig_bp_comparison)
-                        st.plotly_chart(fig_bp_comparison, use_container_width=True)
-                        st.write(bp_analysis)
+                        chart_analysis_section("Blood Pressure Analysis", fig_bp_comparison, fan_out, 'bp_trends', 'Analyzing BP trends...')
                         bp_analysis_content = AnalysisContent()
                         bp_analysis_content.sub_heading = "Blood Pressure Analysis:"
-                        bp_analysis_content.figure = fig_bp_comparison
-                        bp_analysis_content.paragraph = bp_analysis
+                        bp_analysis_content.figure = go.Figure(fig_bp_comparison)
                         content_to_write.append(bp_analysis_content)
 
                     else:
                         st.write("Upload multiple sessions to see progress charts")
                     
+                    # Write the analyses into their sections as they complete
+                    analyses = fan_out.fill()
+                    if case_history.strip():
+                        case_history_analysis.paragraph = analyses['case_history']
+                    if len(filtered_treatments) > 1:
+                        session_analysis_content.paragraph = analyses['session_comparison']
+                    if len(analysis_data['treatments']) > 1:
+                        analysis_content.paragraph = analyses['phase_durations']
+                        pulserate_analysis_content.paragraph = analyses['pr_trends']
+                        hypoxic_time_analysis_content.paragraph = analyses['hypoxic_time']
+                        bp_analysis_content.paragraph = analyses['bp_trends']
+                    
                     st.markdown("---")
                     pdf_path = "exported_report.pdf"
-                    create_pdf(session_analysis_content,content_to_write,pdf_path)
-                    with open(pdf_path, "rb") as file:
-                        pdf_bytes = file.read()
+                    
+                    def build_pdf():
+                        create_pdf(session_analysis_content,content_to_write,pdf_path)
+                        with open(pdf_path, "rb") as file:
+                            return file.read()
+                    
+                    # A PDF with a failed analysis in it is rebuilt next time instead of cached
+                    if any(str(text).startswith("Error") for text in analyses.values()):
+                        pdf_bytes = build_pdf()
+                    else:
+                        pdf_bytes = cached_for_subset(subset_results, 'pdf', build_pdf)
+                    content_to_write.clear()
 
                     st.download_button(
                         label="Download PDF",
                         data=pdf_bytes,
                         file_name= "exported_report.pdf",
                         mime="application/pdf",
+                        on_click="ignore"
                     )
                     # Now add the Detailed Treatment Overview section
-                    # Add custom CSS for styling
-                    st.markdown("""
-                        <style>
-                            /* Style for the section header */
-                            .detailed-overview-header {
-                                font-size: 24px;
-                                color: #1E88E5;
-                                padding: 10px 0;
-                                border-bottom: 2px solid #1E88E5;
-                                margin-bottom: 20px;
-                            }
-                            
-                            /* Style for tab labels */
-                            .stTabs [data-baseweb="tab-list"] {
-                                gap: 8px;
-                            }
-                            
-                            .stTabs [data-baseweb="tab"] {
-                                background-color: #f0f2f6;
-                                border-radius: 4px;
-                                padding: 8px 16px;
-                                font-weight: 500;
-                            }
-                            
-                            .stTabs [aria-selected="true"] {
-                                background-color: #1E88E5;
-                                color: white;
-                            }
-                            
-                            /* Style for table headers and cells */
-                            .treatment-header {
-                                font-weight: bold;
-                                color: #1E88E5;
-                                font-size: 16px;
-                                padding: 8px 0;
-                                border-bottom: 1px solid #e0e0e0;
-                            }
-                            
-                            .field-label {
-                                font-weight: 500;
-                                color: #424242;
-                                background-color: #f5f5f5;
-                                padding: 6px;
-                                border-radius: 4px;
-                                margin: 2px 0;
-                            }
-                            
-                            .field-value {
-                                padding: 6px;
-                                border-radius: 4px;
-                                background-color: white;
-                                margin: 2px 0;
-                                border: 1px solid #e0e0e0;
-                            }
-                            
-                            /* Keep Case History Analysis heading with content */
-                            h2:contains("Case History Analysis") {
-                                break-inside: avoid !important;
-                                page-break-inside: avoid !important;
-                            }
-                            
-                            /* Keep the analysis text with its heading */
-                            h2:contains("Case History Analysis") + p {
-                                break-inside: avoid !important;
-                                page-break-inside: avoid !important;
-                            }
-                            
-                            /* Create a wrapper for the heading and content */
-                            .case-history-section {
-                                break-inside: avoid !important;
-                                page-break-inside: avoid !important;
-                                margin-bottom: 20px !important;
-                            }
-                        </style>
-                    """, unsafe_allow_html=True)
-                    
-                    # Add paginated detailed view with styled header
-                    st.markdown('<h2 class="detailed-overview-header">Detailed Treatment Overview</h2>', unsafe_allow_html=True)
-                    if analysis_data['treatments']:
-                        st.markdown('<div class="detailed-overview-content">', unsafe_allow_html=True)
-                        # Convert treatments to sorted list of tuples
-                        sorted_treatments = sorted(analysis_data['treatments'].items())
-                        
-                        # Group treatments into sets of 5 (changed from 10)
-                        sessions_per_page = 5
-                        all_pages = []
-                        current_page = []
-                        
-                        for i, (treatment_num, data) in enumerate(sorted_treatments, 1):
-                            current_page.append((treatment_num, data))
-                            if i % sessions_per_page == 0 or i == len(sorted_treatments):
-                                all_pages.append(current_page)
-                                current_page = []
-                        
-                        # Add any remaining treatments to the last page
-                        if current_page:
-                            all_pages.append(current_page)
-                        
-                        # Create tabs for each group of 5 (updated labels)
-                        tab_labels = [f"Sessions {i*5-4}-{min(i*5, len(sorted_treatments))}" 
-                                     for i in range(1, len(all_pages) + 1)]
-                        tabs = st.tabs(tab_labels)
-                        
-                        # Define fields to display
-                        fields = [
-                            ('Date', 'Treatment Date'),
-                            ('Procedure duration (min:sec)', 'Total Duration'),
-                            ('total_hypoxic_calc', 'Total Hypoxic Time (approx)'),
-                            ('Number of cycles', 'Number of Cycles'),
-                            ('Hypox. Phase dur. Av. (min:sec)', 'Hypoxic Phase Duration Average'),
-                            ('Min SpO2 Av. (%)', 'Min SpO2 Average'),
-                            ('Hyperox. Phase dur. Av. (min:sec)', 'Hyperoxic Phase Duration Average'),
-                            ('Max SpO2 Av. (%)', 'Max SpO2 Average'),
-                            ('Min PR Av. (bpm)', 'Min PR Average'),
-                            ('Max PR Av. (bpm)', 'Max PR Average'),
-                            ('Therapeutic SpO2 (%)', 'Therapeutic SpO2'),
-                            ('Hypoxic O2 conc. (%)', 'Hypoxic O2 Concentration'),
-                            ('BP_before', 'BP Before Procedure'),
-                            ('BP_after', 'BP After Procedure')
-                        ]
-                        
-                        # Display content for each tab
-                        for tab_index, tab in enumerate(tabs):
-                            with tab:
-                                current_treatments = all_pages[tab_index]
-                                
-                                # Create columns for the table
-                                cols = st.columns(len(current_treatments) + 1)
-                                
-                                # Treatment number headers
-                                for i, (treatment_num, _) in enumerate(current_treatments, 1):
-                                    cols[i].markdown(f'<div class="treatment-header">Session {treatment_num}</div>', unsafe_allow_html=True)
-                                
-                                # Create rows
-                                for field_key, field_label in fields:
-                                    cols = st.columns(len(current_treatments) + 1)
-                                    cols[0].markdown(f'<div class="field-label">{field_label}</div>', unsafe_allow_html=True)
-                                    for i, (treatment_num, data) in enumerate(current_treatments, 1):
-                                        if field_key == 'BP_before':
-                                            sys_before = data.get('BP SYS before (mmHg)', 'N/A')
-                                            dia_before = data.get('BP DIA before (mmHg)', 'N/A')
-                                            value = f"{sys_before}/{dia_before}" if sys_before != 'N/A' else 'N/A'
-                                        elif field_key == 'BP_after':
-                                            sys_after = data.get('BP SYS after (mmHg)', 'N/A')
-                                            dia_after = data.get('BP DIA after (mmHg)', 'N/A')
-                                            value = f"{sys_after}/{dia_after}" if sys_after != 'N/A' else 'N/A'
-                                        elif field_key == 'total_hypoxic_calc':
-                                            try:
-                                                # Get hypoxic phase duration
-                                                hypoxic_dur = data.get('Hypox. Phase dur. Av. (min:sec)', 'N/A')
-                                                if hypoxic_dur != 'N/A':
-                                                    # Convert "MM:SS" to total seconds
-                                                    min_sec = hypoxic_dur.split(':')
-                                                    total_seconds = int(min_sec[0]) * 60 + int(min_sec[1])
-                                                    
-                                                    # Get number of cycles
-                                                    cycles_str = data.get('Number of cycles', 'N/A')
-                                                    if cycles_str != 'N/A':
-                                                        num_cycles = int(cycles_str.split()[0])  # Get first number
-                                                        
-                                                        # Calculate total time in seconds
-                                                        total_time_seconds = total_seconds * num_cycles
-                                                        
-                                                        # Convert back to MM:SS format
-                                                        minutes = total_time_seconds // 60
-                                                        seconds = total_time_seconds % 60
-                                                        value = f"{minutes:02d}:{seconds:02d}"
-                                                    else:
-                                                        value = 'N/A'
-                                                else:
-                                                    value = 'N/A'
-                                            except (ValueError, IndexError):
-                                                value = 'N/A'
-                                        else:
-                                            value = df.loc[treatment_num, field_key] if field_key in df.columns else data.get(field_key, 'N/A')
-                                        cols[i].markdown(f'<div class="field-value">{value}</div>', unsafe_allow_html=True)
-                        st.markdown('</div>', unsafe_allow_html=True)
+                    show_detailed_overview(analysis_data, df, metrics)
+                    show_latency_histogram()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import time
+
+from extraction_cache import get_cached_extraction, set_cached_extraction
+
+# Bump when the treatment hash or the stored record layout changes
+COURSE_STORE_VERSION = "1"
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def course_identity(course_data):
+    """
+    Key that matches re-exports of the same course
+
+    Returns:
+        str: Hash of the normalised patient name, date of birth and reference number,
+        or None when the report carries no patient name
+    """
+    name = " ".join(str(course_data.get('patient_name', '')).split()).lower()
+    if not name:
+        return None
+    return _digest([name, course_data.get('dob', ''), course_data.get('ref_no', '')])
+
+
+def treatment_hashes(course_data):
+    """Return treatment number -> hash of its date and measurements"""
+    schedule = course_data.get('schedule', {})
+    return {
+        treatment_num: _digest([schedule.get(treatment_num, ''), sorted(measurements.items())])
+        for treatment_num, measurements in course_data['treatments'].items()
+    }
+
+
+def diff_treatments(previous_hashes, current_hashes):
+    """
+    Compare two uploads of a course
+
+    Returns:
+        dict: Sorted treatment numbers under 'new', 'changed', 'unchanged' and 'removed'
+    """
+    return {
+        'new': sorted(num for num in current_hashes if num not in previous_hashes),
+        'changed': sorted(num for num, h in current_hashes.items()
+                          if num in previous_hashes and previous_hashes[num] != h),
+        'unchanged': sorted(num for num, h in current_hashes.items() if previous_hashes.get(num) == h),
+        'removed': sorted(num for num in previous_hashes if num not in current_hashes),
+    }
+
+
+def match_course(course_data):
+    """
+    Match an upload against the stored course and remember it for the next upload
+
+    Returns:
+        dict: 'identity', 'hashes' (current treatment hashes), 'diff' against the stored
+        course (None for a first upload) and 'previous_upload' (time of the stored upload)
+    """
+    identity = course_identity(course_data)
+    hashes = treatment_hashes(course_data)
+    if identity is None:
+        return {'identity': None, 'hashes': hashes, 'diff': None, 'previous_upload': None}
+
+    stored = get_cached_extraction('course_record', identity, COURSE_STORE_VERSION)
+    diff = None
+    previous_upload = None
+    if stored is not None:
+        previous_upload = stored['uploaded_at']
+        diff = diff_treatments(stored['hashes'], hashes)
+        if stored['hashes'] == hashes:
+            # Same content re-uploaded; keep the original upload time as the baseline
+            return {'identity': identity, 'hashes': hashes, 'diff': diff, 'previous_upload': previous_upload}
+
+    set_cached_extraction('course_record', identity, COURSE_STORE_VERSION, {
+        'hashes': hashes,
+        'uploaded_at': time.time(),
+    })
+    return {'identity': identity, 'hashes': hashes, 'diff': diff, 'previous_upload': previous_upload}
+
+
+def course_result(course_match, name, treatment_nums, compute, extra=None, refresh=False):
+    """
+    Reuse a result computed earlier for the same treatment contents
+
+    Args:
+        course_match: Result of match_course
+        name: Which result this is, e.g. "pr_trends"
+        treatment_nums: Treatments the result is computed from
+        compute: Callable producing the result on a miss
+        extra: Any other input the result depends on (e.g. the case history)
+        refresh: Compute and store a new result even if one is stored
+
+    Returns:
+        The stored or freshly computed result. Results of error strings are not stored.
+    """
+    if course_match['identity'] is None:
+        return compute()
+    hashes = course_match['hashes']
+    key = _digest([course_match['identity'], name, [(num, hashes.get(num)) for num in sorted(treatment_nums)], extra])
+    cached = None if refresh else get_cached_extraction('course_result', key, COURSE_STORE_VERSION)
+    if cached is not None:
+        return cached
+    value = compute()
+    if not (isinstance(value, str) and value.startswith("Error")):
+        set_cached_extraction('course_result', key, COURSE_STORE_VERSION, value)
+    return value
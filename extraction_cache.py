@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+# On-disk cache of parsed PDF reports, shared by every session, worker process and restart
+CACHE_PATH = os.getenv("REOXY_CACHE_PATH", os.path.join(".cache", "extraction_cache.sqlite3"))
+CACHE_MAX_BYTES = int(os.getenv("REOXY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def hash_pdf_bytes(pdf_bytes):
+    """Return the SHA-256 hex digest used to key extracted reports"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def _connect():
+    directory = os.path.dirname(CACHE_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH, timeout=30)
+    # WAL lets several processes read while one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS extractions (
+            kind TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            version TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (kind, file_hash, version)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions (last_access)")
+    return conn
+
+
+def get_cached_extraction(kind, file_hash, version):
+    """
+    Look up a parsed report
+
+    Args:
+        kind: Report type, e.g. "reoxy_session" or "course_report"
+        file_hash: SHA-256 of the PDF bytes
+        version: Extractor version the value was produced with
+
+    Returns:
+        The cached value, or None on a miss or if the cache is unavailable
+    """
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT value FROM extractions WHERE kind = ? AND file_hash = ? AND version = ?",
+                    (kind, file_hash, version)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE extractions SET last_access = ? WHERE kind = ? AND file_hash = ? AND version = ?",
+                    (time.time(), kind, file_hash, version)
+                )
+            return pickle.loads(row[0])
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def set_cached_extraction(kind, file_hash, version, value):
+    """Store a parsed report and evict least recently used entries beyond CACHE_MAX_BYTES"""
+    try:
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions (kind, file_hash, version, value, size, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, file_hash, version, sqlite3.Binary(blob), len(blob), time.time())
+                )
+                _evict(conn)
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError, pickle.PicklingError):
+        pass
+
+
+def _evict(conn):
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    rows = conn.execute(
+        "SELECT kind, file_hash, version, size FROM extractions ORDER BY last_access ASC"
+    ).fetchall()
+    for kind, file_hash, version, size in rows:
+        if total <= CACHE_MAX_BYTES:
+            break
+        conn.execute(
+            "DELETE FROM extractions WHERE kind = ? AND file_hash = ? AND version = ?",
+            (kind, file_hash, version)
+        )
+        total -= size
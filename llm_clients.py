@@ -0,0 +1,237 @@
+import bisect
+import contextvars
+import hashlib
+import importlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+import streamlit as st
+
+from extraction_cache import get_cached_extraction, set_cached_extraction
+
+# One OpenAI and one Anthropic client per process, shared by every session and worker thread.
+# Their connection pools keep TLS connections alive between analysis calls.
+LLM_MAX_CONNECTIONS = int(os.getenv("REOXY_LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("REOXY_LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+LLM_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("REOXY_LLM_KEEPALIVE_EXPIRY_SECONDS", "120"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("REOXY_LLM_CONNECT_TIMEOUT_SECONDS", "10"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("REOXY_LLM_TIMEOUT_SECONDS", "120"))
+LLM_MAX_RETRIES = int(os.getenv("REOXY_LLM_MAX_RETRIES", "2"))
+
+# Completions are stored in the shared on-disk cache, so every worker process and
+# every clinician opening the same patient reuses them until they expire
+LLM_CACHE_VERSION = "1"
+LLM_CACHE_TTL_SECONDS = float(os.getenv("REOXY_LLM_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is open ended
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+_latency_lock = threading.Lock()
+_latency_counts = {}
+
+# Set by regenerating() and streaming_to(); copied into fan-out worker threads with the rest of the context
+_regenerate = contextvars.ContextVar("reoxy_llm_regenerate", default=False)
+_token_sink = contextvars.ContextVar("reoxy_llm_token_sink", default=None)
+
+
+def _record_latency(provider, seconds):
+    with _latency_lock:
+        counts = _latency_counts.setdefault(provider, [0] * (len(LATENCY_BUCKETS) + 1))
+        counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def _latency_hooks(provider):
+    """httpx event hooks timing each request until its response headers arrive"""
+    def on_request(request):
+        request.extensions['reoxy_started'] = time.perf_counter()
+
+    def on_response(response):
+        started = response.request.extensions.get('reoxy_started')
+        if started is not None:
+            _record_latency(provider, time.perf_counter() - started)
+
+    return {'request': [on_request], 'response': [on_response]}
+
+
+def _http_library(client_class):
+    """The HTTP package the SDK client is built on (httpx, or httpx2 in newer SDK releases)"""
+    base = next(cls for cls in client_class.__mro__ if cls.__name__ == 'Client' and cls is not client_class)
+    return importlib.import_module(base.__module__.split('.')[0])
+
+
+def _http_client(client_class, provider):
+    httpx = _http_library(client_class)
+    return client_class(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+        event_hooks=_latency_hooks(provider),
+    )
+
+
+@st.cache_resource
+def openai_client():
+    """Process-wide OpenAI client; safe to share between threads"""
+    import openai
+    return openai.OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=_http_client(openai.DefaultHttpxClient, "openai"),
+        max_retries=LLM_MAX_RETRIES,
+    )
+
+
+@st.cache_resource
+def anthropic_client():
+    """Process-wide Anthropic client; safe to share between threads"""
+    import anthropic
+    return anthropic.Anthropic(
+        api_key=os.getenv("ANTHROPIC_API_KEY"),
+        http_client=_http_client(anthropic.DefaultHttpxClient, "anthropic"),
+        max_retries=LLM_MAX_RETRIES,
+    )
+
+
+def latency_histogram():
+    """
+    Per-call latency of the LLM clients since the process started
+
+    Returns:
+        DataFrame: Call counts, one row per latency bucket and one column per provider
+    """
+    labels = [f"≤ {bound}s" for bound in LATENCY_BUCKETS] + [f"> {LATENCY_BUCKETS[-1]}s"]
+    with _latency_lock:
+        counts = {provider: list(values) for provider, values in _latency_counts.items()}
+    return pd.DataFrame(counts, index=labels)
+
+
+def show_latency_histogram():
+    """Expander with the LLM call latency histogram"""
+    histogram = latency_histogram()
+    if histogram.empty:
+        return
+    with st.expander("LLM call latency"):
+        st.bar_chart(histogram)
+        st.caption(f"{int(histogram.to_numpy().sum())} calls since the server started")
+
+
+@contextmanager
+def regenerating(enabled=True):
+    """LLM calls made in this block, including analyses it starts on the fan-out, skip the response cache"""
+    token = _regenerate.set(enabled)
+    try:
+        yield
+    finally:
+        _regenerate.reset(token)
+
+
+@contextmanager
+def streaming_to(sink):
+    """
+    LLM calls made in this block use the providers' streaming APIs
+
+    Args:
+        sink: Callable(text) receiving each text delta as it arrives, or None to not stream
+    """
+    token = _token_sink.set(sink)
+    try:
+        yield
+    finally:
+        _token_sink.reset(token)
+
+
+def regenerate_requested():
+    """True inside a regenerating() block"""
+    return _regenerate.get()
+
+
+def normalise_prompt(text):
+    """Collapse whitespace, so re-indented prompt templates still share cache entries"""
+    return " ".join(str(text).split())
+
+
+def response_cache_key(provider, model, messages, params):
+    """Hash of everything that determines a completion"""
+    normalised = [{'role': message['role'], 'content': normalise_prompt(message['content'])} for message in messages]
+    payload = json.dumps([provider, model, normalised, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _is_valid(text, validate):
+    try:
+        validate(text)
+    except ValueError:
+        return False
+    return True
+
+
+def _cached_response(provider, model, messages, params, request, regenerate, validate=None):
+    key = response_cache_key(provider, model, messages, params)
+    if not (regenerate or _regenerate.get()):
+        cached = get_cached_extraction('llm_response', key, LLM_CACHE_VERSION)
+        if (cached is not None and time.time() - cached['created_at'] <= LLM_CACHE_TTL_SECONDS
+                and (validate is None or _is_valid(cached['text'], validate))):
+            return cached['text']
+    # Failed requests raise and are never stored, also when a stream breaks off halfway
+    text = request()
+    if validate is not None:
+        validate(text)
+    set_cached_extraction('llm_response', key, LLM_CACHE_VERSION, {'text': text, 'created_at': time.time()})
+    return text
+
+
+def _openai_text(model, messages, params):
+    sink = _token_sink.get()
+    if sink is None:
+        return openai_client().chat.completions.create(model=model, messages=messages, **params).choices[0].message.content
+    parts = []
+    for chunk in openai_client().chat.completions.create(model=model, messages=messages, stream=True, **params):
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            sink(parts[-1])
+    return "".join(parts)
+
+
+def _anthropic_text(model, messages, params):
+    sink = _token_sink.get()
+    if sink is None:
+        return anthropic_client().messages.create(model=model, messages=messages, **params).content[0].text
+    parts = []
+    with anthropic_client().messages.stream(model=model, messages=messages, **params) as stream:
+        for text in stream.text_stream:
+            parts.append(text)
+            sink(text)
+    return "".join(parts)
+
+
+def chat_completion(model, messages, regenerate=False, validate=None, **params):
+    """
+    Text of an OpenAI chat completion, reused from the response cache when possible
+
+    Inside streaming_to() the completion is streamed; the full text is still returned.
+
+    Args:
+        model: OpenAI model name
+        messages: Chat messages
+        regenerate: Ask the model again even if a cached answer exists
+        validate: Optional callable(text) raising ValueError for answers that must not be cached
+        **params: Other create() parameters, part of the cache key
+
+    Returns:
+        str: The completion text
+    """
+    return _cached_response('openai', model, messages, params, lambda: _openai_text(model, messages, params),
+                            regenerate, validate)
+
+
+def claude_message(model, messages, max_tokens, regenerate=False, validate=None, **params):
+    """Text of an Anthropic message, reused from the response cache when possible (see chat_completion)"""
+    params = dict(params, max_tokens=max_tokens)
+    return _cached_response('anthropic', model, messages, params, lambda: _anthropic_text(model, messages, params),
+                            regenerate, validate)
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import streamlit as st
+
+# One pool of PDF parse workers per server process, shared by every session and rerun,
+# so its start-up cost is paid once instead of on every upload
+PARSE_WORKERS = int(os.getenv("REOXY_PARSE_WORKERS", str(os.cpu_count() or 1)))
+
+_main_lock = threading.Lock()
+
+
+@contextmanager
+def _entry_script_hidden():
+    """
+    Spawned workers re-import sys.modules['__main__'] before running anything. Under
+    Streamlit that is the entry script, with its login page and app.main(), so workers
+    started in this block see an empty module instead and import only what they run.
+    """
+    with _main_lock:
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main
+
+
+@st.cache_resource
+def parse_pool():
+    """
+    Process-wide parse pool
+
+    Workers are spawned, not forked: forking the threaded Streamlit server (Tornado and
+    the LLM thread pool) can deadlock the child. They start on demand in submit_parse().
+    """
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def submit_parse(fn, *args):
+    """
+    Run fn(*args) on the parse pool
+
+    Args:
+        fn: Module-level function, imported by name in the worker
+        *args: Picklable arguments
+
+    Returns:
+        Future: The call's result
+    """
+    # The pool starts a worker inside submit() whenever none is idle
+    with _entry_script_hidden():
+        try:
+            return parse_pool().submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            parse_pool.clear()
+            return parse_pool().submit(fn, *args)
@@ -0,0 +1,196 @@
+import json
+import os
+import time
+
+from upload_buffers import as_pdf_stream
+
+# Benchmark results: report type -> name of the fastest backend that passed the golden-field check
+BACKENDS_PATH = os.getenv("REOXY_PDF_BACKENDS_PATH", os.path.join(".cache", "pdf_backends.json"))
+DEFAULT_BACKEND = "pdfplumber"
+
+# Word splitting of ReOxy session reports, shared by every backend so they produce the same words
+WORD_X_TOLERANCE = 3
+WORD_Y_TOLERANCE = 3
+
+# Backends able to serve each report type; course reports need pdfplumber's table extraction
+REPORT_TYPE_BACKENDS = {
+    'reoxy_session': ['pdfplumber', 'pdfminer'],
+    'course_report': ['pdfplumber'],
+}
+
+
+class PdfTextBackend:
+    """Common interface for the PDF text stacks used across the app"""
+    name = ""
+
+    def is_available(self):
+        return True
+
+    def page_words(self, source):
+        """
+        Yield each page as a list of stripped words
+
+        Every backend must split and order words like pdfplumber's extract_words with
+        use_text_flow=True, since field values are found by their position from a label.
+        """
+        raise NotImplementedError
+
+
+class PdfplumberBackend(PdfTextBackend):
+    name = "pdfplumber"
+
+    def page_words(self, source):
+        import pdfplumber
+        with pdfplumber.open(as_pdf_stream(source)) as pdf:
+            for page in pdf.pages:
+                words = page.extract_words(
+                    x_tolerance=WORD_X_TOLERANCE,
+                    y_tolerance=WORD_Y_TOLERANCE,
+                    keep_blank_chars=True,
+                    use_text_flow=True
+                )
+                yield [w['text'].strip() for w in words]
+
+
+class PdfminerBackend(PdfTextBackend):
+    """
+    Characters straight from pdfminer, grouped into words with pdfplumber's rule
+
+    Layout analysis is skipped, so characters stay in content-stream order like
+    pdfplumber's use_text_flow, and pdfplumber's per-page object model is never built.
+    """
+    name = "pdfminer"
+
+    def is_available(self):
+        try:
+            import pdfminer.high_level  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @staticmethod
+    def _chars(container):
+        from pdfminer.layout import LTChar, LTContainer
+        for item in container:
+            if isinstance(item, LTChar):
+                yield item
+            elif isinstance(item, LTContainer):
+                yield from PdfminerBackend._chars(item)
+
+    @staticmethod
+    def _begins_new_word(previous, char):
+        # pdfplumber's WordExtractor.char_begins_new_word for upright left-to-right text
+        return (char.x0 < previous.x0
+                or char.x0 > previous.x1 + WORD_X_TOLERANCE
+                or abs(char.y1 - previous.y1) > WORD_Y_TOLERANCE)
+
+    def page_words(self, source):
+        from pdfminer.converter import PDFPageAggregator
+        from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.utils import open_filename
+        manager = PDFResourceManager()
+        device = PDFPageAggregator(manager, laparams=None)
+        interpreter = PDFPageInterpreter(manager, device)
+        with open_filename(as_pdf_stream(source), "rb") as fp:
+            for page in PDFPage.get_pages(fp):
+                interpreter.process_page(page)
+                words = []
+                current = []
+                previous = None
+                for char in self._chars(device.get_result()):
+                    if previous is not None and self._begins_new_word(previous, char):
+                        words.append(''.join(current))
+                        current = []
+                    current.append(char.get_text())
+                    previous = char
+                if current:
+                    words.append(''.join(current))
+                yield [word.strip() for word in words]
+
+
+BACKENDS = {backend.name: backend for backend in (PdfplumberBackend(), PdfminerBackend())}
+
+
+def get_backend(name):
+    """Return the backend registered under name"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown PDF backend: {name}")
+    return BACKENDS[name]
+
+
+def load_backend_selection():
+    try:
+        with open(BACKENDS_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_backend_selection(selection):
+    directory = os.path.dirname(BACKENDS_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(BACKENDS_PATH, "w") as f:
+        json.dump(selection, f, indent=2)
+
+
+_selection = None
+
+
+def selected_backend(report_type):
+    """Return the benchmarked backend for a report type, falling back to pdfplumber"""
+    global _selection
+    if _selection is None:
+        _selection = load_backend_selection()
+    name = _selection.get(report_type, DEFAULT_BACKEND)
+    if name not in REPORT_TYPE_BACKENDS.get(report_type, []) or not BACKENDS[name].is_available():
+        return DEFAULT_BACKEND
+    return name
+
+
+def benchmark_backends(report_type, samples, extract, golden_fields, repeats=3):
+    """
+    Time every available backend on sample reports and check it against pdfplumber
+
+    Args:
+        report_type: Key of REPORT_TYPE_BACKENDS
+        samples: List of PDF bytes
+        extract: Callable(pdf_bytes, backend_name) returning a dict of extracted fields
+        golden_fields: Fields that must match the pdfplumber output exactly
+        repeats: Timed runs per sample, the best run is kept
+
+    Returns:
+        list: One dict per backend with 'backend', 'seconds', 'passed' and 'mismatches',
+        fastest first
+    """
+    golden = [extract(pdf_bytes, DEFAULT_BACKEND) for pdf_bytes in samples]
+    results = []
+    for name in REPORT_TYPE_BACKENDS[report_type]:
+        if not BACKENDS[name].is_available():
+            continue
+        seconds = 0.0
+        mismatches = []
+        for sample_index, pdf_bytes in enumerate(samples):
+            best = None
+            output = {}
+            for _ in range(repeats):
+                start = time.perf_counter()
+                try:
+                    output = extract(pdf_bytes, name)
+                except Exception as e:
+                    output = {'error': str(e)}
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            seconds += best
+            for field in golden_fields:
+                if output.get(field) != golden[sample_index].get(field):
+                    mismatches.append((sample_index, field, output.get(field), golden[sample_index].get(field)))
+        results.append({
+            'backend': name,
+            'seconds': seconds,
+            'passed': not mismatches,
+            'mismatches': mismatches
+        })
+    results.sort(key=lambda result: result['seconds'])
+    return results
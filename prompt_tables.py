@@ -0,0 +1,171 @@
+import csv
+import io
+import math
+import os
+
+import pandas as pd
+
+from session_records import parse_blood_pressure, parse_min_sec, parse_number
+
+# Session data goes into prompts as one CSV table with a single header row. Above this many
+# tokens the table is replaced by per-column summary statistics so long courses stay affordable.
+PROMPT_TOKEN_BUDGET = int(os.getenv("REOXY_PROMPT_TOKEN_BUDGET", "1000"))
+# Rough characters per token when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+# The summary keeps the trend by averaging this many consecutive stretches of the course
+SUMMARY_STRETCHES = 3
+
+_encodings = {}
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """Tokens of text for model; estimated from its length when tiktoken is not installed"""
+    try:
+        import tiktoken
+    except ImportError:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return len(_encodings[model].encode(text))
+
+
+def _cell(column, treatment_num, data):
+    _, value = column
+    if callable(value):
+        return value(treatment_num, data)
+    return data.get(value, 'N/A')
+
+
+def _csv(rows):
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerows(rows)
+    return out.getvalue().rstrip("\n")
+
+
+def session_table(sessions, columns):
+    """
+    Sessions as CSV: a header row, then one row per session
+
+    Args:
+        sessions: (treatment_num, data) pairs in session order
+        columns: (header, value) pairs; value is a data key or a callable(treatment_num, data)
+
+    Returns:
+        str: The CSV text
+    """
+    rows = [['Session'] + [header for header, _ in columns]]
+    for treatment_num, data in sessions:
+        rows.append([treatment_num] + [_cell(column, treatment_num, data) for column in columns])
+    return _csv(rows)
+
+
+def _column_kind(text):
+    present = text[text.notna() & ~text.isin(['', 'N/A', '---'])]
+    if present.empty or present.str.fullmatch(r'\s*\d{1,2}\.\d{1,2}\.\d{2,4}\s*').any():
+        return 'text'
+    if present.str.contains(r'\d+:\d{1,2}').all():
+        return 'duration'
+    # "SYS/DIA" blood pressure or "6 / 5" cycle counts
+    if present.str.contains(r'\d\s*/\s*\d').any():
+        return 'pair'
+    if parse_number(present).notna().all():
+        return 'number'
+    return 'text'
+
+
+def _format_seconds(seconds):
+    if pd.isna(seconds):
+        return 'N/A'
+    seconds = int(round(seconds))
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+def _format_number(value):
+    return 'N/A' if pd.isna(value) else f"{value:.1f}".rstrip('0').rstrip('.')
+
+
+def _summarise_column(values, stretches):
+    """Summary cells of one column: first, last, min, max, mean, then one mean per stretch"""
+    text = pd.Series(values, dtype='string')
+    kind = _column_kind(text)
+    if kind == 'text':
+        return [values[0], values[-1]] + [''] * (3 + len(stretches))
+
+    if kind == 'pair':
+        series = list(parse_blood_pressure(text))
+        formatter = _format_number
+        join = '/'.join
+    elif kind == 'duration':
+        series = [parse_min_sec(text).dt.total_seconds()]
+        formatter = _format_seconds
+        join = ''.join
+    else:
+        series = [parse_number(text)]
+        formatter = _format_number
+        join = ''.join
+
+    def cell(pick):
+        return join(formatter(pick(s.reset_index(drop=True))) for s in series)
+
+    cells = [
+        cell(lambda s: s.dropna().iloc[0] if s.notna().any() else math.nan),
+        cell(lambda s: s.dropna().iloc[-1] if s.notna().any() else math.nan),
+        cell(lambda s: s.min()),
+        cell(lambda s: s.max()),
+        cell(lambda s: s.mean()),
+    ]
+    for start, stop in stretches:
+        cells.append(cell(lambda s: s.iloc[start:stop].mean()))
+    return cells
+
+
+def summary_table(sessions, columns, stretch_count=SUMMARY_STRETCHES):
+    """
+    Per-column summary statistics of the sessions as CSV
+
+    Missing values are skipped. The stretch means split the course into stretch_count
+    consecutive parts, so trends survive the summary.
+    """
+    sessions = list(sessions)
+    nums = [treatment_num for treatment_num, _ in sessions]
+    size = math.ceil(len(sessions) / stretch_count) if sessions else 1
+    stretches = [(start, min(start + size, len(sessions))) for start in range(0, len(sessions), size)]
+
+    labels = [f"first (session {nums[0]})", f"last (session {nums[-1]})", "min", "max", "mean"]
+    labels += [f"mean sessions {nums[start]}-{nums[stop - 1]}" for start, stop in stretches]
+    summaries = [
+        _summarise_column([_cell(column, treatment_num, data) for treatment_num, data in sessions], stretches)
+        for column in columns
+    ]
+    rows = [['Statistic'] + [header for header, _ in columns]]
+    rows += [[label] + [summary[i] for summary in summaries] for i, label in enumerate(labels)]
+    return _csv(rows)
+
+
+def sessions_block(sessions, columns, budget=None, model="gpt-3.5-turbo"):
+    """
+    Session data for a prompt: the full table, or its summary when the table is over budget
+
+    Args:
+        sessions: (treatment_num, data) pairs in session order
+        columns: See session_table
+        budget: Token budget of the table, PROMPT_TOKEN_BUDGET by default
+        model: Model whose tokenizer is used for counting
+
+    Returns:
+        str: A labelled CSV block ready to paste into a prompt
+    """
+    sessions = list(sessions)
+    if not sessions:
+        return "Sessions: none"
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    table = session_table(sessions, columns)
+    if count_tokens(table, model) <= budget:
+        return f"Sessions (CSV, one row per session):\n{table}"
+    return (
+        f"Summary of {len(sessions)} sessions (CSV; too many sessions to list one by one):\n"
+        f"{summary_table(sessions, columns)}"
+    )
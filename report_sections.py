@@ -0,0 +1,146 @@
+import contextvars
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from llm_clients import streaming_to
+
+# Report sections shared by the session and course pages. They hold no widgets, so they
+# are plain functions; reruns are scoped by the selection, trace and overview fragments.
+# A section lays out its heading (and chart) with a placeholder for its analysis;
+# AnalysisFanOut.fill() writes the analyses in once the page is laid out.
+
+# LLM calls are network bound; one pool shared by all sessions runs a page's calls side by side
+LLM_WORKERS = int(os.getenv("REOXY_LLM_WORKERS", "6"))
+_llm_pool = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="reoxy-llm")
+
+# Stream analyses token by token into their sections; "0" waits for each full completion
+LLM_STREAMING = os.getenv("REOXY_LLM_STREAMING", "1") == "1"
+# Minimum time between redraws of one streaming section
+STREAM_REFRESH_SECONDS = 0.1
+
+
+class AnalysisFanOut:
+    """
+    Runs the analyses of one page concurrently and fills each section as its result lands
+
+    Page latency is that of the slowest call instead of the sum of all of them, and with
+    streaming every section shows its first tokens as soon as its provider sends them.
+    Computations run in worker threads and must not touch st; caching on the
+    session goes through the cached / store arguments, which stay on the script thread.
+    """
+
+    def __init__(self, streaming=LLM_STREAMING):
+        self.streaming = streaming
+        self.results = {}
+        self._pending = set()
+        self._events = queue.Queue()
+        self._stores = {}
+        self._placeholders = {}
+
+    def start(self, name, compute, cached=None, store=None):
+        """
+        Start one analysis unless its result is already known
+
+        Args:
+            name: Key of the analysis, also passed to the section that shows it
+            compute: Callable producing the analysis text, run in the thread pool
+            cached: Result looked up from a cache, or None to compute it
+            store: Optional callable(result) saving a fresh result
+        """
+        if cached is not None:
+            self.results[name] = cached
+            return
+        self._pending.add(name)
+        if store is not None:
+            self._stores[name] = store
+        # Worker threads see the caller's context variables, e.g. llm_clients.regenerating()
+        _llm_pool.submit(contextvars.copy_context().run, self._run, name, compute)
+
+    def start_group(self, names, compute, cached=None, stores=None):
+        """
+        Start one computation that produces several analyses, e.g. a single structured request
+
+        Args:
+            names: Keys of the analyses it produces
+            compute: Callable returning dict name -> analysis text, run in the thread pool
+            cached: dict name -> result already known; the group only runs when one is missing
+            stores: dict name -> callable(result) saving fresh results
+        """
+        cached = cached or {}
+        if all(cached.get(name) is not None for name in names):
+            self.results.update((name, cached[name]) for name in names)
+            return
+        self._pending.update(names)
+        self._stores.update(stores or {})
+        _llm_pool.submit(contextvars.copy_context().run, self._run_group, list(names), compute)
+
+    def _run_group(self, names, compute):
+        try:
+            # A half-received JSON document is not worth showing, so the group never streams
+            with streaming_to(None):
+                values = compute()
+        except Exception as e:
+            values = {name: f"Error in analysis: {str(e)}" for name in names}
+        for name in names:
+            self._events.put((name, values.get(name, "Error in analysis: no result"), True))
+
+    def _run(self, name, compute):
+        # Runs in a worker: text deltas and the final result go back through the event queue
+        sink = (lambda text: self._events.put((name, text, False))) if self.streaming else None
+        try:
+            with streaming_to(sink):
+                value = compute()
+        except Exception as e:
+            value = f"Error in analysis: {str(e)}"
+        self._events.put((name, value, True))
+
+    def placeholder(self, name, pending_text):
+        """Show the analysis if it is known, otherwise a placeholder fill() writes into"""
+        if name in self.results:
+            st.write(self.results[name])
+        else:
+            self._placeholders[name] = st.empty()
+            self._placeholders[name].caption(pending_text)
+
+    def fill(self):
+        """
+        Wait for the running analyses, streaming each into its placeholder as it arrives
+
+        Returns:
+            dict: name -> full analysis text for every analysis on the page
+        """
+        partial = {}
+        redrawn = {}
+        while self._pending:
+            name, payload, done = self._events.get()
+            if done:
+                self._pending.discard(name)
+                self.results[name] = payload
+                if name in self._stores:
+                    self._stores.pop(name)(payload)
+                if name in self._placeholders:
+                    self._placeholders.pop(name).write(payload)
+                continue
+            partial[name] = partial.get(name, "") + payload
+            now = time.monotonic()
+            if name in self._placeholders and now - redrawn.get(name, 0) >= STREAM_REFRESH_SECONDS:
+                self._placeholders[name].markdown(partial[name])
+                redrawn[name] = now
+        return self.results
+
+
+def text_analysis_section(title, fan_out, name, spinner_text=None):
+    """Subheader and one analysis text, e.g. the case history analysis"""
+    st.subheader(title)
+    fan_out.placeholder(name, spinner_text or f"Running {title.lower()}...")
+
+
+def chart_analysis_section(title, figure, fan_out, name, spinner_text=None):
+    """One progress chart followed by its analysis"""
+    st.write(f"**{title}:**")
+    st.plotly_chart(figure, use_container_width=True)
+    fan_out.placeholder(name, spinner_text or f"Analyzing {title.lower()}...")
@@ -0,0 +1,187 @@
+import pandas as pd
+
+# patient_data fields and the parser used to turn them into typed columns
+DURATION_FIELDS = [
+    'total_duration',
+    'total_hypoxic_time',
+    'adjustment_time',
+    'hypoxic_phase_duration_avg',
+    'hyperoxic_phase_duration_avg',
+]
+COUNT_FIELDS = [
+    'number_of_hypoxic_phases',
+    'number_of_hyperoxic_phases',
+]
+NUMBER_FIELDS = [
+    'min_spo2_average',
+    'max_spo2_average',
+    'baseline_pr',
+    'min_pr_average',
+    'max_pr_average',
+    'pr_after_procedure',
+    'pr_elevation_bpm',
+    'pr_elevation_percent',
+]
+BP_FIELDS = {
+    'bp_before_procedure': ('bp_before_sys', 'bp_before_dia'),
+    'bp_after_procedure': ('bp_after_sys', 'bp_after_dia'),
+}
+
+# Course report row names and the typed columns they become
+COURSE_DURATION_FIELDS = {
+    'Procedure duration (min:sec)': 'total_duration',
+    'Hypox. Phase dur. Av. (min:sec)': 'hypoxic_phase_duration_avg',
+    'Hyperox. Phase dur. Av. (min:sec)': 'hyperoxic_phase_duration_avg',
+}
+COURSE_COUNT_FIELDS = {
+    'Number of cycles': 'number_of_cycles',
+}
+COURSE_NUMBER_FIELDS = {
+    'Min SpO2 Av. (%)': 'min_spo2_average',
+    'Max SpO2 Av. (%)': 'max_spo2_average',
+    'Therapeutic SpO2 (%)': 'therapeutic_spo2',
+    'Hypoxic O2 conc. (%)': 'hypoxic_o2_conc',
+    'Min PR Av. (bpm)': 'min_pr_average',
+    'Max PR Av. (bpm)': 'max_pr_average',
+    'BP SYS before (mmHg)': 'bp_before_sys',
+    'BP DIA before (mmHg)': 'bp_before_dia',
+    'BP SYS after (mmHg)': 'bp_after_sys',
+    'BP DIA after (mmHg)': 'bp_after_dia',
+}
+
+
+def _as_text(values):
+    return pd.Series(values, dtype='string')
+
+
+def parse_min_sec(values):
+    """Parse "41:09 min:sec" style values into timedeltas (NaT when missing)"""
+    parts = _as_text(values).str.extract(r'(\d+):(\d{1,2})')
+    seconds = pd.to_numeric(parts[0], errors='coerce') * 60 + pd.to_numeric(parts[1], errors='coerce')
+    return pd.to_timedelta(seconds, unit='s')
+
+
+def parse_number(values):
+    """Parse the leading number of "82 %", "71 bpm" or comma-decimal "13,00" values (NaN when missing)"""
+    text = _as_text(values).str.replace(',', '.', regex=False)
+    return pd.to_numeric(text.str.extract(r'(-?\d+(?:\.\d+)?)')[0], errors='coerce').astype('float64')
+
+
+def parse_blood_pressure(values):
+    """
+    Parse "SYS/DIA" blood pressure values
+
+    Returns:
+        tuple: (systolic, diastolic) float Series; "---", "N/A" and blanks become NaN
+    """
+    text = _as_text(values).str.replace(',', '.', regex=False)
+    parts = text.str.extract(r'(\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?')
+    systolic = pd.to_numeric(parts[0], errors='coerce').astype('float64')
+    diastolic = pd.to_numeric(parts[1], errors='coerce').astype('float64')
+    return systolic, diastolic
+
+
+def build_session_frame(sorted_results):
+    """
+    Build a typed one-row-per-session frame from extracted ReOxy patient_data
+
+    Args:
+        sorted_results: Treatment number -> patient_data dict
+
+    Returns:
+        DataFrame: Indexed by treatment number with timedelta durations,
+        Int64 phase counts and float SpO2 / PR / BP columns
+    """
+    raw = pd.DataFrame.from_dict(dict(sorted_results), orient='index')
+    raw.index = raw.index.astype('int64')
+    raw.index.name = 'treatment_number'
+    raw = raw.sort_index()
+
+    frame = pd.DataFrame(index=raw.index)
+    for field in DURATION_FIELDS:
+        frame[field] = parse_min_sec(raw.get(field, pd.Series(index=raw.index, dtype='string'))).values
+    for field in COUNT_FIELDS:
+        frame[field] = parse_number(raw.get(field, pd.Series(index=raw.index, dtype='string'))).round().astype('Int64').values
+    for field in NUMBER_FIELDS:
+        frame[field] = parse_number(raw.get(field, pd.Series(index=raw.index, dtype='string'))).values
+    for field, (sys_column, dia_column) in BP_FIELDS.items():
+        systolic, diastolic = parse_blood_pressure(raw.get(field, pd.Series(index=raw.index, dtype='string')))
+        frame[sys_column] = systolic.values
+        frame[dia_column] = diastolic.values
+    return add_derived_metrics(frame)
+
+
+def build_course_frame(treatments, schedule=None):
+    """
+    Build a typed one-row-per-treatment frame from course report treatments
+
+    Args:
+        treatments: Treatment number -> {course report row name: value}
+        schedule: Treatment number -> date, added as the 'date' column
+
+    Returns:
+        DataFrame: Indexed by treatment number with the same column names as
+        build_session_frame where the two reports overlap, plus derived metrics
+    """
+    raw = pd.DataFrame.from_dict(dict(treatments), orient='index')
+    raw.index = raw.index.astype('int64')
+    raw.index.name = 'treatment_number'
+    raw = raw.sort_index()
+
+    frame = pd.DataFrame(index=raw.index)
+    schedule = schedule or {}
+    frame['date'] = pd.Series([schedule.get(num, '') for num in raw.index], index=raw.index, dtype='string')
+    missing = pd.Series(index=raw.index, dtype='string')
+    for field, column in COURSE_DURATION_FIELDS.items():
+        frame[column] = parse_min_sec(raw.get(field, missing)).values
+    for field, column in COURSE_COUNT_FIELDS.items():
+        frame[column] = parse_number(raw.get(field, missing)).round().astype('Int64').values
+    for field, column in COURSE_NUMBER_FIELDS.items():
+        frame[column] = parse_number(raw.get(field, missing)).values
+    return add_derived_metrics(frame)
+
+
+def add_derived_metrics(frame):
+    """
+    Add the metrics derived from several fields, for whichever inputs the frame has
+
+    pr_average: mean of min and max PR averages
+    total_hypoxic_time: hypoxic phase average x cycles, unless the report states it
+    bp_*_valid: systolic and diastolic both present
+    """
+    if 'min_pr_average' in frame and 'max_pr_average' in frame:
+        frame['pr_average'] = (frame['min_pr_average'] + frame['max_pr_average']) / 2
+    if 'total_hypoxic_time' not in frame and 'hypoxic_phase_duration_avg' in frame and 'number_of_cycles' in frame:
+        seconds = frame['hypoxic_phase_duration_avg'].dt.total_seconds() * frame['number_of_cycles'].astype('float64')
+        frame['total_hypoxic_time'] = pd.to_timedelta(seconds, unit='s')
+    for prefix in ('bp_before', 'bp_after'):
+        if f'{prefix}_sys' in frame and f'{prefix}_dia' in frame:
+            frame[f'{prefix}_valid'] = frame[f'{prefix}_sys'].notna() & frame[f'{prefix}_dia'].notna()
+    return frame
+
+
+def minutes(durations):
+    """Convert a timedelta Series to float minutes"""
+    return durations.dt.total_seconds() / 60
+
+
+def format_min_sec(durations):
+    """Format a timedelta Series as "MM:SS" strings ("N/A" when missing)"""
+    seconds = durations.dt.total_seconds().round()
+    text = (
+        (seconds // 60).astype('Int64').astype('string').str.zfill(2) + ':' +
+        (seconds % 60).astype('Int64').astype('string').str.zfill(2)
+    )
+    return text.fillna('N/A')
+
+
+def format_number(values):
+    """Format a float Series without a trailing ".0" ("N/A" when missing)"""
+    text = values.round(1).astype('string').str.replace(r'\.0$', '', regex=True)
+    return text.fillna('N/A')
+
+
+def format_blood_pressure(systolic, diastolic):
+    """Format systolic / diastolic Series as "SYS/DIA" strings ("N/A" without a systolic value)"""
+    text = format_number(systolic) + '/' + format_number(diastolic)
+    return text.where(systolic.notna(), 'N/A')
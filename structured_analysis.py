@@ -0,0 +1,124 @@
+import json
+import os
+
+from llm_clients import chat_completion
+from prompt_tables import sessions_block
+
+# Single-request analysis: the session table is sent once and the model answers every
+# section of the report in one JSON document instead of six separate completions.
+STRUCTURED_ANALYSIS = os.getenv("REOXY_STRUCTURED_ANALYSIS", "0") == "1"
+STRUCTURED_MODEL = "gpt-3.5-turbo"
+
+# Section key -> what the model should write for it
+SECTION_INSTRUCTIONS = {
+    'case_history': "2-3 sentences on key correlations between the case history and the treatment results, "
+                    "and relevant clinical insights",
+    'comparison': "Markdown with unordered lists on adaptive response changes between sessions: heart rate "
+                  "adaptation, SpO2 tolerance, hypoxic exposure tolerance and blood pressure response patterns",
+    'phase': "2-3 sentences on the relationship between hyperoxic and hypoxic phase durations and what it "
+             "indicates about the adaptive response",
+    'pr': "2-3 sentences on the recovery pattern of PR after procedure compared to PR average (mean of min and "
+          "max PR) and what it indicates about cardiovascular adaptation",
+    'hypoxic_time': "2-3 sentences on changes in total hypoxic time and what they suggest about adaptation to "
+                    "hypoxic stress",
+    'bp': "2-3 sentences on the acute blood pressure response (before vs after) and the trend across sessions; "
+          "say so if there is not enough blood pressure data",
+}
+
+# Columns of the session table, in order: (column header, patient_data field)
+SESSION_TABLE_COLUMNS = [
+    ('Date', 'treatment_date'),
+    ('Duration', 'total_duration'),
+    ('Hypoxic time', 'total_hypoxic_time'),
+    ('Hypoxic phases', 'number_of_hypoxic_phases'),
+    ('Hypoxic phase avg', 'hypoxic_phase_duration_avg'),
+    ('Hyperoxic phase avg', 'hyperoxic_phase_duration_avg'),
+    ('Min SpO2', 'min_spo2_average'),
+    ('Max SpO2', 'max_spo2_average'),
+    ('Baseline PR', 'baseline_pr'),
+    ('Min PR', 'min_pr_average'),
+    ('Max PR', 'max_pr_average'),
+    ('PR after', 'pr_after_procedure'),
+    ('PR elevation %', 'pr_elevation_percent'),
+    ('BP before', 'bp_before_procedure'),
+    ('BP after', 'bp_after_procedure'),
+]
+
+
+def analysis_schema(sections):
+    """JSON Schema of the answer: one required string per section"""
+    return {
+        'type': 'object',
+        'properties': {section: {'type': 'string'} for section in sections},
+        'required': list(sections),
+        'additionalProperties': False,
+    }
+
+
+def validate_analysis(document, schema):
+    """
+    Check a parsed answer against analysis_schema
+
+    Raises:
+        ValueError: The answer is not an object, misses a section, has extra keys or a non-string section
+    """
+    if not isinstance(document, dict):
+        raise ValueError("Structured analysis is not a JSON object")
+    missing = [key for key in schema['required'] if key not in document]
+    if missing:
+        raise ValueError(f"Structured analysis is missing sections: {', '.join(missing)}")
+    extra = [key for key in document if key not in schema['properties']]
+    if extra and not schema.get('additionalProperties', True):
+        raise ValueError(f"Structured analysis has unexpected sections: {', '.join(extra)}")
+    for key, value in document.items():
+        if key in schema['properties'] and not isinstance(value, str):
+            raise ValueError(f"Structured analysis section {key} is not text")
+
+
+def structured_prompt(sorted_results, sections, case_history=''):
+    """Prompt asking for every section at once, with the session data included a single time"""
+    instructions = '\n'.join(f'- "{section}": {SECTION_INSTRUCTIONS[section]}' for section in sections)
+    prompt = f"""Analyze these ReOxy treatment sessions. Answer with a single JSON object with exactly these keys, each a string:
+{instructions}
+
+{sessions_block(sorted_results.items(), SESSION_TABLE_COLUMNS, model=STRUCTURED_MODEL)}"""
+    if 'case_history' in sections:
+        prompt += f"""
+
+Case History:
+{case_history}"""
+    return prompt
+
+
+def structured_session_analysis(sorted_results, case_history=''):
+    """
+    Analyse all report sections of the sessions in one request
+
+    Args:
+        sorted_results: Treatment number -> patient_data, in session order
+        case_history: Case history text; the case history section is only requested when it is given
+
+    Returns:
+        dict: Section key (see SECTION_INSTRUCTIONS) -> analysis text
+
+    Raises:
+        ValueError: The model's answer does not match the schema (it is not cached)
+    """
+    sections = [section for section in SECTION_INSTRUCTIONS if section != 'case_history' or case_history.strip()]
+    schema = analysis_schema(sections)
+
+    def parse(text):
+        try:
+            document = json.loads(text)
+        except (TypeError, ValueError):
+            raise ValueError("Structured analysis is not valid JSON")
+        validate_analysis(document, schema)
+        return document
+
+    text = chat_completion(
+        model=STRUCTURED_MODEL,
+        messages=[{"role": "user", "content": structured_prompt(sorted_results, sections, case_history)}],
+        response_format={"type": "json_object"},
+        validate=parse,
+    )
+    return parse(text)
@@ -0,0 +1,217 @@
+import re
+
+import numpy as np
+import pdfplumber
+
+from upload_buffers import as_pdf_stream
+
+# Paths with fewer points than this are axes, grid lines or markers rather than traces
+MIN_TRACE_POINTS = 20
+
+NUMBER_PATTERN = re.compile(r'^-?\d+(?:[.,]\d+)?$')
+TIME_PATTERN = re.compile(r'^(\d{1,3}):(\d{2})$')
+
+
+def _tick_value(text):
+    """Return a tick label as a number (mm:ss labels become minutes), or None"""
+    text = text.strip()
+    time_match = TIME_PATTERN.match(text)
+    if time_match:
+        return int(time_match.group(1)) + int(time_match.group(2)) / 60
+    if NUMBER_PATTERN.match(text):
+        return float(text.replace(',', '.'))
+    return None
+
+
+def _path_points(obj):
+    points = obj.get('pts') or obj.get('points') or []
+    return [(float(x), float(y)) for x, y in points]
+
+
+def _candidate_paths(page):
+    """Collect long vector paths: single curve objects and chains of connected line segments"""
+    paths = [_path_points(curve) for curve in page.curves]
+
+    # Polylines are often drawn as one line object per sample
+    chain = []
+    for line in page.lines:
+        points = _path_points(line)
+        if len(points) < 2:
+            continue
+        if chain and abs(chain[-1][0] - points[0][0]) < 0.5 and abs(chain[-1][1] - points[0][1]) < 0.5:
+            chain.extend(points[1:])
+        else:
+            paths.append(chain)
+            chain = list(points)
+    paths.append(chain)
+
+    traces = []
+    for points in paths:
+        if len(points) < MIN_TRACE_POINTS:
+            continue
+        xs = [x for x, _ in points]
+        # A trace moves forward in time across the chart
+        if max(xs) - min(xs) < 50:
+            continue
+        traces.append(points)
+    return traces
+
+
+def _chart_region(page, points):
+    """Return the smallest frame rect around a trace, or a padded box around the trace itself"""
+    x0 = min(x for x, _ in points)
+    x1 = max(x for x, _ in points)
+    top = min(y for _, y in points)
+    bottom = max(y for _, y in points)
+    best = None
+    for rect in page.rects:
+        if rect['x0'] - 1 <= x0 and rect['x1'] + 1 >= x1 and rect['top'] - 1 <= top and rect['bottom'] + 1 >= bottom:
+            area = (rect['x1'] - rect['x0']) * (rect['bottom'] - rect['top'])
+            if best is None or area < best[0]:
+                best = (area, (rect['x0'], rect['top'], rect['x1'], rect['bottom']))
+    if best is not None:
+        return best[1]
+    padding = max(bottom - top, 60)
+    return (x0, top - padding, x1, bottom + padding)
+
+
+def _fit(pixels, values):
+    """Least-squares linear map from page coordinates to data values"""
+    slope, intercept = np.polyfit(np.asarray(pixels, dtype='float64'), np.asarray(values, dtype='float64'), 1)
+    return slope, intercept
+
+
+def _axis_maps(words, region):
+    """Fit y (value) and x (minutes) maps from the tick labels around a chart region"""
+    x0, top, x1, bottom = region
+    y_ticks = []
+    x_ticks = []
+    for word in words:
+        value = _tick_value(word['text'])
+        if value is None:
+            continue
+        center_y = (word['top'] + word['bottom']) / 2
+        center_x = (word['x0'] + word['x1']) / 2
+        # Y tick labels sit just left of the plot area
+        if x0 - 60 <= word['x1'] <= x0 + 2 and top - 6 <= center_y <= bottom + 6:
+            y_ticks.append((center_y, value))
+        # X tick labels sit just below it
+        elif bottom - 2 <= word['top'] <= bottom + 25 and x0 - 10 <= center_x <= x1 + 10:
+            x_ticks.append((center_x, value))
+
+    y_map = _fit(*zip(*y_ticks)) if len({v for _, v in y_ticks}) >= 2 else None
+    x_map = _fit(*zip(*x_ticks)) if len({v for _, v in x_ticks}) >= 2 else None
+    return y_map, x_map
+
+
+def _trace_name(words, region, values):
+    """Name a trace from the nearest chart label above or inside its region"""
+    x0, top, x1, bottom = region
+    best = None
+    for word in words:
+        text = word['text']
+        if 'SpO' in text:
+            name = 'spo2'
+        elif re.search(r'\bPR\b|Pulse|bpm', text):
+            name = 'pr'
+        else:
+            continue
+        if word['bottom'] > bottom or word['top'] < top - 40:
+            continue
+        distance = abs(word['top'] - top)
+        if best is None or distance < best[0]:
+            best = (distance, name)
+    if best is not None:
+        return best[1]
+    # SpO2 saturates near 100 %, pulse rate rarely does
+    return 'spo2' if np.nanmax(values) <= 100 and np.nanmedian(values) >= 85 else 'pr'
+
+
+def _resample_per_second(seconds, values):
+    order = np.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    values = values[order]
+    start = max(0, int(round(seconds[0])))
+    grid = np.arange(start, int(np.ceil(seconds[-1])) + 1, dtype='float64')
+    return start, np.interp(grid, seconds, values).astype(np.float32)
+
+
+def extract_session_traces(source, total_duration_seconds=None):
+    """
+    Recover the per-second SpO2 and pulse-rate traces drawn in a ReOxy session report
+
+    Args:
+        source: PDF bytes, path or open stream
+        total_duration_seconds: Session length, used to scale the time axis when it has no tick labels
+
+    Returns:
+        dict: Trace name ('spo2' / 'pr') -> {'start': first second, 'values': float32 array, one sample per second}
+    """
+    traces = {}
+    with pdfplumber.open(as_pdf_stream(source)) as pdf:
+        for page in pdf.pages:
+            paths = _candidate_paths(page)
+            if not paths:
+                continue
+            words = page.extract_words(keep_blank_chars=False, use_text_flow=False)
+            for points in paths:
+                region = _chart_region(page, points)
+                y_map, x_map = _axis_maps(words, region)
+                if y_map is None:
+                    continue
+                xs = np.array([x for x, _ in points], dtype='float64')
+                ys = np.array([y for _, y in points], dtype='float64')
+                values = y_map[0] * ys + y_map[1]
+                if x_map is not None:
+                    seconds = (x_map[0] * xs + x_map[1]) * 60
+                elif total_duration_seconds:
+                    seconds = (xs - xs.min()) / (xs.max() - xs.min()) * total_duration_seconds
+                else:
+                    continue
+                name = _trace_name(words, region, values)
+                if name in traces:
+                    continue
+                start, per_second = _resample_per_second(seconds, values)
+                traces[name] = {'start': start, 'values': per_second}
+            if len(traces) == 2:
+                break
+    return traces
+
+
+def lttb_downsample(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling for plotting
+
+    Args:
+        x, y: Equal-length arrays
+        threshold: Number of points to keep
+
+    Returns:
+        tuple: (x, y) arrays with at most threshold points, keeping the visual shape
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    sampled = np.empty(threshold, dtype='int64')
+    sampled[0] = 0
+    sampled[-1] = n - 1
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle point
+        next_start = int(np.floor((i + 1) * bucket_size)) + 1
+        next_end = min(int(np.floor((i + 2) * bucket_size)) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        start = int(np.floor(i * bucket_size)) + 1
+        end = int(np.floor((i + 1) * bucket_size)) + 1
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        sampled[i + 1] = a
+    return x[sampled], y[sampled]
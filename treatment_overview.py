@@ -0,0 +1,88 @@
+import html
+
+import pandas as pd
+import streamlit as st
+
+# Sessions shown per page of the Detailed Treatment Overview
+SESSIONS_PER_PAGE = 5
+
+# Table styling, sent with the table itself so a page is a single element
+OVERVIEW_TABLE_CSS = """
+<style>
+    .overview-table {
+        border-collapse: separate;
+        border-spacing: 4px;
+        width: 100%;
+    }
+    .overview-table th.treatment-header {
+        text-align: left;
+    }
+    .overview-table td.field-label {
+        width: 25%;
+    }
+</style>
+"""
+
+
+def page_labels(count, per_page=SESSIONS_PER_PAGE):
+    """Return "Sessions 1-5" style labels for count sessions"""
+    return [f"Sessions {start + 1}-{min(start + per_page, count)}" for start in range(0, count, per_page)]
+
+
+def overview_frame(treatment_nums, fields, value):
+    """
+    Overview cells as display strings
+
+    Args:
+        treatment_nums: Sessions to include, in display order
+        fields: (field_key, field_label) pairs, one row each
+        value: Callable(field_key, treatment_num) returning the cell value
+
+    Returns:
+        DataFrame: One row per field label, one "Session N" column per treatment
+    """
+    return pd.DataFrame(
+        {f"Session {num}": [str(value(field_key, num)) for field_key, _ in fields] for num in treatment_nums},
+        index=[label for _, label in fields],
+    )
+
+
+def overview_table_html(frame):
+    """Render an overview frame as one HTML table using the overview CSS classes"""
+    header = ''.join(f'<th class="treatment-header">{html.escape(column)}</th>' for column in frame.columns)
+    rows = []
+    for label, cells in zip(frame.index, frame.itertuples(index=False)):
+        row = ''.join(f'<td class="field-value">{html.escape(cell)}</td>' for cell in cells)
+        rows.append(f'<tr><td class="field-label">{html.escape(label)}</td>{row}</tr>')
+    return (
+        f'{OVERVIEW_TABLE_CSS}<div class="detailed-overview-content"><table class="overview-table">'
+        f'<thead><tr><th></th>{header}</tr></thead><tbody>{"".join(rows)}</tbody></table></div>'
+    )
+
+
+def render_overview(treatment_nums, fields, value, key):
+    """
+    Paginated overview: only the cells of the active page are built and sent
+
+    The element count is the same for any course length. "Show all sessions" swaps
+    the page for a single scrollable dataframe, which the browser renders lazily.
+
+    Args:
+        treatment_nums: Sorted treatment numbers
+        fields: (field_key, field_label) pairs
+        value: Callable(field_key, treatment_num) returning the cell value
+        key: Widget key prefix, unique per page of the app
+    """
+    if st.toggle("Show all sessions", key=f"{key}_all"):
+        st.dataframe(overview_frame(treatment_nums, fields, value), use_container_width=True)
+        return
+
+    labels = page_labels(len(treatment_nums))
+    page = 0
+    if len(labels) > 1:
+        page = st.selectbox("Page", range(len(labels)), format_func=labels.__getitem__, key=f"{key}_page")
+        # The remembered page can be past the end after a smaller selection is processed
+        page = min(page or 0, len(labels) - 1)
+    start = page * SESSIONS_PER_PAGE
+    page_frame = overview_frame(treatment_nums[start:start + SESSIONS_PER_PAGE], fields, value)
+    st.markdown(overview_table_html(page_frame), unsafe_allow_html=True)
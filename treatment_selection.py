@@ -0,0 +1,42 @@
+# Treatment selections are int bitsets: bit i is set when treatment_numbers[i] is selected
+
+
+def bits_from_treatments(selected, treatment_numbers):
+    """Return the bitset of the selected treatment numbers"""
+    selected = set(selected)
+    bits = 0
+    for position, treatment_num in enumerate(treatment_numbers):
+        if treatment_num in selected:
+            bits |= 1 << position
+    return bits
+
+
+def treatments_from_bits(bits, treatment_numbers):
+    """Return the selected treatment numbers, in treatment_numbers order"""
+    return [treatment_num for position, treatment_num in enumerate(treatment_numbers) if bits >> position & 1]
+
+
+def bits_from_flags(flags):
+    """Return the bitset of a sequence of booleans (e.g. a data_editor checkbox column)"""
+    bits = 0
+    for position, flag in enumerate(flags):
+        if flag:
+            bits |= 1 << position
+    return bits
+
+
+def flags_from_bits(bits, count):
+    """Return count booleans, one per bit"""
+    return [bool(bits >> position & 1) for position in range(count)]
+
+
+def range_bits(treatment_numbers, first, last):
+    """Bitset of the treatments numbered first to last, inclusive"""
+    return bits_from_treatments([num for num in treatment_numbers if first <= num <= last], treatment_numbers)
+
+
+def last_n_bits(count, n):
+    """Bitset of the last n of count treatments"""
+    n = max(0, min(n, count))
+    return ((1 << n) - 1) << (count - n)
+
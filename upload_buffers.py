@@ -0,0 +1,158 @@
+import hashlib
+import io
+import mmap
+import os
+import time
+from contextlib import contextmanager
+
+# Uploads larger than this are spilled to a content-addressed file and read through mmap
+SPOOL_THRESHOLD_BYTES = int(os.getenv("REOXY_SPOOL_THRESHOLD_BYTES", str(4 * 1024 * 1024)))
+SPOOL_DIR = os.getenv("REOXY_SPOOL_DIR", os.path.join(".cache", "uploads"))
+SPOOL_MAX_AGE_SECONDS = 24 * 60 * 60
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+class UploadBuffer:
+    """
+    One uploaded PDF, identified by the SHA-256 of its bytes
+
+    Small uploads are read in place from the uploader's own buffer; large ones
+    live in a spool file that parsers map into memory instead of copying.
+    """
+
+    def __init__(self, name, file_hash, size, upload=None, path=None):
+        self.name = name
+        self.file_hash = file_hash
+        self.size = size
+        self.upload = upload
+        self.path = path
+
+    @contextmanager
+    def open(self):
+        """Yield a seekable stream over the PDF without copying its bytes"""
+        if self.path:
+            with open(self.path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    yield mapped
+        else:
+            self.upload.seek(0)
+            yield self.upload
+
+    def worker_source(self):
+        """Source to hand to another process: the spool path, or the bytes for small uploads"""
+        if self.path:
+            return self.path
+        with self.upload.getbuffer() as view:
+            return bytes(view)
+
+
+class MappedStream(io.RawIOBase):
+    """Read-only file object over an mmap; pdfminer only opens paths and io streams"""
+
+    def __init__(self, mapped):
+        super().__init__()
+        self._mapped = mapped
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._mapped)
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), len(self._mapped))
+        size = max(end - self._position, 0)
+        buffer[:size] = self._mapped[self._position:end]
+        self._position += size
+        return size
+
+
+def as_pdf_stream(source):
+    """Accept PDF bytes, a file path or an open stream and return something pdfplumber / pdfminer can open"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # BytesIO shares an immutable bytes object until it is written to
+        return io.BytesIO(source)
+    if isinstance(source, mmap.mmap):
+        return MappedStream(source)
+    return source
+
+
+def _iter_chunks(file):
+    if hasattr(file, "getbuffer"):
+        with file.getbuffer() as view:
+            for offset in range(0, len(view), HASH_CHUNK_BYTES):
+                yield view[offset:offset + HASH_CHUNK_BYTES]
+        return
+    file.seek(0)
+    while True:
+        chunk = file.read(HASH_CHUNK_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _prune_spool_dir():
+    cutoff = time.time() - SPOOL_MAX_AGE_SECONDS
+    try:
+        for entry in os.scandir(SPOOL_DIR):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def spool_upload(file, file_hash=None):
+    """
+    Hash an uploaded file in a single streaming pass, spilling large files to disk
+
+    Args:
+        file: Uploaded file object (st.file_uploader result or any binary stream)
+        file_hash: Hash already known from an earlier run; skips re-hashing when the bytes need no spooling
+
+    Returns:
+        UploadBuffer
+    """
+    name = getattr(file, "name", "")
+    size = getattr(file, "size", None)
+    if size is None:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+
+    if file_hash is not None:
+        if size <= SPOOL_THRESHOLD_BYTES and hasattr(file, "getbuffer"):
+            return UploadBuffer(name, file_hash, size, upload=file)
+        path = os.path.join(SPOOL_DIR, f"{file_hash}.pdf")
+        if os.path.exists(path):
+            return UploadBuffer(name, file_hash, size, path=path)
+
+    digest = hashlib.sha256()
+    if size <= SPOOL_THRESHOLD_BYTES and hasattr(file, "getbuffer"):
+        for chunk in _iter_chunks(file):
+            digest.update(chunk)
+        return UploadBuffer(name, digest.hexdigest(), size, upload=file)
+
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    _prune_spool_dir()
+    temp_path = os.path.join(SPOOL_DIR, f".{os.getpid()}-{id(file)}.part")
+    with open(temp_path, "wb") as spool:
+        for chunk in _iter_chunks(file):
+            digest.update(chunk)
+            spool.write(chunk)
+    file_hash = digest.hexdigest()
+    path = os.path.join(SPOOL_DIR, f"{file_hash}.pdf")
+    # Content-addressed, so an existing spool file already holds these bytes
+    os.replace(temp_path, path)
+    return UploadBuffer(name, file_hash, size, path=path)